@@ -9,6 +9,7 @@ import re
 import requests
 import logging
 from ..websocket_manager import manager
+from ..user_store import make_user_store
 import asyncio
 from collections import defaultdict
 from google.cloud import firestore
@@ -30,20 +31,19 @@ location = "us-west1"
 # Initialize the FastAPI router
 router = APIRouter()
 
+# Firestore reads/writes of the users collection, off the event loop and behind a per user cache
+user_store = make_user_store(db)
+
+@router.on_event("shutdown")
+async def flush_user_store():
+    await user_store.close()
+
 
 @router.post("/user-complete-challenge")
 async def user_complete_challenge(request: UserCompleteChallenge):
     try:
-        document_data = {
-            "challenge_information": 
-            {
-                request.challenge_id_completed: {
-                    "completed": True
-                }
-            }
-        }
-        doc_ref = db.collection('users').document(request.user_id)
-        doc_ref.set(document_data, merge=True)  # Merge keeps existing fields
+        # written behind and batched with other users' completions, nothing is written if it is already recorded
+        await user_store.complete_challenge(request.user_id, request.challenge_id_completed)
         return {"message": "Document updated successfully."}
     except Exception as e:
         logger.error(f"Error updating document: {str(e)}")
@@ -54,16 +54,21 @@ async def get_user_data(user: dict = Depends(verify_firebase_token)):
     """Fetch the authenticated user's data from Firestore."""
     try:
         user_id = user["uid"]  # Extract Firebase user ID
-        user_ref = db.collection("users").document(user_id)
-        user_doc = user_ref.get()
+        user_data = await user_store.get_user(user_id)
 
-        if not user_doc.exists:
+        if user_data is None:
             raise HTTPException(status_code=404, detail="User not found")
 
-        user_data = user_doc.to_dict()
         user_data["id"] = user_id  # Include user ID
 
         return {"user": user_data}
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching user data: {str(e)}")
+
+@router.get("/user-store-stats")
+async def get_user_store_stats():
+    """User data cache hits, misses and writes"""
+    return user_store.stats()
\ No newline at end of file
@@ -0,0 +1 @@
+from .job_registry import *
\ No newline at end of file
@@ -0,0 +1,157 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+
+class InMemoryJobRegistry:
+    '''
+    user_id -> most recent job_id of the user, with an expiry. Only visible to the current process
+    '''
+    def __init__(self, ttl=None):
+        '''
+        ttl: float, seconds after which an entry is forgotten, None to keep entries forever
+        '''
+        self.ttl = ttl
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def _expires_at(self, ttl):
+        ttl = self.ttl if ttl is None else ttl
+        return time.time() + ttl if ttl else None
+
+    def _current(self, user_id):
+        entry = self._jobs.get(user_id)
+        if entry is None:
+            return None
+        job_id, expires_at = entry
+        if expires_at is not None and expires_at <= time.time():
+            del self._jobs[user_id]
+            return None
+        return job_id
+
+    def get(self, user_id):
+        '''
+        Returns the user's most recent job_id, None if unknown or expired
+        '''
+        with self._lock:
+            return self._current(user_id)
+
+    def set(self, user_id, job_id, ttl=None):
+        with self._lock:
+            self._jobs[user_id] = (job_id, self._expires_at(ttl))
+
+    def compare_and_swap(self, user_id, expected, job_id, ttl=None):
+        '''
+        Sets the user's job to job_id only if it currently is expected (None matches a missing entry).
+        Returns whether the swap happened
+        '''
+        with self._lock:
+            if self._current(user_id) != expected:
+                return False
+            self._jobs[user_id] = (job_id, self._expires_at(ttl))
+            return True
+
+    def stats(self):
+        with self._lock:
+            return {"backend": "memory", "entries": len(self._jobs)}
+
+
+class SQLiteJobRegistry:
+    '''
+    Same interface as InMemoryJobRegistry, stored in a SQLite file so every uvicorn worker (and every instance
+    mounting the same volume) sees the same entries. Lookups are a primary key read of a WAL database,
+    tens of microseconds, so they run directly on the event loop
+    '''
+    def __init__(self, path, ttl=None, purge_interval=300):
+        self.path = str(path)
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self._local = threading.local()
+        self._last_purge = 0
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS user_jobs (user_id TEXT PRIMARY KEY, job_id TEXT NOT NULL, expires_at REAL)"
+            )
+
+    def _connection(self):
+        # sqlite3 connections can't be shared between threads, keep one per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _expires_at(self, ttl):
+        ttl = self.ttl if ttl is None else ttl
+        return time.time() + ttl if ttl else None
+
+    def get(self, user_id):
+        row = self._connection().execute(
+            "SELECT job_id FROM user_jobs WHERE user_id = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (user_id, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, user_id, job_id, ttl=None):
+        self._connection().execute(
+            "INSERT OR REPLACE INTO user_jobs (user_id, job_id, expires_at) VALUES (?, ?, ?)",
+            (user_id, job_id, self._expires_at(ttl))
+        )
+        self._maybe_purge()
+
+    def compare_and_swap(self, user_id, expected, job_id, ttl=None):
+        conn = self._connection()
+        # BEGIN IMMEDIATE takes the write lock up front, so the read and the write can't interleave with another writer
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT job_id FROM user_jobs WHERE user_id = ? AND (expires_at IS NULL OR expires_at > ?)",
+                (user_id, time.time())
+            ).fetchone()
+            if (row[0] if row else None) != expected:
+                conn.execute("ROLLBACK")
+                return False
+            conn.execute(
+                "INSERT OR REPLACE INTO user_jobs (user_id, job_id, expires_at) VALUES (?, ?, ?)",
+                (user_id, job_id, self._expires_at(ttl))
+            )
+            conn.execute("COMMIT")
+            return True
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _maybe_purge(self):
+        now = time.time()
+        if now - self._last_purge < self.purge_interval:
+            return
+        self._last_purge = now
+        self._connection().execute("DELETE FROM user_jobs WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+
+    def stats(self):
+        entries = self._connection().execute("SELECT COUNT(*) FROM user_jobs").fetchone()[0]
+        return {"backend": "sqlite", "path": self.path, "entries": entries}
+
+
+def make_job_registry():
+    '''
+    SQLiteJobRegistry at JOB_REGISTRY_PATH if it is set, InMemoryJobRegistry otherwise.
+    JOB_REGISTRY_TTL is the entry lifetime in seconds (default 6 hours, 0 to keep entries forever)
+    '''
+    ttl = float(os.environ.get("JOB_REGISTRY_TTL", str(6 * 60 * 60))) or None
+    path = os.environ.get("JOB_REGISTRY_PATH")
+    if path:
+        logger.info(f"Using SQLite job registry at {path}")
+        return SQLiteJobRegistry(path, ttl=ttl)
+    return InMemoryJobRegistry(ttl=ttl)
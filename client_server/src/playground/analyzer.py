@@ -0,0 +1,125 @@
+import math
+
+# Static checks of a diagram, run before a training job is enqueued. Mirrors how the training server builds the model
+# (training_server/src/utils/utils.py, Diagram.create_model_from_inputs) without importing torch: the width of the
+# features and the range of the values are propagated block by block against the dataset's known shapes, and the
+# result is checked against what the loss function accepts. Only diagrams that are certain to fail are rejected,
+# style problems and outputs that may leave the loss function's range stay warnings (see handle_design_warnings).
+
+# output_shape and task of every dataset the training server can load. The input width needs no check,
+# the first linear layer always gets the dataset's number of features as in_features
+DATASETS = {
+    "emails": {"output_shape": 1, "task": "binary_classification"},
+    "mushrooms": {"output_shape": 1, "task": "binary_classification"},
+    "weather": {"output_shape": 5, "task": "multiclass_classification"},
+    "shapes": {"output_shape": 3, "task": "multiclass_classification"},
+}
+
+OPTIMIZERS = {"adam_algorithm", "sgd_algorithm", "momentum_algorithm"}
+
+# keyword arguments each block accepts (the torch module's constructor arguments)
+BLOCK_PARAMS = {
+    "linear_layer": {"out_features", "bias"},
+    "flatten_layer": {"start_dim", "end_dim"},
+    "relu_activation": {"inplace"},
+    "sigmoid_activation": set(),
+    "tanh_activation": set(),
+    "softmax_activation": {"dim"},
+    "dropout_layer": {"p", "inplace"},
+}
+
+# (low, high) bounds of the block's output for an input within (low, high)
+ACTIVATION_RANGES = {
+    "relu_activation": lambda low, high: (max(low, 0.0), max(high, 0.0)),
+    "sigmoid_activation": lambda low, high: (0.0, 1.0),
+    "tanh_activation": lambda low, high: (-1.0, 1.0),
+    "softmax_activation": lambda low, high: (0.0, 1.0),
+}
+
+# same wording as Diagram.errorHandler on the training server, which raises it when an output actually is out of range
+RANGE_MESSAGE = "Selected loss function requires model outputs to be between 0 and 1. Apply an appropriate activation function as the last layer to achieve this range!"
+TASK_MESSAGE = "Loss function does not work with specified task due to different expected outputs. For this challenge, choose a loss function that works with {task}!"
+
+
+def analyze_diagram(diagram):
+    '''
+    Returns (errors, shapes). errors is a list of {"message": str, "layer": int} (layer is the 1-based position
+    of the offending block, or the number of blocks for errors about the output), empty if the diagram can train.
+    shapes lists the feature width after every block, "input" standing for the dataset's feature count
+    '''
+    errors = []
+    blocks = sorted(diagram.blocks, key=lambda block: block.order)
+    n_layers = len(blocks)
+
+    def error(message, layer=n_layers):
+        errors.append({"message": message, "layer": layer})
+
+    dataset = DATASETS.get(diagram.dataset)
+    if dataset is None:
+        error(f"Unknown dataset {diagram.dataset}!")
+        return errors, []
+    if diagram.loss_fn not in ("cross_entropy_loss", "bce", "hinge_loss"):
+        error(f"Unknown loss function {diagram.loss_fn}!")
+    if diagram.optimizer not in OPTIMIZERS:
+        error(f"Unknown optimizer {diagram.optimizer}!")
+    if not diagram.lr > 0:
+        error("Learning rate must be greater than 0!")
+
+    linear_positions = [i for i, block in enumerate(blocks) if block.block_id == "linear_layer"]
+    if not linear_positions:
+        error("The model needs at least one linear layer to produce predictions!")
+        return errors, []
+
+    # width of the features after each block
+    width = "input"
+    shapes = []
+    for i, block in enumerate(blocks):
+        layer = i + 1
+        name = block.block_id
+        if name not in BLOCK_PARAMS:
+            error(f"Unknown block {name} at layer {layer}!", layer)
+            return errors, shapes
+        unknown = set(block.params) - BLOCK_PARAMS[name]
+        if unknown:
+            error(f"Unsupported parameters {sorted(unknown)} for {name} at layer {layer}!", layer)
+
+        if name == "linear_layer":
+            out_features = block.params.get("out_features")
+            if i == linear_positions[-1] and "out_features" in block.params:
+                # the training server resizes the last linear layer to the dataset's output shape
+                out_features = dataset["output_shape"]
+            if not isinstance(out_features, int) or isinstance(out_features, bool) or out_features < 1:
+                error(f"Linear layer at layer {layer} needs a positive whole number of output features!", layer)
+                out_features = "?"
+            width = out_features
+        elif name == "dropout_layer":
+            p = block.params.get("p", 0.5)
+            if not isinstance(p, (int, float)) or not 0 <= p <= 1:
+                error(f"Dropout probability at layer {layer} must be between 0 and 1!", layer)
+        shapes.append(width)
+
+    if dataset["task"] == "binary_classification" and diagram.loss_fn == "cross_entropy_loss":
+        error(TASK_MESSAGE.format(task="binary_classification"))
+    elif dataset["task"] != "binary_classification" and diagram.loss_fn in ("bce", "hinge_loss"):
+        error(TASK_MESSAGE.format(task=dataset["task"]))
+
+    return errors, shapes
+
+
+def output_range(blocks):
+    '''
+    (low, high) bounds of the model's outputs during training, blocks sorted by order. Only a bound, the outputs
+    may well stay within a narrower range
+    '''
+    low, high = -math.inf, math.inf
+    for block in blocks:
+        if block.block_id == "linear_layer":
+            low, high = -math.inf, math.inf
+        elif block.block_id == "dropout_layer":
+            p = block.params.get("p", 0.5)
+            if isinstance(p, (int, float)) and 0 <= p < 1:
+                # during training the kept values are scaled up by 1 / (1 - p)
+                low, high = min(low, low / (1 - p)), max(high, high / (1 - p))
+        elif block.block_id in ACTIVATION_RANGES:
+            low, high = ACTIVATION_RANGES[block.block_id](low, high)
+    return low, high
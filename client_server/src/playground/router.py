@@ -1,5 +1,4 @@
 from fastapi import APIRouter
-from google.cloud import tasks_v2
 import json
 import os
 import time
@@ -8,8 +7,13 @@ import re
 import requests
 import logging
 from ..websocket_manager import manager
+from ..task_queue import TaskQueue, make_backend
+from ..job_registry import make_job_registry
+from .analyzer import analyze_diagram, output_range, RANGE_MESSAGE
 import asyncio
+import threading
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 # Configure logging
 logging.basicConfig(
@@ -23,14 +27,63 @@ project_number = "590321385188" # Associated with project, it's not publically e
 location = "us-west1"
 queue = "myapi-training-queue" 
 TRAINING_SERVICE_URL = "https://training-server-590321385188.us-west1.run.app/train"
+# base url of the training server's POST /jobs/{job_id}/cancel, empty to not cancel jobs on the training server
+TRAINING_SERVER_URL = os.environ.get("TRAINING_SERVER_URL", TRAINING_SERVICE_URL[:-len("/train")])
 
-task_client = tasks_v2.CloudTasksClient()
-queue_path = task_client.queue_path(project, location, queue)
+# Cloud Tasks (or the in process stand-in, see TASK_QUEUE_BACKEND) behind an async, micro-batching queue
+task_queue = TaskQueue(make_backend(project, location, queue, TRAINING_SERVICE_URL))
 
 # Initialize the FastAPI router
 router = APIRouter()
-# User jobs dictionary, lists user and their most recent job
-userJobs = defaultdict(str) # user_id -> job_id
+# User jobs registry, lists user and their most recent job (user_id -> job_id)
+# set JOB_REGISTRY_PATH to share it between uvicorn workers / instances
+userJobs = make_job_registry()
+# diagrams checked by the static analyzer, and those rejected before a training job was enqueued for them
+analyzer_stats = {"analyzed": 0, "rejected": 0}
+# cancel requests sent to the training server, from a small pool so they never wait on the event loop
+cancel_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="job-cancel")
+cancel_stats = {"sent": 0, "failed": 0}
+# post_cancel runs on the executor's threads, += on a shared dict is not atomic
+cancel_stats_lock = threading.Lock()
+
+
+def post_cancel(job_id):
+    try:
+        requests.post(f"{TRAINING_SERVER_URL}/jobs/{job_id}/cancel", timeout=5).raise_for_status()
+        with cancel_stats_lock:
+            cancel_stats["sent"] += 1
+    except Exception as e:
+        with cancel_stats_lock:
+            cancel_stats["failed"] += 1
+        logger.info(f"Failed to cancel job {job_id} on the training server: {e}")
+
+
+def cancel_training(job_id):
+    '''
+    Tells the training server to stop job_id without waiting for the answer. The job stops within a batch
+    instead of at the end of its epoch, when it reads stop_training from its next update
+    '''
+    if job_id and TRAINING_SERVER_URL:
+        cancel_executor.submit(post_cancel, job_id)
+
+
+# running supersede() calls, the event loop only keeps weak references to tasks
+superseding = set()
+
+
+async def supersede(job_id):
+    '''
+    Stops a job the user replaced or cancelled: its task is deleted from the queue if it hasn't been dispatched yet
+    (task names are derived from the job id), otherwise the training server is told to cancel it
+    '''
+    if job_id and not await task_queue.purge(job_id):
+        cancel_training(job_id)
+
+
+def supersede_later(job_id):
+    task = asyncio.ensure_future(supersede(job_id))
+    superseding.add(task)
+    task.add_done_callback(superseding.discard)
 
 @router.post("/process-diagram/")
 async def process_diagram(data: DiagramRequest):
@@ -48,8 +101,32 @@ async def process_diagram(data: DiagramRequest):
 
     await handle_design_warnings(data.blocks, data.job_id, data.loss_fn)
 
+    # diagrams that are certain to fail on the training server are rejected here, before paying for a task
+    errors, shapes = analyze_diagram(data)
+    analyzer_stats["analyzed"] += 1
+    if errors:
+        analyzer_stats["rejected"] += 1
+        # reported like an error of the training server, the first one is the one shown
+        await manager.send_json(data.user_id, {
+            "message": errors[0]["message"],
+            "update_type": "error",
+            "layer": errors[0]["layer"],
+            "job_id": data.job_id,
+        })
+        return {
+            "message": "Diagram rejected",
+            "job_id": data.job_id,
+            "user_id": data.user_id,
+            "errors": errors,
+        }
+
+    # only an accepted diagram replaces the user's job, a rejected one leaves the previous job running
     if data.user_id:
-        userJobs[data.user_id] = data.job_id
+        previous_job = userJobs.get(data.user_id)
+        userJobs.set(data.user_id, data.job_id)
+        # the previous job's results would be dropped anyway, drop its task or free its worker now
+        if previous_job != data.job_id:
+            supersede_later(previous_job)
 
     # encode the payload as bytes and send it as a job
     payload_dict = {
@@ -59,17 +136,10 @@ async def process_diagram(data: DiagramRequest):
         "user_id": data.user_id,
         "dataset": data.dataset,
     }
-    task_payload = json.dumps(payload_dict).encode()
 
     # UNCOMMENT FOR GCP
-    task = {
-        "http_request": { 
-            "http_method": tasks_v2.HttpMethod.POST,
-            "url": TRAINING_SERVICE_URL,
-            "body": task_payload,
-        }
-    }
-    response = task_client.create_task(parent=queue_path, task=task)
+    # the task is created off the event loop, together with other submissions arriving at the same time
+    await task_queue.enqueue(payload_dict)
 
     # sent post request to training server
 
@@ -82,12 +152,35 @@ async def process_diagram(data: DiagramRequest):
         "data": data,
     }
 
+@router.get("/metrics")
+async def metrics():
+    """
+    Task enqueue counters and latency percentiles, job registry size and training jobs saved by the analyzer
+    """
+    return {
+        "task_queue": task_queue.stats(),
+        "job_registry": userJobs.stats(),
+        "analyzer": dict(analyzer_stats, saved_training_jobs=analyzer_stats["rejected"]),
+        "cancellations": dict(cancel_stats),
+    }
+
 @router.post("/cancel-job/")
 async def cancel_job(req: JobCancelRequest):
     """
     Cancels the most recent job for a user.
+    If job_id is given, only that job is cancelled, a newer job submitted in the meantime keeps running
     """
-    userJobs[req.user_id] = ""
+    if req.job_id is None:
+        job_id = userJobs.get(req.user_id)
+        userJobs.set(req.user_id, "")
+    elif not userJobs.compare_and_swap(req.user_id, req.job_id, ""):
+        return {
+            "message": "Job already superseded",
+            "user_id": req.user_id
+        }
+    else:
+        job_id = req.job_id
+    supersede_later(job_id)
     return {
         "message": "Job cancelled",
         "user_id": req.user_id
@@ -156,6 +249,11 @@ async def handle_design_warnings(blocks, job_id, loss_fn):
             n_layers
         )
 
+    low, high = output_range(blocks)
+    if loss_fn == 'bce' and (low < 0 or high > 1):
+        # not provably within [0, 1], e.g. a linear last layer, the training server fails if the outputs leave it
+        upgrade_to_warning(RANGE_MESSAGE, n_layers)
+
     if previous_dropout_layer > previous_linear_layer:
         upgrade_to_warning(
             f"Dropout at layer {previous_dropout_layer+1} should be followed by a layer with learnable parameters, i.e. a linear layer",
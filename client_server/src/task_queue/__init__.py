@@ -0,0 +1 @@
+from .task_queue import *
\ No newline at end of file
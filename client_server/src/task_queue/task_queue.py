@@ -0,0 +1,313 @@
+import os
+import time
+import json
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+
+def task_id(job_id):
+    '''
+    Task id derived from job_id, so the task of a job can be found again to delete it. Hashed: Cloud Tasks only accepts
+    [A-Za-z0-9_-] in task ids and dispatches tasks with sequential names more slowly
+    '''
+    return "job-" + hashlib.sha256(str(job_id).encode()).hexdigest()[:32]
+
+
+class CloudTasksBackend:
+    '''
+    Creates one Cloud Tasks HTTP task per payload. Cloud Tasks has no batch create call, the tasks of a batch are
+    created concurrently on a small thread pool (the gRPC client is thread safe).
+    Tasks are named after the payload's job_id, see task_name()
+    '''
+    def __init__(self, project, location, queue, target_url, max_concurrency=8):
+        self.project = project
+        self.location = location
+        self.queue = queue
+        self.target_url = target_url
+        self._client = None
+        self._pool = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="cloud-tasks")
+
+    @property
+    def client(self):
+        if self._client is None:
+            from google.cloud import tasks_v2
+            self._client = tasks_v2.CloudTasksClient()
+        return self._client
+
+    def task_name(self, job_id):
+        return f"projects/{self.project}/locations/{self.location}/queues/{self.queue}/tasks/{task_id(job_id)}"
+
+    def create_task(self, payload):
+        from google.cloud import tasks_v2
+        from google.api_core.exceptions import AlreadyExists
+        task = {
+            "http_request": {
+                "http_method": tasks_v2.HttpMethod.POST,
+                "url": self.target_url,
+                "body": json.dumps(payload).encode(),
+            }
+        }
+        if payload.get("job_id") is not None:
+            task["name"] = self.task_name(payload["job_id"])
+        parent = self.client.queue_path(self.project, self.location, self.queue)
+        try:
+            return self.client.create_task(parent=parent, task=task).name
+        except AlreadyExists:
+            # the job's task was created before, e.g. by a retried request
+            return task["name"]
+
+    def enqueue_batch(self, payloads):
+        '''
+        Blocking, runs on the TaskQueue executor. Returns one task name or exception per payload
+        '''
+        futures = [self._pool.submit(self.create_task, payload) for payload in payloads]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def delete_task(self, name):
+        '''
+        Blocking. Returns False if the task doesn't exist anymore, i.e. it was dispatched already
+        '''
+        from google.api_core.exceptions import NotFound
+        try:
+            self.client.delete_task(name=name)
+        except NotFound:
+            return False
+        return True
+
+
+class InProcessBackend:
+    '''
+    Stand-in for Cloud Tasks in tests and load runs. Like in a Cloud Tasks queue, tasks wait dispatch_delay seconds
+    before they are dispatched (POSTed to target_url if one is given) and can be deleted until then
+    '''
+    def __init__(self, target_url=None, max_tasks=10000, dispatch_delay=0.0, max_concurrent_dispatches=8):
+        self.target_url = target_url
+        self.dispatch_delay = dispatch_delay
+        # every created task, for inspection
+        self.tasks = deque(maxlen=max_tasks)
+        self._pending = OrderedDict()  # name -> (dispatch at, payload), in dispatch order
+        self._cond = threading.Condition()
+        self._counter = 0
+        self._dispatcher = None
+        self._pool = ThreadPoolExecutor(max_workers=max_concurrent_dispatches, thread_name_prefix="in-process-dispatch")
+        self.created = 0
+        self.dispatched = 0
+        self.deleted = 0
+        self.failed_dispatches = 0
+
+    def task_name(self, job_id):
+        return f"in-process/tasks/{task_id(job_id)}"
+
+    def enqueue_batch(self, payloads):
+        results = []
+        with self._cond:
+            for payload in payloads:
+                self._counter += 1
+                name = self.task_name(payload["job_id"]) if payload.get("job_id") is not None else f"in-process/tasks/{self._counter}"
+                if name not in self._pending:
+                    self._pending[name] = (time.monotonic() + self.dispatch_delay, payload)
+                    self.tasks.append({"name": name, "payload": payload})
+                    self.created += 1
+                results.append(name)
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(target=self._dispatch, name="in-process-dispatcher", daemon=True)
+                self._dispatcher.start()
+            self._cond.notify()
+        return results
+
+    def delete_task(self, name):
+        with self._cond:
+            if self._pending.pop(name, None) is None:
+                return False
+            self.deleted += 1
+            return True
+
+    def _dispatch(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                # every task waits the same delay, the oldest one is due first
+                name, (dispatch_at, payload) = next(iter(self._pending.items()))
+                wait = dispatch_at - time.monotonic()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+                del self._pending[name]
+                self.dispatched += 1
+            if self.target_url:
+                self._pool.submit(self._post, payload)
+
+    def _post(self, payload):
+        try:
+            import requests
+            requests.post(self.target_url, json=payload, timeout=10).raise_for_status()
+        except Exception as e:
+            self.failed_dispatches += 1
+            logger.error(f"Failed to dispatch task: {e}")
+
+    def stats(self):
+        with self._cond:
+            return {
+                "created": self.created,
+                "dispatched": self.dispatched,
+                "deleted": self.deleted,
+                "failed_dispatches": self.failed_dispatches,
+                "waiting": len(self._pending),
+            }
+
+
+def make_backend(project, location, queue, target_url):
+    '''
+    TASK_QUEUE_BACKEND selects the backend: "cloud_tasks" (default) or "in_process".
+    The in process backend POSTs to TASK_QUEUE_TARGET_URL when it is set, TASK_QUEUE_DISPATCH_DELAY seconds
+    (default 0) after the task was created
+    '''
+    backend = os.environ.get("TASK_QUEUE_BACKEND", "cloud_tasks")
+    if backend == "in_process":
+        return InProcessBackend(
+            os.environ.get("TASK_QUEUE_TARGET_URL"),
+            dispatch_delay=float(os.environ.get("TASK_QUEUE_DISPATCH_DELAY", "0"))
+        )
+    if backend != "cloud_tasks":
+        raise ValueError(f"Unknown TASK_QUEUE_BACKEND {backend}")
+    return CloudTasksBackend(project, location, queue, target_url)
+
+
+class TaskQueue:
+    '''
+    Async front of a task backend. enqueue() never blocks the event loop: payloads submitted within max_delay seconds
+    of each other are grouped into one batch (up to max_batch_size) and the backend call runs on a thread pool.
+    Keeps the enqueue latency (submission to task created) of the last latency_window tasks
+    '''
+    def __init__(self, backend, max_batch_size=32, max_delay=0.005, max_inflight_batches=4, latency_window=1000):
+        self.backend = backend
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.max_inflight_batches = max_inflight_batches
+        self._executor = ThreadPoolExecutor(max_workers=max_inflight_batches, thread_name_prefix="task-queue")
+        self._queue = None
+        self._worker = None
+        self._inflight = None
+        self._sending = set()
+        self._latencies = deque(maxlen=latency_window)
+        self._batch_sizes = deque(maxlen=latency_window)
+        self.enqueued = 0
+        self.failed = 0
+        self.batches = 0
+        self.purged = 0
+        self.purge_misses = 0
+
+    async def enqueue(self, payload):
+        '''
+        Queues payload (a JSON serializable dict) and returns the created task's name once the backend accepted it.
+        Raises the backend's exception if creating this task failed
+        '''
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((payload, future, time.perf_counter()))
+        return await future
+
+    def _ensure_started(self):
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._inflight = asyncio.Semaphore(self.max_inflight_batches)
+            self._worker = asyncio.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self._inflight.acquire()
+            # keep a reference, the event loop only holds weak references to tasks
+            task = asyncio.create_task(self._send(batch))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _send(self, batch):
+        loop = asyncio.get_running_loop()
+        try:
+            try:
+                results = await loop.run_in_executor(self._executor, self.backend.enqueue_batch, [payload for payload, _, _ in batch])
+            except Exception as e:
+                results = [e] * len(batch)
+            now = time.perf_counter()
+            self.batches += 1
+            self._batch_sizes.append(len(batch))
+            for (_, future, submitted_at), result in zip(batch, results):
+                self._latencies.append(now - submitted_at)
+                if isinstance(result, Exception):
+                    self.failed += 1
+                    logger.error(f"Failed to enqueue task: {result}")
+                    if not future.done():
+                        future.set_exception(result)
+                else:
+                    self.enqueued += 1
+                    if not future.done():
+                        future.set_result(result)
+        finally:
+            self._inflight.release()
+
+    async def purge(self, job_id):
+        '''
+        Deletes the task of job_id if it is still waiting in the queue. Returns False if it was dispatched already
+        (or its creation hasn't finished yet)
+        '''
+        loop = asyncio.get_running_loop()
+        try:
+            deleted = await loop.run_in_executor(self._executor, self.backend.delete_task, self.backend.task_name(job_id))
+        except Exception as e:
+            logger.error(f"Failed to delete the task of job {job_id}: {e}")
+            deleted = False
+        if deleted:
+            self.purged += 1
+        else:
+            self.purge_misses += 1
+        return deleted
+
+    def stats(self):
+        latencies = sorted(self._latencies)
+
+        def percentile(p):
+            if not latencies:
+                return None
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000
+
+        return {
+            "backend": type(self.backend).__name__,
+            "enqueued": self.enqueued,
+            "failed": self.failed,
+            "batches": self.batches,
+            "purged": self.purged,
+            "purge_misses": self.purge_misses,
+            "pending": self._queue.qsize() if self._queue is not None else 0,
+            "mean_batch_size": sum(self._batch_sizes) / len(self._batch_sizes) if self._batch_sizes else None,
+            "latency_ms": {"p50": percentile(0.5), "p95": percentile(0.95), "p99": percentile(0.99), "max": percentile(1.0)},
+            "backend_stats": self.backend.stats() if hasattr(self.backend, "stats") else None,
+        }
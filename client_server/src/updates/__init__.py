@@ -0,0 +1 @@
+from .router import *
\ No newline at end of file
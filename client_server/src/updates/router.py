@@ -0,0 +1,101 @@
+from fastapi import APIRouter, WebSocket
+from starlette.websockets import WebSocketDisconnect
+from pydantic import ValidationError
+import time
+import logging
+from src.utils import Update
+from ..websocket_manager import manager
+from .. import playground
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+# updates handled and time spent handling them, per transport
+update_stats = {
+    "http": {"updates": 0, "handler_seconds": 0.0},
+    "stream": {"updates": 0, "handler_seconds": 0.0, "open_streams": 0},
+}
+
+
+async def process_update(update: Update):
+    '''
+    Forwards a training update to the user's websocket and tells the training server whether to stop,
+    shared by the /updates POST route and the /updates-stream websocket
+    '''
+    # Get the message data
+    msg = update.message
+    update_type = update.update_type
+    metrics = update.metrics
+    job_id = update.job_id
+
+    if not msg:
+        return {"error": "No message received"}
+
+    cancel_task = False
+    # if the user's most recent job is not the current job, cancel the task
+    if playground.userJobs.get(update.user_id) != job_id:
+        cancel_task = True
+
+    # job_id lets the connection coalesce queued progress updates per job
+    await manager.send_json(update.user_id, {"message": msg, "update_type": update_type, "metrics": metrics, "stop_training": cancel_task, "job_id": job_id})
+
+    return {"result": msg, "stop_training": cancel_task}
+
+
+@router.post("/updates")
+async def handle_updates(update: Update):
+    '''
+    Receives json object
+    '''
+    start = time.process_time()
+    active_connections = manager.get_active_connections()
+    logging.info(f"Received update: {update}")
+    logging.info(f"Number of active connections: {len(active_connections)}")
+
+    response = await process_update(update)
+    response["number of connections"] = len(active_connections)
+    update_stats["http"]["updates"] += 1
+    update_stats["http"]["handler_seconds"] += time.process_time() - start
+    return response
+
+
+@router.websocket("/updates-stream")
+async def handle_update_stream(websocket: WebSocket):
+    '''
+    Long lived alternative to POST /updates, opened by the training server once per job.
+    Every text frame is an Update, every frame is answered with {"stop_training": bool} (or {"error": ...})
+    '''
+    await websocket.accept()
+    update_stats["stream"]["open_streams"] += 1
+    try:
+        while True:
+            frame = await websocket.receive_text()
+            start = time.process_time()
+            try:
+                response = await process_update(Update.model_validate_json(frame))
+            except ValidationError as e:
+                response = {"error": str(e)}
+            await websocket.send_json(response)
+            update_stats["stream"]["updates"] += 1
+            update_stats["stream"]["handler_seconds"] += time.process_time() - start
+    except WebSocketDisconnect:
+        pass
+    finally:
+        update_stats["stream"]["open_streams"] -= 1
+
+
+@router.get("/updates-stats")
+async def get_update_stats():
+    '''
+    Updates received per transport and the mean handler CPU time per update
+    '''
+    return {
+        transport: dict(stats, cpu_ms_per_update=stats["handler_seconds"] / stats["updates"] * 1000 if stats["updates"] else None)
+        for transport, stats in update_stats.items()
+    }
@@ -0,0 +1 @@
+from .user_store import *
\ No newline at end of file
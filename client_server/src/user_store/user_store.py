@@ -0,0 +1,301 @@
+import os
+import copy
+import time
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+
+def deep_merge(target: dict, data: dict):
+    '''
+    Firestore set(..., merge=True) semantics: nested maps are merged key by key, other values are replaced
+    '''
+    for key, value in data.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            deep_merge(target[key], value)
+        else:
+            target[key] = copy.deepcopy(value)
+
+
+class InMemorySnapshot:
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self._data = data
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+
+class InMemoryDocument:
+    def __init__(self, store, collection, doc_id):
+        self._store = store
+        self._key = (collection, doc_id)
+        self.id = doc_id
+
+    def get(self):
+        with self._store.lock:
+            self._store.reads += 1
+            return InMemorySnapshot(self.id, copy.deepcopy(self._store.documents.get(self._key)))
+
+    def set(self, data, merge=False):
+        with self._store.lock:
+            self._store.writes += 1
+            if merge and self._key in self._store.documents:
+                deep_merge(self._store.documents[self._key], data)
+            else:
+                self._store.documents[self._key] = copy.deepcopy(data)
+
+
+class InMemoryWriteBatch:
+    def __init__(self, store):
+        self._store = store
+        self._writes = []
+
+    def set(self, document, data, merge=False):
+        self._writes.append((document, data, merge))
+
+    def commit(self):
+        # applied under one lock acquisition, like a batch commit is atomic
+        with self._store.lock:
+            self._store.batches += 1
+            for document, data, merge in self._writes:
+                self._store.writes += 1
+                if merge and document._key in self._store.documents:
+                    deep_merge(self._store.documents[document._key], data)
+                else:
+                    self._store.documents[document._key] = copy.deepcopy(data)
+
+
+class InMemoryCollection:
+    def __init__(self, store, name):
+        self._store = store
+        self.name = name
+
+    def document(self, doc_id):
+        return InMemoryDocument(self._store, self.name, doc_id)
+
+
+class InMemoryFirestore:
+    '''
+    Stand-in for the part of firestore.Client the client server uses (collection().document().get()/set() and
+    batch()), for tests and offline runs. Counts reads, writes and batch commits
+    '''
+    def __init__(self):
+        self.documents = {}
+        self.lock = threading.Lock()
+        self.reads = 0
+        self.writes = 0
+        self.batches = 0
+
+    def collection(self, name):
+        return InMemoryCollection(self, name)
+
+    def batch(self):
+        return InMemoryWriteBatch(self)
+
+
+class UserStore:
+    '''
+    Non-blocking access to the users collection. The synchronous Firestore calls run on a dedicated thread pool,
+    and user documents are kept in a read-through cache for cache_ttl seconds. Writes through the store invalidate
+    the user's entry, concurrent misses for the same user share a single read.
+
+    Challenge completions are written behind: completions that are already recorded are dropped, the others are
+    merged per user and written as batches every flush_interval seconds, or as soon as max_pending_users users
+    have pending writes. Reads see pending writes, close() flushes whatever is left
+    '''
+    # Firestore rejects batches with more than 500 writes
+    max_batch_writes = 500
+
+    def __init__(self, db, collection="users", cache_ttl=60, max_entries=10000, max_workers=8, flush_interval=1.0, max_pending_users=100):
+        self.db = db
+        self.collection = collection
+        self.cache_ttl = cache_ttl
+        self.max_entries = max_entries
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="firestore")
+        self._cache = OrderedDict()  # uid -> (expires_at, user data or None)
+        self._versions = {}  # uid -> write count, a read started before a write must not fill the cache
+        self._inflight = {}  # uid -> future of the running read
+        self.flush_interval = flush_interval
+        self.max_pending_users = max_pending_users
+        self._pending = {}  # uid -> merged data waiting to be written
+        self._flushing = {}  # uid -> data of the batch being committed, still overlaid on reads
+        self._completed = OrderedDict()  # (uid, challenge_id) already written or pending, bounded like the cache
+        self._flusher = None
+        self._flush_lock = None
+        self.hits = 0
+        self.misses = 0
+        self.skipped_writes = 0
+        self.batched_writes = 0
+        self.batches = 0
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _read(self, uid):
+        snapshot = self.db.collection(self.collection).document(uid).get()
+        return snapshot.to_dict() if snapshot.exists else None
+
+    async def get_user(self, uid):
+        '''
+        Returns a copy of the user's document including writes not flushed yet, None if it doesn't exist
+        '''
+        entry = self._cache.get(uid)
+        if entry is not None and entry[0] > time.monotonic():
+            self._cache.move_to_end(uid)
+            self.hits += 1
+            data = copy.deepcopy(entry[1])
+        else:
+            self.misses += 1
+            future = self._inflight.get(uid)
+            if future is None:
+                future = asyncio.ensure_future(self._load(uid))
+                self._inflight[uid] = future
+                future.add_done_callback(lambda done: self._inflight.pop(uid) if self._inflight.get(uid) is done else None)
+            data = copy.deepcopy(await asyncio.shield(future))
+        return self._with_pending(uid, data)
+
+    def _with_pending(self, uid, data):
+        for overlay in (self._flushing, self._pending):
+            if uid in overlay:
+                if data is None:
+                    data = {}
+                deep_merge(data, overlay[uid])
+        return data
+
+    async def _load(self, uid):
+        version = self._versions.get(uid, 0)
+        data = await self._run(self._read, uid)
+        if self._versions.get(uid, 0) == version:
+            self._cache[uid] = (time.monotonic() + self.cache_ttl, data)
+            self._cache.move_to_end(uid)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return data
+
+    async def complete_challenge(self, uid, challenge_id):
+        '''
+        Records that the user completed challenge_id. Returns False if it was already recorded (nothing is written),
+        True if the write was queued
+        '''
+        cached = self._cache.get(uid)
+        known = cached is not None and cached[1] is not None and (
+            cached[1].get("challenge_information", {}).get(challenge_id, {}).get("completed") is True
+        )
+        if known or (uid, challenge_id) in self._completed:
+            self.skipped_writes += 1
+            return False
+
+        self._completed[(uid, challenge_id)] = True
+        while len(self._completed) > self.max_entries:
+            self._completed.popitem(last=False)
+        deep_merge(self._pending.setdefault(uid, {}), {"challenge_information": {challenge_id: {"completed": True}}})
+
+        self._ensure_flusher()
+        if len(self._pending) >= self.max_pending_users:
+            asyncio.ensure_future(self.flush())
+        return True
+
+    def _ensure_flusher(self):
+        if self._flusher is None or self._flusher.done():
+            self._flush_lock = asyncio.Lock()
+            self._flusher = asyncio.ensure_future(self._flush_periodically())
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Failed to flush user writes, retrying in {self.flush_interval}s: {e}")
+
+    def _commit(self, writes):
+        for start in range(0, len(writes), self.max_batch_writes):
+            batch = self.db.batch()
+            for uid, data in writes[start:start + self.max_batch_writes]:
+                batch.set(self.db.collection(self.collection).document(uid), data, merge=True)
+            batch.commit()
+
+    async def flush(self):
+        '''
+        Writes every pending update. On failure the updates go back to the pending ones and the error is raised
+        '''
+        if self._flush_lock is None:
+            return
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            self._flushing, self._pending = self._pending, {}
+            writes = list(self._flushing.items())
+            for uid, _ in writes:
+                self.invalidate(uid)
+            try:
+                await self._run(self._commit, writes)
+            except Exception:
+                # newer updates win over the failed ones
+                for uid, data in writes:
+                    deep_merge(data, self._pending.get(uid, {}))
+                    self._pending[uid] = data
+                raise
+            finally:
+                self._flushing = {}
+                for uid, _ in writes:
+                    self.invalidate(uid)
+            self.batched_writes += len(writes)
+            self.batches += -(-len(writes) // self.max_batch_writes)
+
+    async def close(self):
+        '''
+        Stops the periodic flush and writes what is still pending
+        '''
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        await self.flush()
+
+    def invalidate(self, uid):
+        self._versions[uid] = self._versions.get(uid, 0) + 1
+        self._cache.pop(uid, None)
+        # later callers must not join a read that started before the write
+        self._inflight.pop(uid, None)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "skipped_writes": self.skipped_writes,
+            "batched_writes": self.batched_writes,
+            "batches": self.batches,
+            "pending_writes": len(self._pending),
+            "entries": len(self._cache),
+            "cache_ttl": self.cache_ttl,
+        }
+
+
+def make_user_store(db):
+    '''
+    UserStore over db, or over an InMemoryFirestore when USER_STORE_BACKEND=memory.
+    USER_DATA_CACHE_TTL is the cache lifetime in seconds (default 60),
+    USER_WRITE_FLUSH_INTERVAL the delay of challenge completion writes in seconds (default 1)
+    '''
+    if os.environ.get("USER_STORE_BACKEND") == "memory":
+        logger.info("Using the in-memory Firestore stand-in")
+        db = InMemoryFirestore()
+    return UserStore(
+        db,
+        cache_ttl=float(os.environ.get("USER_DATA_CACHE_TTL", "60")),
+        flush_interval=float(os.environ.get("USER_WRITE_FLUSH_INTERVAL", "1"))
+    )
@@ -1,4 +1,4 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import Optional, Dict, Any, List, Literal
 
 class JobCancelRequest(BaseModel):
@@ -6,6 +6,7 @@ class JobCancelRequest(BaseModel):
     Represents the structure of a job cancellation request.
     """
     user_id: str
+    job_id: Optional[str] = None  # cancel only this job, not whatever the user's latest job is
 
 # Define the structure for individual blocks in the pipeline
 class Block(BaseModel):
@@ -30,6 +31,7 @@ class DiagramRequest(BaseModel):
     evalFns: List[str]
     lr: float
     epochs: int
+    batch_size: int = Field(default=2, ge=1)
     job_id: str
     user_id: str
 
@@ -40,4 +42,15 @@ class WarningData(BaseModel):
     message: str = "Design looks good!"
     update_type: Literal["warning", "error", "info"] = "info"
     layer: int = -1
-    job_id: str
\ No newline at end of file
+    job_id: str
+
+class Update(BaseModel):
+    '''
+    Update type sent to websocket that can be a training outcome or error
+    '''
+    message: str
+    update_type: Literal["result", "progress", "error"]
+    metrics: Optional[Dict[str, float]] = None
+    layer: Optional[int] = -1 # layer update pertains to, usually as a result of error/warnings
+    job_id: str
+    user_id: str
\ No newline at end of file
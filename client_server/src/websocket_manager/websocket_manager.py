@@ -3,6 +3,7 @@ from typing import  Dict
 from starlette.websockets import WebSocketDisconnect
 import logging
 import asyncio
+from collections import deque
 
 # Configure logging
 logging.basicConfig(
@@ -12,42 +13,143 @@ logging.basicConfig(
 
 websocketRouter = APIRouter()
 
+class Connection:
+    """
+    One client's websocket with its bounded outbound queue, drained by a dedicated writer task.
+
+    Progress messages are replaceable: a new one overwrites the progress message of the same job still waiting
+    in the queue (coalesce-latest) and, when the queue is full, the oldest waiting progress message is dropped.
+    Every other message (results, errors, warnings, status) is always queued, even past max_queue.
+    """
+    def __init__(self, client_id: str, websocket: WebSocket, max_queue: int, send_timeout: float):
+        self.client_id = client_id
+        self.websocket = websocket
+        self.max_queue = max_queue
+        self.send_timeout = send_timeout
+        self.queue = deque()
+        self.ready = asyncio.Event()
+        self.writer = None
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def is_progress(message: dict):
+        return message.get("update_type") == "progress"
+
+    def put(self, message: dict):
+        if self.is_progress(message):
+            job_id = message.get("job_id")
+            for i, queued in enumerate(self.queue):
+                if self.is_progress(queued) and queued.get("job_id") == job_id:
+                    self.queue[i] = message
+                    self.coalesced += 1
+                    return
+            if len(self.queue) >= self.max_queue:
+                oldest = next((i for i, queued in enumerate(self.queue) if self.is_progress(queued)), None)
+                self.dropped += 1
+                if oldest is None:
+                    # the queue is full of guaranteed messages, the new progress message is the one dropped
+                    return
+                del self.queue[oldest]
+        self.queue.append(message)
+        self.ready.set()
+
+    def stats(self):
+        return {"queue_depth": len(self.queue), "sent": self.sent, "dropped": self.dropped, "coalesced": self.coalesced}
+
+
 class WebSocketManager:
-    def __init__(self):
-        self._connections: Dict[str, WebSocket] = {}
+    def __init__(self, max_queue: int = 32, send_timeout: float = 10):
+        """
+        max_queue: outbound messages kept per connection before progress messages are dropped
+        send_timeout: seconds a single send may take before the connection is considered stalled and closed
+        """
+        self._connections: Dict[str, Connection] = {}
         self._lock = asyncio.Lock()
         self.logger = logging.getLogger(__name__)
+        self.max_queue = max_queue
+        self.send_timeout = send_timeout
 
     async def connect(self, client_id: str, websocket: WebSocket):
         await websocket.accept()
+        connection = Connection(client_id, websocket, self.max_queue, self.send_timeout)
         async with self._lock:
-            self._connections[client_id] = websocket
+            previous = self._connections.get(client_id)
+            self._connections[client_id] = connection
+        if previous is not None:
+            previous.writer.cancel()
+        connection.writer = asyncio.create_task(self._write(connection))
         self.logger.info(f"Client {client_id} connected")
+        return connection
 
-    async def disconnect(self, client_id: str):
+    async def disconnect(self, client_id: str, connection: Connection = None):
+        """
+        Removes the client's connection. If connection is given, only if it is still the client's current one
+        """
         async with self._lock:
-            if client_id in self._connections:
-                del self._connections[client_id]
+            current = self._connections.get(client_id)
+            if current is None or (connection is not None and current is not connection):
+                return
+            del self._connections[client_id]
+        if current.writer is not None and current.writer is not asyncio.current_task():
+            current.writer.cancel()
         self.logger.info(f"Client {client_id} disconnected")
 
     async def send_json(self, client_id: str, message: dict):
-        if client_id in self._connections:
-            try:
-                await self._connections[client_id].send_json(message)
-                return True
-            except Exception as e:
-                self.logger.error(f"Error sending to client {client_id}: {str(e)}")
-                await self.disconnect(client_id)
-        return False
+        """
+        Queues message for the client and returns right away. Returns False if the client is not connected
+        """
+        connection = self._connections.get(client_id)
+        if connection is None:
+            return False
+        connection.put(message)
+        return True
+
+    async def _write(self, connection: Connection):
+        while True:
+            await connection.ready.wait()
+            while connection.queue:
+                message = connection.queue.popleft()
+                try:
+                    await asyncio.wait_for(connection.websocket.send_json(message), connection.send_timeout)
+                    connection.sent += 1
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.logger.error(f"Error sending to client {connection.client_id}: {str(e) or type(e).__name__}")
+                    await self.disconnect(connection.client_id, connection)
+                    try:
+                        # a stalled client would otherwise keep its socket, closing it also ends its receive loop
+                        await asyncio.wait_for(connection.websocket.close(), 1)
+                    except Exception:
+                        pass
+                    return
+            connection.ready.clear()
 
     def get_active_connections(self) -> Dict[str, WebSocket]:
-        return dict(self._connections)
+        return {client_id: connection.websocket for client_id, connection in self._connections.items()}
+
+    def stats(self):
+        connections = {client_id: connection.stats() for client_id, connection in self._connections.items()}
+        return {
+            "connections": len(connections),
+            "queue_depth": sum(c["queue_depth"] for c in connections.values()),
+            "dropped": sum(c["dropped"] for c in connections.values()),
+            "coalesced": sum(c["coalesced"] for c in connections.values()),
+            "per_connection": connections,
+        }
 
 manager = WebSocketManager()
 
+@websocketRouter.get("/updates-ws-stats")
+async def websocket_stats():
+    """Per connection outbound queue depth, sent, dropped and coalesced message counts"""
+    return manager.stats()
+
 @websocketRouter.websocket("/updates-ws/{client_id}")
 async def websocket_endpoint(websocket: WebSocket, client_id: str):
-    await manager.connect(client_id, websocket)
+    connection = await manager.connect(client_id, websocket)
     
     try:
         await manager.send_json(client_id, {
@@ -64,4 +166,5 @@ async def websocket_endpoint(websocket: WebSocket, client_id: str):
     except Exception as e:
         manager.logger.error(f"Error with client {client_id}: {str(e)}")
     finally:
-        await manager.disconnect(client_id)
\ No newline at end of file
+        # a reconnect of the same client may already have replaced this connection
+        await manager.disconnect(client_id, connection)
\ No newline at end of file
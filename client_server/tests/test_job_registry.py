@@ -0,0 +1,58 @@
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from src.job_registry import InMemoryJobRegistry, SQLiteJobRegistry
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def registry(request, tmp_path):
+    if request.param == "memory":
+        return InMemoryJobRegistry()
+    return SQLiteJobRegistry(tmp_path / "registry.db")
+
+
+def run_concurrently(fn, count):
+    with ThreadPoolExecutor(max_workers=count) as pool:
+        return list(pool.map(fn, range(count)))
+
+
+def test_concurrent_swaps_from_the_same_job_have_one_winner(registry):
+    registry.set("user", "job-0")
+    results = run_concurrently(lambda i: registry.compare_and_swap("user", "job-0", f"job-{i + 1}"), 16)
+    assert results.count(True) == 1
+    assert registry.get("user") == f"job-{results.index(True) + 1}"
+
+
+def test_concurrent_first_jobs_have_one_winner(registry):
+    # None matches a missing entry
+    results = run_concurrently(lambda i: registry.compare_and_swap("user", None, f"job-{i}"), 16)
+    assert results.count(True) == 1
+    assert registry.get("user") == f"job-{results.index(True)}"
+
+
+def test_chained_swaps_lose_no_update(registry):
+    # every thread retries until its job is the latest once, as a burst of submissions of one user would
+    def submit(i):
+        while True:
+            current = registry.get("user")
+            if registry.compare_and_swap("user", current, f"job-{i}"):
+                return current
+
+    previous = run_concurrently(submit, 16)
+    # each job replaced exactly one other, so the jobs form a single chain starting at None
+    assert sorted(previous, key=str) == sorted([None] + [f"job-{i}" for i in range(16) if f"job-{i}" != registry.get("user")], key=str)
+
+
+def test_expired_entries_are_missing(registry):
+    registry.set("user", "job-0", ttl=-1)
+    assert registry.get("user") is None
+    assert registry.compare_and_swap("user", None, "job-1")
+    assert registry.get("user") == "job-1"
+
+
+def test_sqlite_registries_share_the_file(tmp_path):
+    first = SQLiteJobRegistry(tmp_path / "registry.db")
+    second = SQLiteJobRegistry(tmp_path / "registry.db")
+    first.set("user", "job-0")
+    assert not second.compare_and_swap("user", None, "job-1")
+    assert second.compare_and_swap("user", "job-0", "job-1")
+    assert first.get("user") == "job-1"
@@ -0,0 +1,95 @@
+import asyncio
+import pytest
+from src.task_queue import TaskQueue, InProcessBackend
+
+
+class RecordingBackend:
+    '''
+    Records the batches it is given. Payloads with "fail" get an exception as their result
+    '''
+    def __init__(self, error=None):
+        self.batches = []
+        self.error = error
+
+    def task_name(self, job_id):
+        return f"tasks/{job_id}"
+
+    def enqueue_batch(self, payloads):
+        self.batches.append([payload["job_id"] for payload in payloads])
+        if self.error is not None:
+            raise self.error
+        return [ValueError(f"bad payload {payload['job_id']}") if payload.get("fail") else self.task_name(payload["job_id"])
+                for payload in payloads]
+
+
+def enqueue_all(queue, payloads):
+    async def run():
+        return await asyncio.gather(*(queue.enqueue(payload) for payload in payloads), return_exceptions=True)
+    return asyncio.run(run())
+
+
+def test_submissions_are_batched_up_to_max_batch_size():
+    backend = RecordingBackend()
+    queue = TaskQueue(backend, max_batch_size=4, max_delay=0.05)
+    results = enqueue_all(queue, [{"job_id": i} for i in range(10)])
+
+    assert results == [f"tasks/{i}" for i in range(10)]
+    assert backend.batches == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+    stats = queue.stats()
+    assert stats["enqueued"] == 10 and stats["batches"] == 3 and stats["failed"] == 0
+
+
+def test_a_failed_task_raises_only_for_its_own_submission():
+    queue = TaskQueue(RecordingBackend(), max_delay=0.05)
+    results = enqueue_all(queue, [{"job_id": 0}, {"job_id": 1, "fail": True}, {"job_id": 2}])
+
+    assert results[0] == "tasks/0" and results[2] == "tasks/2"
+    assert isinstance(results[1], ValueError) and str(results[1]) == "bad payload 1"
+    assert queue.stats()["failed"] == 1
+
+
+def test_a_failed_batch_raises_for_every_submission():
+    queue = TaskQueue(RecordingBackend(error=ConnectionError("queue unavailable")), max_delay=0.05)
+    results = enqueue_all(queue, [{"job_id": i} for i in range(3)])
+
+    assert all(isinstance(result, ConnectionError) for result in results)
+    assert queue.stats()["failed"] == 3
+
+
+def test_enqueue_raises_the_backend_exception():
+    queue = TaskQueue(RecordingBackend(), max_delay=0.01)
+    with pytest.raises(ValueError, match="bad payload 7"):
+        asyncio.run(queue.enqueue({"job_id": 7, "fail": True}))
+
+
+def test_purge_deletes_a_task_that_is_still_waiting():
+    # tasks wait an hour before they are dispatched, like a slow Cloud Tasks queue
+    backend = InProcessBackend(dispatch_delay=3600)
+    queue = TaskQueue(backend, max_delay=0.01)
+
+    async def run():
+        name = await queue.enqueue({"job_id": "job-1"})
+        await queue.enqueue({"job_id": "job-2"})
+        return name, await queue.purge("job-1"), await queue.purge("job-1")
+
+    name, purged, purged_again = asyncio.run(run())
+    assert name == backend.task_name("job-1")
+    assert purged and not purged_again
+    assert backend.stats()["deleted"] == 1 and backend.stats()["waiting"] == 1
+    assert queue.stats()["purged"] == 1 and queue.stats()["purge_misses"] == 1
+
+
+def test_purge_misses_a_dispatched_task():
+    backend = InProcessBackend(dispatch_delay=0)
+    queue = TaskQueue(backend, max_delay=0.01)
+
+    async def run():
+        await queue.enqueue({"job_id": "job-1"})
+        for _ in range(100):
+            if backend.stats()["dispatched"]:
+                break
+            await asyncio.sleep(0.01)
+        return await queue.purge("job-1")
+
+    assert not asyncio.run(run())
+    assert backend.stats()["deleted"] == 0
@@ -0,0 +1,75 @@
+import asyncio
+from src.websocket_manager import Connection, WebSocketManager
+
+
+def progress(job_id, epoch):
+    return {"update_type": "progress", "job_id": job_id, "epoch": epoch}
+
+
+def result(job_id):
+    return {"update_type": "result", "job_id": job_id}
+
+
+def make_connection(max_queue=3):
+    # put() never touches the websocket
+    return Connection("client", None, max_queue=max_queue, send_timeout=1)
+
+
+def test_progress_replaces_the_waiting_progress_of_the_same_job():
+    connection = make_connection()
+    connection.put(progress("a", 1))
+    connection.put(progress("b", 1))
+    connection.put(progress("a", 2))
+
+    assert list(connection.queue) == [progress("a", 2), progress("b", 1)]
+    assert connection.coalesced == 1 and connection.dropped == 0
+
+
+def test_a_full_queue_drops_the_oldest_progress():
+    connection = make_connection()
+    connection.put(progress("a", 1))
+    connection.put(result("a"))
+    connection.put(progress("b", 1))
+    connection.put(progress("c", 1))
+
+    assert list(connection.queue) == [result("a"), progress("b", 1), progress("c", 1)]
+    assert connection.dropped == 1
+
+
+def test_guaranteed_messages_are_kept_past_max_queue():
+    connection = make_connection()
+    for job_id in "abcd":
+        connection.put(result(job_id))
+    # nothing replaceable to drop, the new progress message is the one dropped
+    connection.put(progress("e", 1))
+
+    assert list(connection.queue) == [result(job_id) for job_id in "abcd"]
+    assert connection.dropped == 1
+
+
+class RecordingWebSocket:
+    def __init__(self):
+        self.sent = []
+
+    async def accept(self):
+        pass
+
+    async def send_json(self, message):
+        self.sent.append(message)
+
+
+def test_writer_sends_the_queued_messages_in_order():
+    async def run():
+        manager = WebSocketManager(max_queue=3)
+        websocket = RecordingWebSocket()
+        connection = await manager.connect("client", websocket)
+        # queued before the writer task runs, so they coalesce in the queue
+        await manager.send_json("client", progress("a", 1))
+        await manager.send_json("client", progress("a", 2))
+        await manager.send_json("client", result("a"))
+        for _ in range(10):
+            await asyncio.sleep(0)
+        await manager.disconnect("client", connection)
+        return websocket.sent
+
+    assert asyncio.run(run()) == [progress("a", 2), result("a")]
@@ -0,0 +1,50 @@
+from pathlib import Path
+import argparse
+import time
+import torch
+import torch.nn as nn
+from src import utils
+
+# TO RUN, run python3 -m admin.scripts.benchmarkLoaders from the training_server directory
+# Compares optimizer steps/sec of torch DataLoader against TensorBatchLoader at the same batch size
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--dataset", default="mushrooms")
+parser.add_argument("--datasets-path", default=str(Path(__file__).parent.parent / "datasets"))
+parser.add_argument("--batch-sizes", type=int, nargs="+", default=[2, 32, 256])
+parser.add_argument("--epochs", type=int, default=2)
+args = parser.parse_args()
+
+
+def steps_per_second(train_loader, input_shape, output_shape, epochs):
+    model = nn.Sequential(nn.Linear(input_shape, 64), nn.ReLU(), nn.Linear(64, output_shape), nn.Sigmoid())
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.01)
+    loss_fn = nn.BCELoss()
+    steps = 0
+    start = time.perf_counter()
+    for _ in range(epochs):
+        for data, labels in train_loader:
+            optimizer.zero_grad()
+            outputs = model(data)
+            loss = loss_fn(outputs, labels.view_as(outputs))
+            loss.backward()
+            optimizer.step()
+            steps += 1
+    return steps / (time.perf_counter() - start)
+
+
+for batch_size in args.batch_sizes:
+    results = {}
+    for fast_loader in [False, True]:
+        dataloader_creator = utils.DataLoaderCreator(
+            args.dataset,
+            Path(args.datasets_path),
+            'bce',
+            batch_size=batch_size,
+            fast_loader=fast_loader
+        )
+        train_loader, test_loader, input_shape, output_shape, task_type = dataloader_creator.getLoaders()
+        results[fast_loader] = steps_per_second(train_loader, input_shape, output_shape, args.epochs)
+
+    print(f"batch_size={batch_size}: DataLoader {results[False]:.0f} steps/s, "
+          f"TensorBatchLoader {results[True]:.0f} steps/s ({results[True] / results[False]:.2f}x)")
@@ -0,0 +1,68 @@
+from pathlib import Path
+import argparse
+import time
+import torch
+import torch.nn as nn
+from sklearn.metrics import f1_score, precision_score, recall_score, accuracy_score, precision_recall_fscore_support
+from src import utils
+
+# TO RUN, run python3 -m admin.scripts.benchmarkMetrics from the training_server directory
+# Compares the previous list + sklearn evaluation (batch size 2) against the streaming ConfusionMatrix
+# evaluation (inference mode, large batches) on the weather and mushrooms test sets
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--datasets-path", default=str(Path(__file__).parent.parent / "datasets"))
+parser.add_argument("--repeats", type=int, default=5)
+args = parser.parse_args()
+
+
+def sklearn_metrics(model, test_loader, lossFn, task):
+    '''The evaluation path EvalFns used before the streaming confusion matrix'''
+    model.eval()
+    all_preds, all_labels = [], []
+    with torch.no_grad():
+        for inputs, labels in test_loader:
+            outputs = model(inputs)
+            preds, labels = utils.EvalFns.get_predictions(outputs, labels, lossFn, task)
+            all_preds.extend(preds.reshape(-1).cpu().numpy())
+            all_labels.extend(labels.reshape(-1).cpu().numpy())
+    if task == 'binary_classification':
+        return {
+            'f1_score_metric': float('%.3f' % f1_score(all_labels, all_preds, zero_division=0.0)),
+            'precision_metric': float('%.3f' % precision_score(all_labels, all_preds, zero_division=0.0)),
+            'recall_metric': float('%.3f' % recall_score(all_labels, all_preds, zero_division=0.0)),
+            'accuracy_metric': float('%.3f' % accuracy_score(all_labels, all_preds)),
+        }
+    precision, recall, f1, _ = precision_recall_fscore_support(all_labels, all_preds, average='macro', zero_division=0.0)
+    return {
+        'accuracy_metric': float('%.3f' % (accuracy_score(all_labels, all_preds) * 100)),
+        'f1_score_metric': float('%.3f' % f1),
+        'precision_metric': float('%.3f' % precision),
+        'recall_metric': float('%.3f' % recall),
+    }
+
+
+def timed(fn, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        result = fn()
+    return (time.perf_counter() - start) / repeats, result
+
+
+for dataset, lossFn in [('weather', 'cross_entropy_loss'), ('mushrooms', 'bce')]:
+    old_creator = utils.DataLoaderCreator(dataset, Path(args.datasets_path), lossFn, eval_batch_size=2, fast_loader=False)
+    _, old_test_loader, input_shape, output_shape, task = old_creator.getLoaders()
+    new_creator = utils.DataLoaderCreator(dataset, Path(args.datasets_path), lossFn)
+    _, new_test_loader, _, _, _ = new_creator.getLoaders()
+
+    layers = [nn.Linear(input_shape, 64), nn.ReLU(), nn.Linear(64, output_shape)]
+    if lossFn == 'bce':
+        layers.append(nn.Sigmoid())
+    model = nn.Sequential(*layers)
+
+    old_time, old_metrics = timed(lambda: sklearn_metrics(model, old_test_loader, lossFn, task), args.repeats)
+    new_time, new_metrics = timed(lambda: utils.EvalFns.get_all_metrics(model, new_test_loader, lossFn, task), args.repeats)
+    matches = all(old_metrics[metric] == new_metrics[metric] for metric in old_metrics)
+
+    print(f"{dataset}: sklearn {old_time * 1000:.1f} ms, streaming {new_time * 1000:.1f} ms "
+          f"({old_time / new_time:.1f}x), metrics match: {matches}")
@@ -0,0 +1,66 @@
+from pathlib import Path
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+import torch
+from src import utils
+
+# TO RUN, run python3 -m admin.scripts.benchmarkSparse --datasets-path <folder containing emails/emails.csv> from the training_server directory
+# Reports featurization time, epoch time and peak RSS of the emails dataset with dense and sparse features.
+# Each mode runs in its own subprocess so the peak RSS of one does not hide the other.
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--datasets-path", default="/tmp/datasets")
+parser.add_argument("--batch-size", type=int, default=32)
+parser.add_argument("--epochs", type=int, default=1)
+parser.add_argument("--mode", choices=["dense", "sparse"], default=None, help="run a single mode (used internally)")
+args = parser.parse_args()
+
+
+def run(sparse):
+    start = time.perf_counter()
+    dataloader_creator = utils.DataLoaderCreator(
+        'emails',
+        Path(args.datasets_path),
+        'bce',
+        batch_size=args.batch_size,
+        sparse_features=sparse,
+        cache=None
+    )
+    train_loader, test_loader, input_shape, output_shape, task_type = dataloader_creator.getLoaders()
+    featurize = time.perf_counter() - start
+
+    model = torch.nn.Sequential(utils.SparseLinear(input_shape, 16), torch.nn.ReLU(), torch.nn.Linear(16, 1), torch.nn.Sigmoid())
+    optimizer = torch.optim.Adam(model.parameters(), lr=0.001)
+    loss_fn = torch.nn.BCELoss()
+    start = time.perf_counter()
+    for _ in range(args.epochs):
+        for data, labels in train_loader:
+            optimizer.zero_grad()
+            outputs = model(data)
+            loss = loss_fn(outputs, labels.view_as(outputs))
+            loss.backward()
+            optimizer.step()
+    epoch = (time.perf_counter() - start) / args.epochs
+
+    metrics = utils.EvalFns.get_all_metrics(model, test_loader, 'bce', task_type)
+    # ru_maxrss is in kilobytes on linux
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return {"featurize_s": featurize, "epoch_s": epoch, "peak_rss_mb": peak_rss_mb, "accuracy": metrics["accuracy_metric"]}
+
+
+if args.mode:
+    print(json.dumps(run(args.mode == "sparse")))
+else:
+    for mode in ["dense", "sparse"]:
+        output = subprocess.run(
+            [sys.executable, "-m", "admin.scripts.benchmarkSparse", "--mode", mode,
+             "--datasets-path", args.datasets_path, "--batch-size", str(args.batch_size), "--epochs", str(args.epochs)],
+            capture_output=True, text=True, check=True
+        ).stdout.strip().splitlines()[-1]
+        result = json.loads(output)
+        print(f"{mode}: featurize {result['featurize_s']:.2f}s, epoch {result['epoch_s']:.2f}s, "
+              f"peak RSS {result['peak_rss_mb']:.0f} MB, accuracy {result['accuracy']}")
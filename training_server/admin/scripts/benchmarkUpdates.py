@@ -0,0 +1,49 @@
+import argparse
+import os
+import time
+from src.utils.reporter import ProgressReporter
+
+# TO RUN, run python3 -m admin.scripts.benchmarkUpdates --callback-url http://localhost:8080/updates --server-pid <client server pid>
+# from the training_server directory, with a client server running locally.
+# Sends the same progress updates once as separate POSTs to /updates and once over the /updates-stream websocket,
+# and reports the round trip latency per update and the client server CPU time per update (read from /proc, so linux only)
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--callback-url", default="http://localhost:8080/updates")
+parser.add_argument("--server-pid", type=int, default=None, help="pid of the client server, to measure its CPU time")
+parser.add_argument("--updates", type=int, default=500)
+args = parser.parse_args()
+
+
+def cpu_seconds(pid):
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    # utime and stime, in clock ticks
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def run(transport):
+    reporter = ProgressReporter(args.callback_url, transport=transport)
+    # the updates are sent from this thread to time each round trip, the reporter's own thread stays idle
+    send = reporter._send_stream if transport == "stream" else reporter._send
+    update = {"message": "Epoch 1", "update_type": "progress", "metrics": {"loss": 0.5}, "job_id": "benchmark", "user_id": "benchmark"}
+    send(update)
+
+    latencies = []
+    cpu_start = cpu_seconds(args.server_pid) if args.server_pid else None
+    for i in range(args.updates):
+        update["message"] = f"Epoch {i}"
+        start = time.perf_counter()
+        send(update)
+        latencies.append(time.perf_counter() - start)
+    cpu = (cpu_seconds(args.server_pid) - cpu_start) / args.updates if args.server_pid else None
+    reporter.close()
+
+    latencies.sort()
+    cpu_text = f", client server CPU {cpu * 1000:.3f} ms/update" if cpu is not None else ""
+    print(f"{transport}: p50 {latencies[len(latencies) // 2] * 1000:.2f} ms, p95 {latencies[int(len(latencies) * 0.95)] * 1000:.2f} ms, "
+          f"mean {sum(latencies) / len(latencies) * 1000:.2f} ms{cpu_text}, transport used: {reporter.transport}")
+
+
+for transport in ["http", "stream"]:
+    run(transport)
@@ -1,183 +1,220 @@
 from pathlib import Path
+import argparse
 import itertools
-from src import utils, BaseModel, Block
-from typing import List, Dict, Any, Optional
-import os
 import json
-
-class Diagram(BaseModel):
-    blocks: List[Block]
-    execution: str
-    dataset: str
-    optimizer: str
-    loss_fn: str
-    evalFns: List[str]
-    lr: float
-    epochs: int
-
-# TO RUN, run python3 -m admin.scripts.testModels from the training_server directory
-
-learning_rates = [0.001]
-epochs = [20]
-batch_sizes = [2]
-
-optimizers = ["sgd_algorithm", "momentum_algorithm"]
-loss_functions = ['cross_entropy_loss']
-activation_functions = ['relu_activation', 'sigmoid_activation', 'tanh_activation', 'softmax_activation']
-layers = [0, 1, 2, 3]
-
-combinations = list(itertools.product(learning_rates, epochs, batch_sizes, optimizers, loss_functions, activation_functions, layers))
-
-final_results = []
-
-# j = 0
-
-for combo in combinations:
-    # j += 1
-    # if j >= 3:
-    #     break
-    learning_rate, epoch, batch_size, optimizer, loss_fn, activation_fn, layer = combo
-
-    # DIAGRAM
-    # blocks: List[Block]
-    # execution: str
-    # dataset: str
-    # optimizer: str
-    # loss_fn: str
-    # evalFns: List[str]
-    # lr: float
-    # epochs: int
-
+import os
+import torch
+import torch.multiprocessing as mp
+from src import utils
+from src.utils.ensemble import EnsembleDiagram
+
+# TO RUN, run python3 -m admin.scripts.testModels from the training_server directory, e.g.
+#   python3 -m admin.scripts.testModels --dataset weather --loss-fns cross_entropy_loss --workers 4
+# Every combination of the grid flags is trained once. Each dataset is featurized a single time in this process and
+# shared with the workers, results are appended to --output as they finish, and rerunning the same command
+# skips the combinations already trained successfully there, so an interrupted sweep resumes where it stopped.
+# Combinations that failed are run again, unless --skip-errors is given (e.g. for diagrams that can never train).
+# With --ensemble, combinations that only differ in lr and seed are trained together as one vmapped EnsembleDiagram.
+# The members of a group share the shuffle order of the group's first member, the other members see a different batch
+# order than they would without --ensemble, and dropout masks are drawn per member either way, so their results can
+# differ slightly from a run without --ensemble.
+
+EVAL_FNS = ['accuracy_metric', 'precision_metric', 'recall_metric', 'f1_score_metric']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Hyperparameter sweep over block layouts")
+    parser.add_argument("--dataset", default="weather")
+    parser.add_argument("--datasets-path", default=str(Path(__file__).parent.parent / "datasets"))
+    parser.add_argument("--output", default=str(Path(__file__).parent / "output.jsonl"))
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 1) // 2))
+    parser.add_argument("--lr", type=float, nargs="+", default=[0.001])
+    parser.add_argument("--epochs", type=int, nargs="+", default=[20])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[2])
+    parser.add_argument("--optimizers", nargs="+", default=["sgd_algorithm", "momentum_algorithm"])
+    parser.add_argument("--loss-fns", nargs="+", default=["cross_entropy_loss"])
+    parser.add_argument("--activations", nargs="+", default=['relu_activation', 'sigmoid_activation', 'tanh_activation', 'softmax_activation'])
+    parser.add_argument("--layers", type=int, nargs="+", default=[0, 1, 2, 3])
+    parser.add_argument("--hidden", type=int, default=64, help="out_features of the hidden linear layers")
+    parser.add_argument("--seeds", type=int, nargs="+", default=[0])
+    parser.add_argument("--ensemble", action="store_true", help="train combinations differing only in lr/seed in lockstep")
+    parser.add_argument("--skip-errors", action="store_true", help="don't rerun combinations recorded with an error")
+    return parser.parse_args()
+
+
+def build_blocks(activation_fn, layer, loss_fn, hidden):
     blocks = []
     counter = 1
     for i in range(layer):
-        blocks.append({
-            "block_id": "linear_layer",
-            "order": counter,
-            "params": {
-                "out_features": 64
-            }
-        })
-        counter += 1
-        blocks.append({
-            "block_id": activation_fn,
-            "order": counter,
-            "params": {}
-        })
+        blocks.append({"block_id": "linear_layer", "order": counter, "params": {"out_features": hidden}})
         counter += 1
-    
-    if (loss_fn == 'cross_entropy_loss'):
-        blocks.append({
-            "block_id": "linear_layer",
-            "order": counter,
-            "params": {
-                "out_features": 1
-            }
-        })
-        counter += 1
-        # blocks.append({
-        #     "block_id": "sigmoid_activation",
-        #     "order": counter,
-        #     "params": {}
-        # })
-        # counter += 1
-    else:
-        blocks.append({
-            "block_id": "linear_layer",
-            "order": counter,
-            "params": {
-                "out_features": 1
-            }
-        })
-        counter += 1
-        blocks.append({
-            "block_id": activation_fn,
-            "order": counter,
-            "params": {}
-        })
+        blocks.append({"block_id": activation_fn, "order": counter, "params": {}})
         counter += 1
 
-    diagram = Diagram(
+    blocks.append({"block_id": "linear_layer", "order": counter, "params": {"out_features": 1}})
+    counter += 1
+    # cross entropy expects raw logits, the other losses get the activation on the output
+    if loss_fn != 'cross_entropy_loss':
+        blocks.append({"block_id": activation_fn, "order": counter, "params": {}})
+    return blocks
+
+
+def combination_key(combo):
+    return json.dumps(combo, sort_keys=True)
+
+
+def featurize(dataset, datasets_path, loss_fn):
+    '''
+    Featurizes the dataset once and moves the tensors to shared memory so the workers don't copy them
+    '''
+    dataloader_creator = utils.DataLoaderCreator(dataset, datasets_path, loss_fn, cache=None)
+    featurized = dataloader_creator.getFeaturized()
+    for name in ["X_train", "y_train", "X_test", "y_test"]:
+        value = getattr(featurized, name)
+        if isinstance(value, torch.Tensor):
+            value.share_memory_()
+    return dataloader_creator.cacheKey(), featurized
+
+
+def init_worker(featurized_datasets, threads):
+    # seed the worker's dataset cache, so DataLoaderCreator.getLoaders never featurizes in a worker
+    for key, featurized in featurized_datasets:
+        utils.dataset_cache.put(key, featurized)
+    torch.set_num_threads(threads)
+
+
+def build_diagram(combo):
+    blocks = build_blocks(combo["activation_fn"], combo["layers"], combo["loss_fn"], combo["hidden"])
+    return utils.DiagramRequest(
         blocks=blocks,
         execution="train",
-        dataset= "weather",
-        optimizer= optimizer,
-        loss_fn= loss_fn,
-        evalFns = ['accuracy_metric', 'precision_metric', 'recall_metric', 'f1_score_metric'],
-        lr= learning_rate,
-        epochs= epoch,
+        dataset=combo["dataset"],
+        optimizer=combo["optimizer"],
+        loss_fn=combo["loss_fn"],
+        evalFns=EVAL_FNS,
+        lr=combo["lr"],
+        epochs=combo["epochs"],
+        batch_size=combo["batch_size"],
     )
-    
 
+
+def get_loaders(combo, datasets_path):
     dataloader_creator = utils.DataLoaderCreator(
-        'weather',
-        Path("/Users/lukemoberly/Desktop/win25-Team8/training_server/admin/datasets"),
-        loss_fn
-    )   
-    train_loader, test_loader, input_shape, output_shape, type = dataloader_creator.getLoaders()
+        combo["dataset"],
+        Path(datasets_path),
+        combo["loss_fn"],
+        batch_size=combo["batch_size"]
+    )
+    return dataloader_creator.getLoaders()
+
+
+def run_group(args):
+    '''
+    Trains a list of combinations. A single combination runs as a normal Diagram, a larger group
+    (same layout, different lr/seed) runs as one EnsembleDiagram. Returns one record per combination
+    '''
+    combos, datasets_path = args
+    if len(combos) == 1:
+        return [run_combination(combos[0], datasets_path)]
+
+    diagram = build_diagram(combos[0])
+    train_loader, test_loader, input_shape, output_shape, task_type = get_loaders(combos[0], datasets_path)
+    records = [{"key": combination_key(combo), "diagram": build_diagram(combo).model_dump()} for combo in combos]
+    try:
+        members = [{"lr": combo["lr"], "seed": combo["seed"]} for combo in combos]
+        ensemble = EnsembleDiagram(train_loader, test_loader, input_shape, output_shape, task_type, diagram, members)
+        for record, result in zip(records, ensemble.execute()):
+            record["result"] = result
+    except Exception as e:
+        for record in records:
+            record["error"] = str(e)
+    return records
+
+
+def run_combination(combo, datasets_path):
+    torch.manual_seed(combo["seed"])
+    diagram = build_diagram(combo)
+    train_loader, test_loader, input_shape, output_shape, task_type = get_loaders(combo, datasets_path)
     executable_model = utils.Diagram(
         train_loader,
         test_loader,
         input_shape,
         output_shape,
         "",
-        "",
-        ""
+        task_type
     )
 
-
-    executable_model.digest_diagram_object(diagram)
-    executable_model.create_model_from_inputs()
-
-    result = executable_model.execute()
-    final_results.append({
-        "diagram": {
-            "blocks": blocks,
-            "execution": "train",
-            "dataset": "weather",
-            "optimizer": optimizer,
-            "loss_fn": loss_fn,
-            "evalFns": ['accuracy_metric', 'precision_metric', 'recall_metric', 'f1_score_metric'],
-            "lr": learning_rate,
-            "epochs": epoch
-        },
-        "result": result
-    })
-    print(result)
-
-# save final results to output.json
-with open('./admin/scripts/output.json', 'w') as f:
-    f.write(json.dumps(final_results))
-
-
-
-# dataloader_creator = utils.DataLoaderCreator(
-#         'mushrooms',
-#         Path("/admin/datasets"),
-#         diagram.loss_fn
-#     )
-
-#     logger.info(f"Retrieving dataset: {dataset}")
-
-#     # Get train and test loaders
-#     train_loader, test_loader, input_shape, output_shape = dataloader_creator.getLoaders()
-    
-#     # Create the model and execute it
-#     executable_model = utils.Diagram(
-#         train_loader,
-#         test_loader,
-#         input_shape,
-#         output_shape,
-#         job_id,
-#         callback_url,
-#         user_id
-#     )
-    
-#     executable_model.digest_diagram_object(diagram)
-#     executable_model.create_model_from_inputs()
-
-#     logger.info('Executing model')
-
-#     executable_model.execute()
-
-#     logger.info(f"Model execution complete for diagram: {diagram}")
\ No newline at end of file
+    record = {"key": combination_key(combo), "diagram": diagram.model_dump()}
+    try:
+        executable_model.digest_diagram_object(diagram)
+        executable_model.create_model_from_inputs()
+        record["result"] = executable_model.execute()
+    except Exception as e:
+        record["error"] = str(e)
+    return record
+
+
+def load_completed(output_path, skip_errors=False):
+    '''
+    Keys of the combinations recorded in output_path with a result, and with an error too if skip_errors
+    '''
+    completed = set()
+    if not output_path.exists():
+        return completed
+    with open(output_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+                if "result" in record or skip_errors:
+                    completed.add(record["key"])
+            except (json.JSONDecodeError, KeyError):
+                # a partially written last line from an interrupted run, that combination is simply rerun
+                continue
+    return completed
+
+
+def main():
+    args = parse_args()
+    output_path = Path(args.output)
+
+    combinations = [
+        {
+            "dataset": args.dataset, "lr": lr, "epochs": epochs, "batch_size": batch_size, "optimizer": optimizer,
+            "loss_fn": loss_fn, "activation_fn": activation_fn, "layers": layers, "hidden": args.hidden, "seed": seed
+        }
+        for lr, epochs, batch_size, optimizer, loss_fn, activation_fn, layers, seed in itertools.product(
+            args.lr, args.epochs, args.batch_sizes, args.optimizers, args.loss_fns, args.activations, args.layers, args.seeds
+        )
+    ]
+    completed = load_completed(output_path, args.skip_errors)
+    pending = [combo for combo in combinations if combination_key(combo) not in completed]
+    print(f"{len(combinations)} combinations, {len(combinations) - len(pending)} already recorded in {output_path}")
+    if not pending:
+        return
+
+    featurized_datasets = [featurize(args.dataset, Path(args.datasets_path), loss_fn) for loss_fn in args.loss_fns]
+    threads = max(1, torch.get_num_threads() // args.workers)
+
+    if args.ensemble:
+        groups = {}
+        for combo in pending:
+            layout = combination_key({name: value for name, value in combo.items() if name not in ("lr", "seed")})
+            groups.setdefault(layout, []).append(combo)
+        work = [(group, args.datasets_path) for group in groups.values()]
+    else:
+        work = [([combo], args.datasets_path) for combo in pending]
+
+    ctx = mp.get_context("spawn")
+    done = 0
+    with ctx.Pool(args.workers, initializer=init_worker, initargs=(featurized_datasets, threads)) as pool, open(output_path, "a") as f:
+        for records in pool.imap_unordered(run_group, work):
+            # one line per finished combination, flushed right away so a crash loses at most the running ones
+            for record in records:
+                done += 1
+                f.write(json.dumps(record) + "\n")
+                print(f"[{done}/{len(pending)}] {record.get('result', record.get('error'))}")
+            f.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+import requests
+
+# TO RUN, run python3 -m admin.scripts.testRecovery from the training_server directory, with the weather dataset in
+# /tmp/datasets (or DATASETS_BUCKET_DIR set to a local copy of the bucket).
+# Starts a training server, submits a job and kills the server and its workers with SIGKILL once the job wrote a
+# checkpoint, as if its instance was recycled. A second server sharing the job ledger and checkpoint folder then
+# has to take the job over once its claim expires and finish it, resuming from the checkpoint instead of epoch 0.
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--epochs", type=int, default=40)
+parser.add_argument("--lease", type=float, default=4, help="JOB_LEDGER_LEASE of both servers, in seconds")
+parser.add_argument("--ports", type=int, nargs=2, default=[8310, 8311])
+parser.add_argument("--timeout", type=float, default=300)
+args = parser.parse_args()
+
+state_dir = Path(tempfile.mkdtemp(prefix="recovery-"))
+env = dict(
+    os.environ,
+    JOB_LEDGER_PATH=str(state_dir / "ledger.db"),
+    JOB_LEDGER_LEASE=str(args.lease),
+    CHECKPOINT_DIR=str(state_dir / "checkpoints"),
+    CHECKPOINT_INTERVAL="0",
+    CANCEL_FLAGS_DIR=str(state_dir / "cancelled"),
+    MODEL_STORE_DIR=str(state_dir / "model_store"),
+    # a cache hit would finish the job without training it
+    RESULT_CACHE_DIR="",
+    PREWARM_DATASETS="",
+    TRAINING_MAX_WORKERS="1",
+)
+
+
+def start_server(port):
+    # a session of its own, killing the process group takes the worker processes down too
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "src.main:app", "--port", str(port)],
+        env=env, start_new_session=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    wait_for(lambda: requests.get(f"http://127.0.0.1:{port}/", timeout=1).ok, "server startup")
+    return server
+
+
+def wait_for(condition, what):
+    deadline = time.time() + args.timeout
+    while time.time() < deadline:
+        try:
+            if condition():
+                return
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.2)
+    raise TimeoutError(f"Timed out waiting for {what}")
+
+
+blocks = [
+    {"block_id": "linear_layer", "order": 1, "params": {"out_features": 32}},
+    {"block_id": "relu_activation", "order": 2, "params": {}},
+    {"block_id": "linear_layer", "order": 3, "params": {"out_features": 2}},
+]
+job_id = f"recovery-{int(time.time())}"
+job = {
+    "job_id": job_id,
+    "user_id": "recovery",
+    "dataset": "weather",
+    "callback_url": None,
+    "diagram": {
+        "blocks": blocks, "execution": "train", "dataset": "weather", "optimizer": "adam_algorithm",
+        "loss_fn": "cross_entropy_loss", "evalFns": ["accuracy_metric"], "lr": 0.001, "epochs": args.epochs,
+        "batch_size": 2, "seed": 0
+    },
+}
+
+first = start_server(args.ports[0])
+print(requests.post(f"http://127.0.0.1:{args.ports[0]}/train", json=job).json())
+
+
+def checkpointed():
+    status = requests.get(f"http://127.0.0.1:{args.ports[0]}/jobs/{job_id}").json()
+    if status["state"] not in ("queued", "running"):
+        sys.exit(f"Job {job_id} ended before it could be killed: {status}")
+    return any((state_dir / "checkpoints").glob("*.pt"))
+
+
+wait_for(checkpointed, "the first checkpoint")
+os.killpg(first.pid, signal.SIGKILL)
+first.wait()
+print(f"Killed the first server with job {job_id} running")
+
+second = start_server(args.ports[1])
+try:
+    url = f"http://127.0.0.1:{args.ports[1]}/jobs/{job_id}"
+    wait_for(lambda: requests.get(url).json().get("state") in ("done", "error"), "the recovered job")
+    status = requests.get(url).json()
+    print(status)
+    resumed_from = (status.get("result") or {}).get("timings", {}).get("resumed_from_epoch")
+    if status["state"] != "done" or resumed_from is None:
+        sys.exit(f"Job {job_id} did not resume: {status['state']}, resumed_from_epoch={resumed_from}")
+    print(f"Job {job_id} resumed from epoch {resumed_from} of {args.epochs} on the second server")
+finally:
+    os.killpg(second.pid, signal.SIGKILL)
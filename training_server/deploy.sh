@@ -18,4 +18,5 @@ gcloud builds submit --tag us-west1-docker.pkg.dev/cs194-449021/myai-api/trainin
 #    --region us-west1 \
 #    --allow-unauthenticated \
 #    --memory 8Gi \
-#    --cpu 2
\ No newline at end of file
+#    --cpu 2 \
+#    --no-cpu-throttling
\ No newline at end of file
@@ -55,8 +55,11 @@ resource "google_cloud_run_v2_service" "training_server" {
                 # name = ""
                 # value = ""
             #}
+            # not set: JOB_LEDGER_PATH (a ledger every instance shares) and CHECKPOINT_BUCKET. Without them a job whose
+            # instance dies after /train answered 202 is lost instead of recovered, see handle_training_task in src/main.py
             resources {
-                cpu_idle = true
+                # /train answers 202 and trains after the response, the CPU has to stay allocated between requests
+                cpu_idle = false
                 limits = {
                     cpu = "2"
                     memory = "8Gi"
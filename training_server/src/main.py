@@ -1,9 +1,17 @@
 import os
+import time
+import uuid
+import socket
 from pathlib import Path
 import sys
-from fastapi import FastAPI
+import threading
+import multiprocessing
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from . import utils
+from .utils.job_manager import JobManager, JobQueueFull, default_max_workers
+from .utils.job_ledger import job_ledger
 import logging
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -29,26 +37,80 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# access the dataset path. switch out for Path(__file__).parent / Path("tmp/datasets") when running locally
+LOCAL_DATASETS_PATH = Path("/tmp/datasets")
+
+
+def worker_stats(timings, metrics=None):
+    return {
+        "pid": os.getpid(),
+        "metrics": metrics,
+        "timings": timings,
+        "caches": {
+            "dataset": utils.dataset_cache.stats(),
+            "model": utils.model_cache.stats(),
+            "result": utils.result_cache.stats() if utils.result_cache else None,
+            "model_store": utils.model_store.stats() if utils.model_store else None,
+            "checkpoints": utils.checkpoint_store.stats() if utils.checkpoint_store else None
+        }
+    }
+
+
+def result_owner(cache_key):
+    # weights of a cached result are stored under this id next to the users', so a hit can hand them out
+    return f"result:{cache_key}"
+
 
 def execute_model(diagram, dataset, callback_url, job_id, user_id):
+    '''
+    Runs one training job. Executed inside a job manager worker process, returns the job timings
+    and the worker's cache counters
+    '''
     logger.info(f"Executing model with diagram: {diagram} and dataset {dataset}")
+    timings = {}
+    start = time.perf_counter()
     
-    # access the dataset path. uncomment and switch out second part for local
-    local_datasets_path = Path("/tmp/datasets") # Path(__file__).parent / Path("tmp/datasets")
-    
+    local_datasets_path = LOCAL_DATASETS_PATH
+
     # download data if needed
     utils.download_dataset(local_datasets_path, dataset)
+    timings["download"] = time.perf_counter() - start
+
+    # seeded jobs are deterministic, an identical job on the same dataset version replays the recorded result
+    if diagram.seed is None:
+        diagram.seed = utils.default_seed()
+    cache_key = None
+    dataset_version = utils.dataset_version(local_datasets_path / dataset)
+    if utils.result_cache and diagram.execution == "train" and diagram.seed is not None and dataset_version is not None:
+        cache_key = utils.result_key(diagram, dataset, dataset_version, diagram.seed)
+        record = utils.result_cache.get(cache_key)
+        if record is not None:
+            logger.info(f"Result cache hit for job {job_id}, replaying {len(record['updates'])} updates")
+            start = time.perf_counter()
+            metrics = utils.replay_result(record, callback_url, job_id, user_id)
+            timings["replay"] = time.perf_counter() - start
+            if utils.model_store and record.get("architecture"):
+                # later eval jobs of the user evaluate the weights the cached run trained
+                utils.model_store.copy(result_owner(cache_key), user_id, dataset, record["architecture"])
+            timings["result_cache"] = "hit"
+            return worker_stats(timings, metrics)
+        timings["result_cache"] = "miss"
+    compute_start = time.perf_counter()
 
     dataloader_creator = utils.DataLoaderCreator(
         dataset,
         local_datasets_path,
-        diagram.loss_fn
+        diagram.loss_fn,
+        batch_size=diagram.batch_size
     )
 
     logger.info(f"Retrieving dataset: {dataset}")
 
-    # Get train and test loaders
+    # Get train and test loaders, featurization is skipped if the dataset is already cached
+    start = time.perf_counter()
     train_loader, test_loader, input_shape, output_shape, task_type = dataloader_creator.getLoaders()
+    timings["featurize"] = time.perf_counter() - start
+    logger.info(f"Dataset cache stats: {utils.dataset_cache.stats()}")
     
     # Create the model and execute it
     executable_model = utils.Diagram(
@@ -62,14 +124,189 @@ def execute_model(diagram, dataset, callback_url, job_id, user_id):
         user_id
     )
     
+    start = time.perf_counter()
     executable_model.digest_diagram_object(diagram)
     executable_model.create_model_from_inputs()
+    timings["build_model"] = time.perf_counter() - start
+
+    architecture = utils.architecture_hash(executable_model.architecture)
+    if utils.model_store and diagram.execution == "eval":
+        # evaluate the weights of the user's last training run of this architecture, not a fresh initialization
+        start = time.perf_counter()
+        loaded = utils.model_store.load(user_id, dataset, architecture, executable_model.model)
+        timings["model_store"] = "hit" if loaded else "miss"
+        timings["load_weights"] = time.perf_counter() - start
+        if not loaded:
+            logger.info(f"No trained weights stored for user {user_id}, evaluating an untrained model")
 
     logger.info('Executing model')
 
-    executable_model.execute()
+    start = time.perf_counter()
+    metrics = executable_model.execute()
+    timings["execute"] = time.perf_counter() - start
+    # model template cache hit/miss, build/compile/copy time and train/evaluate time
+    timings.update(executable_model.timings)
+
+    seconds = time.perf_counter() - compute_start
+    if utils.checkpoint_store:
+        utils.checkpoint_store.delete(job_id)
+    if utils.model_store and diagram.execution == "train":
+        start = time.perf_counter()
+        utils.model_store.save(user_id, dataset, architecture, executable_model.model, job_id=job_id)
+        timings["save_weights"] = time.perf_counter() - start
+    if cache_key is not None and callback_url and not executable_model.stopped:
+        if utils.model_store:
+            utils.model_store.copy(user_id, result_owner(cache_key), dataset, architecture)
+        utils.result_cache.put(cache_key, executable_model.history, metrics, seconds, architecture=architecture)
 
     logger.info(f"Model execution complete for diagram: {diagram}")
+    return worker_stats(timings, metrics)
+
+
+def hot_datasets():
+    '''
+    Datasets prewarmed on startup, PREWARM_DATASETS is a comma separated list (empty to disable), all registered datasets by default
+    '''
+    names = os.environ.get("PREWARM_DATASETS")
+    if names is None:
+        return list(utils.DataLoaderCreator.registered_datasets)
+    return [name.strip() for name in names.split(",") if name.strip()]
+
+
+def download_datasets(datasets):
+    for dataset in datasets:
+        utils.download_dataset(LOCAL_DATASETS_PATH, dataset)
+
+
+def warm_worker(datasets, warmed_workers):
+    '''
+    Job manager worker initializer: featurizes every label encoding of the hot datasets into the worker's dataset cache,
+    then counts the worker as warm. Normally prewarm() has downloaded the datasets already, download_dataset only
+    checks the manifest then
+    '''
+    start = time.perf_counter()
+    for dataset in datasets:
+        for loss_fn in utils.DataLoaderCreator.labelEncodingLossFns(dataset):
+            try:
+                utils.download_dataset(LOCAL_DATASETS_PATH, dataset)
+                utils.DataLoaderCreator(dataset, LOCAL_DATASETS_PATH, loss_fn).getFeaturized()
+            except Exception as e:
+                # an exception here would break the whole pool, the job that needs the dataset will report the error
+                logger.error(f"Failed to prewarm {dataset} ({loss_fn}): {e}")
+    with warmed_workers.get_lock():
+        warmed_workers.value += 1
+    logger.info(f"Worker {os.getpid()} warmed {datasets} in {time.perf_counter() - start:.2f}s")
+
+
+# identifies this instance's claims in the job ledger
+INSTANCE_ID = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+# cache counters reported back by each worker process, keyed by pid
+worker_cache_stats = {}
+
+def record_worker_stats(job_id, result):
+    worker_cache_stats[result["pid"]] = result["caches"]
+    job_ledger.finish(job_id, INSTANCE_ID, "done", result={"metrics": result["metrics"], "timings": result["timings"]})
+    utils.cancellation_flags.clear(job_id)
+
+
+def record_job_error(job_id, error):
+    job_ledger.finish(job_id, INSTANCE_ID, "error", error=error)
+    utils.cancellation_flags.clear(job_id)
+
+
+def record_job_cancelled(job_id):
+    job_ledger.finish(job_id, INSTANCE_ID, "cancelled")
+    utils.cancellation_flags.clear(job_id)
+    if utils.checkpoint_store:
+        # a cancelled job is never resumed
+        utils.checkpoint_store.delete(job_id)
+
+
+def recover_jobs():
+    '''
+    Runs the jobs whose claim expired while they were running: their instance was recycled or crashed after /train
+    answered 202, so Cloud Tasks won't deliver them again. They resume from their last checkpoint
+    '''
+    for entry in job_ledger.recover(INSTANCE_ID):
+        request = utils.JobRequest.model_validate(entry["payload"])
+        if utils.cancellation_flags.is_cancelled(request.job_id):
+            record_job_cancelled(request.job_id)
+            continue
+        logger.info(f"Recovering job {request.job_id} (attempt {entry['attempts']})")
+        try:
+            submit_job(request)
+        except JobQueueFull:
+            # the claim isn't renewed, it expires again and the job is recovered later, here or on another instance
+            logger.info(f"Queue full, job {request.job_id} is recovered later")
+
+
+def renew_job_claims():
+    '''
+    Keeps the ledger claims of the queued and running jobs alive, a claim expires if the instance stops renewing it.
+    Takes over the expired claims of other instances' running jobs
+    '''
+    while True:
+        time.sleep(job_ledger.lease / 4)
+        try:
+            job_ledger.renew(job_manager.active_jobs(), INSTANCE_ID)
+        except Exception as e:
+            logger.error(f"Failed to renew job claims: {e}")
+        try:
+            recover_jobs()
+        except Exception as e:
+            logger.error(f"Failed to recover jobs: {e}")
+
+# number of worker processes that finished warm_worker, shared with the spawned workers
+warmed_workers = multiprocessing.get_context("spawn").Value("i", 0)
+prewarm_state = {"datasets": hot_datasets(), "downloaded": False, "error": None}
+
+
+def reset_warmed_workers():
+    # the replacement workers warm up again, /ready reports not ready until they are done
+    with warmed_workers.get_lock():
+        warmed_workers.value = 0
+
+
+job_manager = JobManager(
+    max_workers=default_max_workers(),
+    max_queued=int(os.environ.get("TRAINING_MAX_QUEUED", "32")),
+    on_done=record_worker_stats,
+    on_error=record_job_error,
+    on_cancelled=record_job_cancelled,
+    on_pool_restart=reset_warmed_workers,
+    initializer=warm_worker,
+    initargs=(prewarm_state["datasets"], warmed_workers)
+)
+
+
+def prewarm():
+    '''
+    Downloads the hot datasets, then starts the worker processes which featurize them
+    '''
+    start = time.perf_counter()
+    try:
+        download_datasets(prewarm_state["datasets"])
+        prewarm_state["downloaded"] = True
+        logger.info(f"Downloaded {prewarm_state['datasets']} in {time.perf_counter() - start:.2f}s")
+    except Exception as e:
+        # stay not ready, the jobs will retry the download themselves
+        prewarm_state["error"] = str(e)
+        logger.error(f"Failed to download datasets: {e}")
+        return
+    job_manager.start()
+
+
+@app.on_event("startup")
+def start_prewarm():
+    # in the background so the server answers /ready (with 503) while warming
+    threading.Thread(target=prewarm, name="dataset-prewarm", daemon=True).start()
+    threading.Thread(target=renew_job_claims, name="job-claims", daemon=True).start()
+
+
+@app.on_event("shutdown")
+def shutdown_job_manager():
+    job_manager.shutdown()
 
 
 @app.get("/")
@@ -77,32 +314,123 @@ def root():
     return {"message": "Hello World"}
 
 
-# async to permit multiple requests
-@app.post("/train")
+@app.get("/ready")
+def ready():
+    """200 once the hot datasets are downloaded and featurized in every worker, 503 before. Used as the readiness probe"""
+    status = {
+        "ready": prewarm_state["downloaded"] and warmed_workers.value >= job_manager.max_workers,
+        "datasets": prewarm_state["datasets"],
+        "downloaded": prewarm_state["downloaded"],
+        "warm_workers": warmed_workers.value,
+        "workers": job_manager.max_workers,
+        "error": prewarm_state["error"],
+    }
+    return JSONResponse(status_code=200 if status["ready"] else 503, content=status)
+
+
+def result_cache_totals():
+    '''
+    Result cache counters summed over the workers
+    '''
+    totals = {"hits": 0, "misses": 0, "stores": 0, "seconds_saved": 0.0}
+    for caches in worker_cache_stats.values():
+        for counter in totals:
+            totals[counter] += (caches.get("result") or {}).get(counter, 0)
+    lookups = totals["hits"] + totals["misses"]
+    totals["hit_rate"] = totals["hits"] / lookups if lookups else None
+    return totals
+
+
+@app.get("/stats")
+def stats():
+    """Job queue and per-worker cache counters, used to confirm warm jobs skip featurization, and the result cache's hit rate and compute saved"""
+    return {"jobs": job_manager.stats(), "ledger": job_ledger.stats(), "caches": worker_cache_stats, "result_cache": result_cache_totals()}
+
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    """State (queued/running/done/error), queue depth and timings of a submitted job"""
+    status = job_manager.get(job_id)
+    if status is None:
+        # accepted by another instance, or finished too long ago for the job manager to remember it
+        status = job_ledger.get(job_id)
+        if status is not None:
+            # the recorded request is only kept to recover the job
+            status.pop("payload")
+    if status is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job {job_id}")
+    return status
+
+
+@app.post("/jobs/{job_id}/cancel")
+def cancel_job(job_id: str):
+    """
+    Cancels a job: a queued job is dropped, a running one stops before its next batch (within CANCEL_CHECK_INTERVAL).
+    Cancelling a job that hasn't arrived yet makes /train drop it. With a shared job ledger (JOB_LEDGER_PATH) the flag is
+    stored in the job's ledger entry and reaches the job on any instance, otherwise only on the instance the request is routed to
+    """
+    status = job_manager.get(job_id)
+    if status is not None and status["state"] not in ("queued", "running"):
+        return {"job_id": job_id, "state": status["state"]}
+    # set even for queued jobs, a dispatcher may be handing the job to a worker right now
+    utils.cancellation_flags.cancel(job_id)
+    status = job_manager.cancel(job_id) or job_ledger.get(job_id)
+    return {"job_id": job_id, "state": status["state"] if status else "unknown"}
+
+
+def submit_job(request):
+    '''
+    Queues a claimed job, raises JobQueueFull if the queue is at capacity
+    '''
+    return job_manager.submit(
+        request.job_id,
+        execute_model,
+        request.diagram,
+        request.dataset,
+        request.callback_url and str(request.callback_url),
+        request.job_id,
+        request.user_id
+    )
+
+
+@app.post("/train", status_code=202)
 async def handle_training_task(request: utils.JobRequest):
-    """Endpoint that receives tasks from Cloud Tasks"""
+    """
+    Endpoint that receives tasks from Cloud Tasks. Queues the job and returns immediately.
+    After the 202, Cloud Tasks doesn't redeliver the task, so a job whose instance dies is only run again by another
+    instance's recover_jobs() if JOB_LEDGER_PATH points every instance at the same ledger (and its checkpoints reach
+    CHECKPOINT_BUCKET to resume from). The deploy config (main.tf, deploy.sh) sets neither: the default in-memory
+    ledger dies with the instance and the job is lost, the client has to submit it again
+    """
+    # Parse the request body
+    job_id = request.job_id
+    dataset = request.dataset
+
+    if utils.cancellation_flags.is_cancelled(job_id):
+        # cancelled before the task was delivered
+        return {"status": "cancelled", "job_id": job_id, "dataset": dataset}
+
+    claimed, entry = job_ledger.claim(job_id, INSTANCE_ID, payload=request.model_dump(mode="json"))
+    if not claimed:
+        # redelivered task, answer with what is known about the job instead of training it again
+        logger.info(f"Duplicate delivery of job {job_id} ({entry['state']})")
+        return {"status": entry["state"], "job_id": job_id, "duplicate": True, "result": entry["result"], "error": entry["error"], "dataset": dataset}
+
     try:
-        # Parse the request body
-        job_id = request.job_id
-        user_id = request.user_id
-        diagram = request.diagram
-        callback_url = request.callback_url
-        dataset = request.dataset
-        
-        # Start training in the background using multiprocessing
-        execute_model(diagram, dataset, callback_url, job_id, user_id)
-        # future = process_pool.apply_async(execute_model, (diagram,dataset,callback_url, job_id))
-        return {"status": "complete", "job_id": job_id, "callback_url": callback_url, "dataset": dataset, "diagram": diagram}, 200
-    
-    except Exception as e:
-        return {"status": "error", "error": e}, 500
+        # Training runs in a worker process, the event loop stays free for other requests
+        status = submit_job(request)
+    except JobQueueFull as e:
+        job_ledger.release(job_id, INSTANCE_ID)
+        # 429 makes Cloud Tasks retry the task later with backoff
+        raise HTTPException(status_code=429, detail=str(e))
+
+    return {"status": status["state"], "job_id": job_id, "queue_depth": status["queue_depth"], "dataset": dataset}
 
 
 if __name__ == '__main__':
-    # UNCOMMENT FOR GCP
-    local_datasets_path = Path("/tmp/dataset") # Path(__file__).parent / 
+    # pre-downloads the hot datasets, e.g. while building the image
     try:
-        utils.download_dataset(local_datasets_path)
-        logger.info("Successfully downloaded dataset")
+        download_datasets(hot_datasets())
+        logger.info("Successfully downloaded datasets")
     except Exception as e:
-        logger.info(f"Failed to download datasets: {e}")
\ No newline at end of file
+        logger.info(f"Failed to download datasets: {e}")
@@ -1 +1,13 @@
-from .utils import *
\ No newline at end of file
+from .utils import *
+from .dataset_cache import *
+from .dataset_store import *
+from .image_store import *
+from .job_manager import *
+from .reporter import *
+from .model_cache import *
+from .ensemble import *
+from .result_cache import *
+from .model_store import *
+from .checkpoint_store import *
+from .job_ledger import *
+from .cancellation import *
\ No newline at end of file
@@ -0,0 +1,128 @@
+import os
+import time
+import hashlib
+import logging
+from pathlib import Path
+from .job_ledger import job_ledger, SQLiteJobLedger
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class CancellationFlags():
+    '''
+    Cancelled job ids. The server process sets a flag, the worker process running the job polls it through checker(),
+    so no channel between the processes is needed. Subclasses decide where the flags are stored
+    '''
+    def __init__(self, interval=0.05):
+        '''
+        interval: float, minimum seconds between two checks of a job's flag, a check per batch costs a clock read
+        '''
+        self.interval = interval
+
+    def cancel(self, job_id):
+        raise NotImplementedError
+
+    def is_cancelled(self, job_id):
+        raise NotImplementedError
+
+    def clear(self, job_id):
+        raise NotImplementedError
+
+    def checker(self, job_id):
+        '''
+        Returns a function raising JobCancelled once job_id is cancelled, checking the flag at most every interval seconds
+        '''
+        last_check = time.monotonic()
+
+        def check():
+            nonlocal last_check
+            now = time.monotonic()
+            if now - last_check < self.interval:
+                return
+            last_check = now
+            if self.is_cancelled(job_id):
+                raise JobCancelled(f"Job {job_id} was cancelled")
+        return check
+
+
+class LedgerCancellationFlags(CancellationFlags):
+    '''
+    Flags stored in the job's ledger entry. With a ledger shared by every instance, a cancel request reaches the job
+    whichever instance it is routed to, and a job cancelled before it was delivered is answered as a duplicate
+    '''
+    def __init__(self, ledger, interval=0.05):
+        super().__init__(interval)
+        self.ledger = ledger
+
+    def cancel(self, job_id):
+        self.ledger.cancel(job_id)
+
+    def is_cancelled(self, job_id):
+        return self.ledger.is_cancelled(job_id)
+
+    def clear(self, job_id):
+        # the flag expires with the job's ledger entry
+        pass
+
+
+class FileCancellationFlags(CancellationFlags):
+    '''
+    One empty file per cancelled job in path, seen by the worker processes with a stat call. For ledgers that only live
+    in the server process: flags are on this instance's disk, a cancel request only reaches the jobs of the instance
+    it is routed to (unless path is a shared volume)
+    '''
+    def __init__(self, path, interval=0.05, max_age=60 * 60):
+        '''
+        max_age: float, seconds after which flags of jobs that never ran are removed
+        '''
+        super().__init__(interval)
+        self.path = Path(path)
+        self.max_age = max_age
+
+    def _file(self, job_id):
+        # job ids come from requests, keep them out of file names
+        return self.path / hashlib.sha256(job_id.encode()).hexdigest()
+
+    def cancel(self, job_id):
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._file(job_id).touch()
+        self._prune()
+
+    def is_cancelled(self, job_id):
+        return self._file(job_id).exists()
+
+    def clear(self, job_id):
+        self._file(job_id).unlink(missing_ok=True)
+
+    def _prune(self):
+        now = time.time()
+        for file in self.path.iterdir():
+            try:
+                if now - file.stat().st_mtime > self.max_age:
+                    file.unlink()
+            except OSError:
+                continue
+
+
+def make_cancellation_flags():
+    '''
+    LedgerCancellationFlags if the job ledger is a SQLite file, which the worker processes can read too, FileCancellationFlags
+    in CANCEL_FLAGS_DIR (default /tmp/cancelled_jobs) otherwise. CANCEL_CHECK_INTERVAL is the minimum number of
+    seconds between two checks of a running job's flag (default 0.05)
+    '''
+    interval = float(os.environ.get("CANCEL_CHECK_INTERVAL", "0.05"))
+    if isinstance(job_ledger, SQLiteJobLedger):
+        return LedgerCancellationFlags(job_ledger, interval=interval)
+    return FileCancellationFlags(os.environ.get("CANCEL_FLAGS_DIR", "/tmp/cancelled_jobs"), interval=interval)
+
+
+cancellation_flags = make_cancellation_flags()
@@ -0,0 +1,121 @@
+import os
+import time
+import uuid
+import hashlib
+import logging
+from pathlib import Path
+import torch
+from .dataset_store import GCSBucket, LocalBucket
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+
+class CheckpointStore():
+    '''
+    Training checkpoints keyed by job_id, so a job that is delivered again after its instance was recycled resumes
+    from its last checkpoint instead of epoch 0. Checkpoints are written to a local folder (shared by the worker
+    processes) and, if a bucket is given, uploaded to it under prefix, which lets a retry on another instance resume too.
+    Checkpoints are deleted once their job finishes, the ones of abandoned jobs after max_age seconds
+    '''
+    def __init__(self, path, bucket=None, prefix="checkpoints", interval=30, max_age=24 * 60 * 60):
+        '''
+        interval: float, minimum seconds between two checkpoints of a job, bounds the time spent writing them
+        '''
+        self.path = Path(path)
+        self.bucket = bucket
+        self.prefix = prefix
+        self.interval = interval
+        self.max_age = max_age
+        self.saves = 0
+        self.resumes = 0
+        self.save_seconds = 0.0
+
+    def _name(self, job_id):
+        # job ids come from requests, keep them out of file names
+        return hashlib.sha256(job_id.encode()).hexdigest() + ".pt"
+
+    def save(self, job_id, checkpoint):
+        start = time.perf_counter()
+        self.path.mkdir(parents=True, exist_ok=True)
+        target = self.path / self._name(job_id)
+        tmp_path = target.with_name(f"{target.name}.{uuid.uuid4().hex}.tmp")
+        torch.save(checkpoint, tmp_path)
+        os.replace(tmp_path, target)
+        if self.bucket is not None:
+            try:
+                self.bucket.upload(target, f"{self.prefix}/{target.name}")
+            except Exception as e:
+                # the local copy still covers a retry on this instance
+                logger.error(f"Failed to upload checkpoint of job {job_id}: {e}")
+        self.saves += 1
+        self.save_seconds += time.perf_counter() - start
+        self._prune()
+
+    def load(self, job_id):
+        '''
+        Returns the job's latest checkpoint, None if it has none
+        '''
+        target = self.path / self._name(job_id)
+        if not target.is_file() and self.bucket is not None:
+            tmp_path = target.with_name(f"{target.name}.{uuid.uuid4().hex}.tmp")
+            try:
+                self.path.mkdir(parents=True, exist_ok=True)
+                self.bucket.download(f"{self.prefix}/{target.name}", tmp_path)
+                os.replace(tmp_path, target)
+            except Exception:
+                # not found in the bucket either
+                tmp_path.unlink(missing_ok=True)
+                return None
+        try:
+            checkpoint = torch.load(target, map_location="cpu", weights_only=True)
+        except FileNotFoundError:
+            return None
+        self.resumes += 1
+        return checkpoint
+
+    def delete(self, job_id):
+        name = self._name(job_id)
+        (self.path / name).unlink(missing_ok=True)
+        if self.bucket is not None:
+            try:
+                self.bucket.delete(f"{self.prefix}/{name}")
+            except Exception:
+                # the job never uploaded a checkpoint
+                pass
+
+    def _prune(self):
+        now = time.time()
+        for file in self.path.glob("*.pt"):
+            try:
+                if now - file.stat().st_mtime > self.max_age:
+                    file.unlink()
+            except OSError:
+                continue
+
+    def stats(self):
+        return {"saves": self.saves, "resumes": self.resumes, "save_seconds": self.save_seconds}
+
+
+def make_checkpoint_store():
+    '''
+    CheckpointStore in CHECKPOINT_DIR (default /tmp/checkpoints), None if it is set to an empty string.
+    Checkpoints are also uploaded to the GCS bucket CHECKPOINT_BUCKET, or to the folder CHECKPOINT_BUCKET_DIR,
+    if either is set. CHECKPOINT_INTERVAL is the minimum number of seconds between checkpoints of a job (default 30)
+    '''
+    path = os.environ.get("CHECKPOINT_DIR", "/tmp/checkpoints")
+    if not path:
+        return None
+    bucket = None
+    if os.environ.get("CHECKPOINT_BUCKET_DIR"):
+        bucket = LocalBucket(os.environ["CHECKPOINT_BUCKET_DIR"])
+    elif os.environ.get("CHECKPOINT_BUCKET"):
+        bucket = GCSBucket(os.environ["CHECKPOINT_BUCKET"])
+    return CheckpointStore(path, bucket=bucket, interval=float(os.environ.get("CHECKPOINT_INTERVAL", "30")))
+
+
+checkpoint_store = make_checkpoint_store()
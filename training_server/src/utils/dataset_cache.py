@@ -0,0 +1,122 @@
+import os
+import threading
+import logging
+from collections import OrderedDict
+import torch
+import scipy.sparse
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+
+def tensor_nbytes(value):
+    '''
+    Best effort size in bytes of a featurized array
+    '''
+    if isinstance(value, torch.Tensor):
+        return value.element_size() * value.nelement()
+    if scipy.sparse.issparse(value):
+        return value.data.nbytes + value.indices.nbytes + value.indptr.nbytes
+    return getattr(value, "nbytes", 0)
+
+
+class FeaturizedDataset():
+    '''
+    The finished output of a DataLoaderCreator load method: train/test tensors plus the shapes
+    and task type the Diagram needs. Treated as read-only once it is placed in the cache.
+    '''
+    def __init__(self, X_train, y_train, X_test, y_test, input_shape, output_shape, task_type):
+        self.X_train, self.y_train = X_train, y_train
+        self.X_test, self.y_test = X_test, y_test
+        self.input_shape = input_shape
+        self.output_shape = output_shape
+        self.task_type = task_type
+
+    @property
+    def nbytes(self):
+        return sum(tensor_nbytes(t) for t in (self.X_train, self.y_train, self.X_test, self.y_test))
+
+
+class FeaturizedDatasetCache():
+    '''
+    Process-wide LRU cache of featurized datasets, bounded by a memory budget in bytes.
+    Keys are built by DataLoaderCreator.cacheKey(): (dataset, dataset version, label encoding, train split, seed, ...)
+    '''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, featurized):
+        size = featurized.nbytes
+        if size > self.max_bytes:
+            logger.info(f"Featurized dataset {key} ({size} bytes) exceeds cache budget, not caching")
+            return
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key).nbytes
+            self._entries[key] = featurized
+            self._bytes += size
+            # evict least recently used entries until we are back under budget
+            while self._bytes > self.max_bytes:
+                evicted_key, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+                self.evictions += 1
+                logger.info(f"Evicted featurized dataset {evicted_key}")
+
+    def get_or_create(self, key, create_fn):
+        '''
+        Returns the cached entry for key, calling create_fn() to featurize it on a miss
+        '''
+        featurized = self.get(key)
+        if featurized is None:
+            featurized = create_fn()
+            if featurized is not None:
+                self.put(key, featurized)
+        return featurized
+
+    def invalidate(self, dataset):
+        '''
+        Drops every entry built from the given dataset name (first element of the key)
+        '''
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == dataset]:
+                self._bytes -= self._entries.pop(key).nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+# Shared by every job run in this process
+dataset_cache = FeaturizedDatasetCache(int(os.environ.get("DATASET_CACHE_MAX_MB", "1024")) * 1024 * 1024)
@@ -0,0 +1,292 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import base64
+import shutil
+import hashlib
+import logging
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from .dataset_cache import dataset_cache
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+BUCKET_NAME = "myai-datasets-bucket"
+MANIFEST_NAME = ".manifest.json"
+# datasets_path/<dataset> is a symlink to datasets_path/.versions/<dataset>/<version id>
+VERSIONS_DIR_NAME = ".versions"
+
+
+def file_md5(path):
+    '''
+    Base64 encoded md5 digest of a file, the same format GCS reports in blob.md5_hash
+    '''
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return base64.b64encode(digest.digest()).decode()
+
+
+class GCSBucket():
+    '''
+    Datasets bucket on Google Cloud Storage
+    '''
+    def __init__(self, bucket_name=BUCKET_NAME):
+        self.bucket_name = bucket_name
+        self._bucket = None
+
+    @property
+    def bucket(self):
+        if self._bucket is None:
+            # imported here so the local bucket works without google-cloud-storage credentials
+            from google.cloud import storage
+            self._bucket = storage.Client().bucket(self.bucket_name)
+        return self._bucket
+
+    def list(self, prefix):
+        '''
+        Returns {object name: {"size": int, "md5": str or None}} for every file under prefix
+        '''
+        return {
+            blob.name: {"size": blob.size, "md5": blob.md5_hash}
+            for blob in self.bucket.list_blobs(prefix=prefix)
+            if not blob.name.endswith('/')
+        }
+
+    def download(self, name, local_path):
+        self.bucket.blob(name).download_to_filename(str(local_path))
+
+    def upload(self, local_path, name):
+        self.bucket.blob(name).upload_from_filename(str(local_path))
+
+    def delete(self, name):
+        self.bucket.blob(name).delete()
+
+
+class LocalBucket():
+    '''
+    Filesystem bucket, e.g. the datasets_bucket/datasets folder of this repo, so downloads can run offline
+    '''
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def list(self, prefix):
+        objects = {}
+        for path in sorted((self.root / prefix).rglob("*")):
+            if path.is_file():
+                objects[path.relative_to(self.root).as_posix()] = {"size": path.stat().st_size, "md5": file_md5(path)}
+        return objects
+
+    def download(self, name, local_path):
+        shutil.copyfile(self.root / name, local_path)
+
+    def upload(self, local_path, name):
+        target = self.root / name
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = target.with_name(f"{target.name}.{uuid.uuid4().hex}.tmp")
+        shutil.copyfile(local_path, tmp_path)
+        os.replace(tmp_path, target)
+
+    def delete(self, name):
+        (self.root / name).unlink()
+
+
+def get_bucket():
+    '''
+    LocalBucket if DATASETS_BUCKET_DIR is set, the GCS datasets bucket otherwise
+    '''
+    bucket_dir = os.environ.get("DATASETS_BUCKET_DIR")
+    if bucket_dir:
+        return LocalBucket(bucket_dir)
+    return GCSBucket()
+
+
+def read_manifest(dataset_folder):
+    try:
+        with open(dataset_folder / MANIFEST_NAME) as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+
+def is_complete(dataset_folder, manifest):
+    '''
+    Cheap check (no hashing) that every file listed in the manifest is present with the recorded size
+    '''
+    for name, entry in manifest["files"].items():
+        path = dataset_folder / name
+        if not path.is_file() or path.stat().st_size != entry["size"]:
+            return False
+    return True
+
+
+def dataset_version(dataset_folder):
+    '''
+    Short hash of the file checksums and sizes in the dataset's manifest, changes whenever a sync changes a file.
+    None if the folder has no manifest
+    '''
+    manifest = read_manifest(Path(dataset_folder))
+    if manifest is None:
+        return None
+    files = {name: [entry["size"], entry["md5"]] for name, entry in manifest["files"].items()}
+    return hashlib.sha256(json.dumps(files, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def verify_dataset(datasets_path, dataset_name):
+    '''
+    Recomputes the checksum of every local file of the dataset and compares it against the manifest.
+    Returns the list of files that are missing or don't match
+    '''
+    dataset_folder = Path(datasets_path) / dataset_name
+    manifest = read_manifest(dataset_folder)
+    if manifest is None:
+        return [dataset_name]
+    bad = []
+    for name, entry in manifest["files"].items():
+        path = dataset_folder / name
+        if not path.is_file() or path.stat().st_size != entry["size"] or (entry["md5"] and file_md5(path) != entry["md5"]):
+            bad.append(name)
+    return bad
+
+
+def download_dataset(datasets_path, dataset_name, bucket=None, max_workers=8, max_age=None):
+    '''
+    Makes datasets_path / dataset_name a verified copy of the /dataset_name/ folder of the bucket.
+
+    The folder is trusted only if it has a manifest (written last) and every file matches the recorded size. The remote
+    listing is checked again once the manifest is older than max_age seconds (DATASET_SYNC_INTERVAL, default 300), and
+    only the files whose size or checksum changed are downloaded. Downloads run concurrently into a new version
+    folder, each file is checked against the bucket's md5, and the dataset's symlink is then pointed at it with a
+    single os.replace: readers see the old or the new version, never a missing or half populated folder. The previous
+    version is kept for readers that resolved the old link, older ones are removed. A file lock serializes processes
+    syncing the same dataset.
+
+    Returns True if any file changed. The dataset's featurized cache entries are dropped in that case
+    '''
+    datasets_path = Path(datasets_path)
+    dataset_folder = datasets_path / dataset_name
+    if max_age is None:
+        max_age = float(os.environ.get("DATASET_SYNC_INTERVAL", "300"))
+
+    manifest = read_manifest(dataset_folder)
+    if manifest is not None and time.time() - manifest["synced_at"] < max_age and is_complete(dataset_folder, manifest):
+        return False
+
+    datasets_path.mkdir(parents=True, exist_ok=True)
+    with open(datasets_path / f".{dataset_name}.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            return sync_dataset(datasets_path, dataset_name, bucket or get_bucket(), max_workers)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def sync_dataset(datasets_path, dataset_name, bucket, max_workers):
+    '''
+    Body of download_dataset, runs with the dataset lock held
+    '''
+    dataset_folder = datasets_path / dataset_name
+    logger.info(f"Syncing dataset {dataset_name} to {dataset_folder}")
+    start = time.perf_counter()
+
+    prefix = f"{dataset_name}/"
+    remote = {name[len(prefix):]: entry for name, entry in bucket.list(prefix).items()}
+    if not remote:
+        raise ValueError(f"Dataset {dataset_name} not found in bucket")
+
+    # another process may have finished the sync while we were waiting for the lock
+    manifest = read_manifest(dataset_folder) or {"files": {}}
+    local = manifest["files"]
+
+    def unchanged(name, entry):
+        path = dataset_folder / name
+        if not path.is_file() or path.stat().st_size != entry["size"]:
+            return False
+        # folders from before manifests existed have no recorded checksum, hash the file instead
+        local_md5 = local[name]["md5"] if name in local else file_md5(path)
+        return entry["md5"] is None or local_md5 == entry["md5"]
+
+    keep = [name for name, entry in remote.items() if unchanged(name, entry)]
+    fetch = [name for name in remote if name not in keep]
+    removed = [name for name in local if name not in remote]
+
+    new_manifest = {"dataset": dataset_name, "synced_at": time.time(), "files": remote}
+    if not fetch and not removed and manifest.get("files") == remote:
+        # nothing changed, only refresh the sync time
+        write_json_atomic(dataset_folder / MANIFEST_NAME, new_manifest)
+        logger.info(f"Dataset {dataset_name} is up to date ({len(remote)} files)")
+        return False
+
+    versions = datasets_path / VERSIONS_DIR_NAME / dataset_name
+    staging = versions / uuid.uuid4().hex
+    try:
+        staging.mkdir(parents=True)
+        for name in keep:
+            target = staging / name
+            target.parent.mkdir(parents=True, exist_ok=True)
+            # hard links make carrying over unchanged files free
+            os.link(dataset_folder / name, target)
+
+        def fetch_one(name):
+            target = staging / name
+            target.parent.mkdir(parents=True, exist_ok=True)
+            bucket.download(prefix + name, target)
+            expected = remote[name]
+            if target.stat().st_size != expected["size"] or (expected["md5"] and file_md5(target) != expected["md5"]):
+                raise IOError(f"Checksum mismatch for {prefix + name}")
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            # list() re-raises the first download error
+            list(pool.map(fetch_one, fetch))
+
+        write_json_atomic(staging / MANIFEST_NAME, new_manifest)
+        previous = swap_version(datasets_path, dataset_name, staging)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+    for version in versions.iterdir():
+        # also removes folders left behind by syncs that died before their swap
+        if version.name not in (staging.name, previous):
+            shutil.rmtree(version, ignore_errors=True)
+
+    dataset_cache.invalidate(dataset_name)
+    logger.info(f"Synced dataset {dataset_name}: {len(fetch)} downloaded, {len(keep)} kept, {len(removed)} removed "
+                f"in {time.perf_counter() - start:.2f}s")
+    return True
+
+
+def swap_version(datasets_path, dataset_name, version_folder):
+    '''
+    Atomically points the datasets_path/dataset_name symlink at version_folder. Returns the name of the version
+    it pointed at before, None if there was none
+    '''
+    dataset_folder = datasets_path / dataset_name
+    previous = None
+    if dataset_folder.is_symlink():
+        previous = Path(os.readlink(dataset_folder)).name
+    elif dataset_folder.exists():
+        # a plain folder from before versioned datasets, moved into the versions once. Until the symlink below
+        # replaces it the dataset is missing, later syncs swap without that window
+        previous = uuid.uuid4().hex
+        dataset_folder.rename(version_folder.parent / previous)
+    link = datasets_path / f".{dataset_name}.{uuid.uuid4().hex}.link"
+    # relative, the datasets folder can be moved or mounted elsewhere
+    link.symlink_to(version_folder.relative_to(datasets_path))
+    os.replace(link, dataset_folder)
+    return previous
+
+
+def write_json_atomic(path, data):
+    tmp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
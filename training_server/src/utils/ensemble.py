@@ -0,0 +1,144 @@
+import copy
+import logging
+import torch
+import torch.nn.functional as F
+import torch.optim as optim
+from torch.func import stack_module_state, functional_call, vmap
+from .utils import Diagram, EvalFns, ConfusionMatrix, device
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+
+class EnsembleDiagram():
+    '''
+    Trains N models with the same block layout in lockstep. The members' parameters are stacked along a new leading
+    dimension and a single vmapped forward/backward per batch updates all of them, so a sweep over learning rates or
+    seeds costs roughly one training run. Members only differ in their lr and initialization seed, all of them see
+    the same batches in the same order: the order the first member sees when it is trained on its own.
+    '''
+    def __init__(self, train_loader, test_loader, input_shape, output_shape, task, diagram, members):
+        '''
+        diagram: DiagramRequest shared by every member (its lr is ignored)
+        members: list of {"lr": float, "seed": int}
+        '''
+        self.train_loader, self.test_loader = train_loader, test_loader
+        self.task = task
+        self.members = members
+        self.loss_fn_string = diagram.loss_fn
+        self.optimizer_name = diagram.optimizer
+        self.epochs = diagram.epochs
+
+        models = []
+        for i, member in enumerate(members):
+            torch.manual_seed(member["seed"])
+            executable_model = Diagram(train_loader, test_loader, input_shape, output_shape, "", task)
+            executable_model.digest_diagram_object(diagram)
+            executable_model.create_model_from_inputs()
+            models.append(executable_model.model)
+            if i == 0:
+                # trained on its own, the first member would shuffle with the RNG as its initialization left it
+                first_member_rng = torch.get_rng_state()
+        # the shared batch order is the first member's, restored once the other members are built
+        self.rng_state = first_member_rng
+
+        self.params, self.buffers = stack_module_state(models)
+        # stateless copy of the architecture that functional_call runs with each member's parameters
+        self.base_model = copy.deepcopy(models[0]).to("meta")
+        self.lrs = torch.tensor([member["lr"] for member in members], dtype=torch.float32, device=device)
+        self.step_count = 0
+        self.optimizer_state = {name: {} for name in self.params}
+
+    def forward(self, inputs):
+        def call_member(params, buffers, x):
+            return functional_call(self.base_model, (params, buffers), (x,))
+        # torch.func can't batch sparse matmuls, sparse batches are densified once for all members
+        if inputs.is_sparse:
+            inputs = inputs.to_dense()
+        return vmap(call_member, in_dims=(0, 0, None), randomness="different")(self.params, self.buffers, inputs)
+
+    def member_losses(self, outputs, labels):
+        '''
+        outputs: (members, batch, out). Returns the mean loss of every member, shape (members,)
+        '''
+        n_members = outputs.shape[0]
+        if self.loss_fn_string == 'cross_entropy_loss':
+            losses = F.cross_entropy(outputs.reshape(-1, outputs.shape[-1]), labels.repeat(n_members), reduction='none')
+        else:
+            targets = labels.view(1, -1, 1).expand_as(outputs).to(outputs.dtype)
+            if self.loss_fn_string == 'bce':
+                losses = F.binary_cross_entropy(outputs, targets, reduction='none')
+            else:
+                # BinaryHingeLoss
+                losses = torch.clamp(1 - outputs * targets, min=0)
+        return losses.reshape(n_members, -1).mean(dim=1)
+
+    def optimizer_step(self):
+        '''
+        Applies the diagram's optimizer to every member with its own learning rate.
+        Mirrors Diagram.optimizerDict: adam_algorithm is Adam with default betas, the other optimizers are plain SGD
+        '''
+        self.step_count += 1
+        use_adam = Diagram.optimizerDict[self.optimizer_name] is optim.Adam
+        beta1, beta2, eps = 0.9, 0.999, 1e-8
+        with torch.no_grad():
+            for name, param in self.params.items():
+                grad = param.grad
+                if grad is None:
+                    continue
+                lr = self.lrs.view(-1, *([1] * (param.dim() - 1)))
+                if use_adam:
+                    state = self.optimizer_state[name]
+                    if not state:
+                        state["exp_avg"] = torch.zeros_like(param)
+                        state["exp_avg_sq"] = torch.zeros_like(param)
+                    state["exp_avg"].mul_(beta1).add_(grad, alpha=1 - beta1)
+                    state["exp_avg_sq"].mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+                    bias_correction1 = 1 - beta1 ** self.step_count
+                    bias_correction2 = 1 - beta2 ** self.step_count
+                    denom = (state["exp_avg_sq"] / bias_correction2).sqrt_().add_(eps)
+                    param.sub_(lr * (state["exp_avg"] / bias_correction1) / denom)
+                else:
+                    param.sub_(lr * grad)
+                param.grad = None
+
+    def train(self):
+        torch.set_rng_state(self.rng_state)
+        self.base_model.train()
+        losses = None
+        for epoch in range(self.epochs):
+            running_loss = torch.zeros(len(self.members))
+            for data, labels in self.train_loader:
+                data, labels = data.to(device), labels.to(device)
+                losses = self.member_losses(self.forward(data), labels)
+                # members are independent, so the gradient of the sum is each member's own gradient
+                losses.sum().backward()
+                self.optimizer_step()
+                running_loss += losses.detach().cpu()
+            logger.info(f"Epoch {epoch+1}/{self.epochs}, Losses: {(running_loss / len(self.train_loader)).tolist()}")
+
+    def evaluate(self):
+        '''
+        Returns one metrics dict per member, in the same format as EvalFns.get_all_metrics
+        '''
+        self.base_model.eval()
+        confusions = [ConfusionMatrix() for _ in self.members]
+        with torch.inference_mode():
+            for inputs, labels in self.test_loader:
+                inputs, labels = inputs.to(device), labels.to(device)
+                outputs = self.forward(inputs)
+                for confusion, member_outputs in zip(confusions, outputs):
+                    preds, member_labels = EvalFns.get_predictions(member_outputs, labels, self.loss_fn_string, self.task)
+                    confusion.update(preds, member_labels)
+
+        if self.task == 'binary_classification':
+            return [confusion.binary_metrics() for confusion in confusions]
+        return [confusion.multiclass_metrics() for confusion in confusions]
+
+    def execute(self):
+        self.train()
+        return self.evaluate()
@@ -0,0 +1,144 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import shutil
+import logging
+from pathlib import Path
+import numpy as np
+import torch
+from .dataset_store import dataset_version
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+PACK_DIR_NAME = ".packed"
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg"}
+
+
+class PackedImages():
+    '''
+    A subset (indices) of a packed uint8 image array, usually a read-only memmap. Indexing with a slice or an index
+    array only selects indices, the pixels are read and scaled to [0, 1] floats one batch at a time by to_tensor(),
+    so every job reading the same pack shares the page cache instead of holding its own copy
+    '''
+    def __init__(self, images, indices=None):
+        self.images = images
+        self.indices = np.arange(len(images)) if indices is None else indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, index):
+        return PackedImages(self.images, self.indices[index])
+
+    @property
+    def nbytes(self):
+        # the pixels are shared through the memmap, a subset only owns its indices
+        return self.indices.nbytes
+
+    def to_tensor(self):
+        '''
+        Returns the selected images as a float tensor of shape (n, height * width * channels)
+        '''
+        # numpy reads faster with increasing indices, the rows are put back in the requested order afterwards
+        order = np.argsort(self.indices, kind="stable")
+        batch = np.empty((len(self.indices),) + self.images.shape[1:], dtype=self.images.dtype)
+        batch[order] = self.images[self.indices[order]]
+        return torch.from_numpy(batch).reshape(len(batch), -1).float().div_(255)
+
+
+def ingest_images(dataset_folder, mode="L", pack_dir=None):
+    '''
+    Decodes every image under dataset_folder/<class name>/ once into pack_dir (default dataset_folder/.packed):
+        images.npy, uint8 array of shape (n, height, width) for mode "L" or (n, height, width, 3) for "RGB"
+        labels.npy, int64 class index of every image
+        classes.json, class names ordered by index
+    All images must have the same size. The files are written under temporary names and renamed into place
+    '''
+    from PIL import Image
+
+    dataset_folder = Path(dataset_folder)
+    classes = sorted(path.name for path in dataset_folder.iterdir() if path.is_dir() and not path.name.startswith("."))
+    files = [
+        (path, label)
+        for label, name in enumerate(classes)
+        for path in sorted((dataset_folder / name).iterdir())
+        if path.suffix.lower() in IMAGE_EXTENSIONS
+    ]
+    if not files:
+        raise ValueError(f"No images found under {dataset_folder}")
+
+    start = time.perf_counter()
+    first = np.asarray(Image.open(files[0][0]).convert(mode))
+    images = np.empty((len(files),) + first.shape, dtype=np.uint8)
+    labels = np.empty(len(files), dtype=np.int64)
+    for i, (path, label) in enumerate(files):
+        with Image.open(path) as image:
+            images[i] = np.asarray(image.convert(mode))
+        labels[i] = label
+
+    pack_dir = Path(pack_dir) if pack_dir is not None else dataset_folder / PACK_DIR_NAME
+    pack_dir.mkdir(parents=True, exist_ok=True)
+    suffix = uuid.uuid4().hex
+    # classes.json goes last, its presence marks a complete pack
+    for name, array in [("images.npy", images), ("labels.npy", labels)]:
+        tmp_path = pack_dir / f"{name}.{suffix}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp_path, pack_dir / name)
+    tmp_path = pack_dir / f"classes.json.{suffix}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"classes": classes, "mode": mode}, f)
+    os.replace(tmp_path, pack_dir / "classes.json")
+
+    logger.info(f"Packed {len(files)} images of {dataset_folder} ({images.nbytes / 1e6:.1f} MB) in {time.perf_counter() - start:.2f}s")
+
+
+def load_packed_images(dataset_folder, mode="L"):
+    '''
+    Returns (images, labels, classes) of dataset_folder, images being a read-only memmap of the packed array.
+    Packs live in dataset_folder/.packed/<dataset_version>, so images synced by any process are never read from a
+    pack of the previous version. The pack is built by ingest_images the first time, a file lock makes concurrent
+    jobs wait for a single ingest, and the packs of other versions are removed then
+    '''
+    dataset_folder = Path(dataset_folder)
+    version = dataset_version(dataset_folder) or "unversioned"
+    pack_dir = dataset_folder / PACK_DIR_NAME / version
+
+    def read_classes():
+        try:
+            with open(pack_dir / "classes.json") as f:
+                meta = json.load(f)
+            return meta["classes"] if meta["mode"] == mode else None
+        except (OSError, json.JSONDecodeError, KeyError):
+            return None
+
+    classes = read_classes()
+    if classes is None:
+        with open(dataset_folder / ".pack.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                classes = read_classes()
+                if classes is None:
+                    ingest_images(dataset_folder, mode, pack_dir)
+                    classes = read_classes()
+                    for stale in (dataset_folder / PACK_DIR_NAME).iterdir():
+                        # jobs still reading a removed pack keep their memmap, the pages stay valid until closed
+                        if stale.name == version:
+                            continue
+                        if stale.is_dir():
+                            shutil.rmtree(stale, ignore_errors=True)
+                        else:
+                            stale.unlink(missing_ok=True)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    images = np.load(pack_dir / "images.npy", mmap_mode="r")
+    labels = np.load(pack_dir / "labels.npy")
+    return images, labels, classes
@@ -0,0 +1,403 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+
+class InMemoryJobLedger:
+    '''
+    job_id -> state of every job this server accepted, so a redelivered /train request is recognized.
+    A job is claimed by an owner (the instance running it) for lease seconds, and the owner renews the claim while
+    the job is queued or running. A claim that wasn't renewed in time, e.g. because the instance went away, can be
+    taken over. A claim records the job's request (payload), so recover() can run a job again when its instance went
+    away after answering the request. Entries carry the job's cancellation flag, which its running job polls.
+    Finished jobs keep their state and result for ttl seconds. Only visible to the current process: a duplicate
+    delivered to another instance, or to another uvicorn worker, is not recognized and trains again
+    '''
+    def __init__(self, lease=120, ttl=24 * 60 * 60, max_attempts=3):
+        '''
+        max_attempts: int, number of claims after which recover() gives up on a job and marks it as failed
+        '''
+        self.lease = lease
+        self.ttl = ttl
+        self.max_attempts = max_attempts
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.claims = 0
+        self.duplicates = 0
+        self.recoveries = 0
+
+    def _current(self, job_id, now):
+        entry = self._entries.get(job_id)
+        if entry is not None and entry["expires_at"] <= now:
+            del self._entries[job_id]
+            return None
+        return entry
+
+    def claim(self, job_id, owner, payload=None):
+        '''
+        Returns (True, entry) if the caller now owns the job, (False, entry) with the recorded entry if the job is
+        running elsewhere or already finished. Failed jobs can be claimed again.
+        payload: JSON serializable request of the job, needed to recover it
+        '''
+        now = time.time()
+        with self._lock:
+            entry = self._current(job_id, now)
+            if entry is not None and entry["state"] != "error":
+                self.duplicates += 1
+                return False, dict(entry)
+            entry = {
+                "job_id": job_id,
+                "state": "running",
+                "owner": owner,
+                "attempts": (entry["attempts"] if entry else 0) + 1,
+                "result": None,
+                "error": None,
+                "payload": payload,
+                "cancelled": False,
+                "expires_at": now + self.lease,
+            }
+            self._entries[job_id] = entry
+            self.claims += 1
+            return True, dict(entry)
+
+    def cancel(self, job_id):
+        '''
+        Flags a running job as cancelled. A job without an entry yet is recorded as cancelled, its delivery is then
+        answered as a duplicate instead of running it. Returns the job's state
+        '''
+        now = time.time()
+        with self._lock:
+            entry = self._current(job_id, now)
+            if entry is None:
+                entry = {
+                    "job_id": job_id,
+                    "state": "cancelled",
+                    "owner": None,
+                    "attempts": 0,
+                    "result": None,
+                    "error": None,
+                    "payload": None,
+                    "cancelled": True,
+                    "expires_at": now + self.ttl,
+                }
+                self._entries[job_id] = entry
+            elif entry["state"] == "running":
+                entry["cancelled"] = True
+            return entry["state"]
+
+    def is_cancelled(self, job_id):
+        with self._lock:
+            entry = self._entries.get(job_id)
+            return entry is not None and entry["cancelled"]
+
+    def recover(self, owner):
+        '''
+        Claims for owner the jobs whose claim expired while they were running, i.e. their instance went away without
+        finishing them, and returns their entries. Jobs already claimed max_attempts times are marked as failed instead
+        '''
+        now = time.time()
+        recovered = []
+        with self._lock:
+            for entry in self._entries.values():
+                if entry["state"] != "running" or entry["expires_at"] > now or entry["payload"] is None:
+                    continue
+                if entry["attempts"] >= self.max_attempts:
+                    entry.update(state="error", error=f"Abandoned after {entry['attempts']} attempts", payload=None,
+                                 expires_at=now + self.ttl)
+                    continue
+                entry.update(owner=owner, attempts=entry["attempts"] + 1, expires_at=now + self.lease)
+                recovered.append(dict(entry))
+            self.recoveries += len(recovered)
+        return recovered
+
+    def renew(self, job_ids, owner):
+        '''
+        Extends the claims owner still holds on job_ids
+        '''
+        expires_at = time.time() + self.lease
+        with self._lock:
+            for job_id in job_ids:
+                entry = self._entries.get(job_id)
+                if entry is not None and entry["state"] == "running" and entry["owner"] == owner:
+                    entry["expires_at"] = expires_at
+
+    def release(self, job_id, owner):
+        '''
+        Drops a claim without recording a result, e.g. when the job could not be queued
+        '''
+        with self._lock:
+            entry = self._entries.get(job_id)
+            if entry is not None and entry["state"] == "running" and entry["owner"] == owner:
+                del self._entries[job_id]
+
+    def finish(self, job_id, owner, state, result=None, error=None):
+        '''
+        Records the outcome of a job (state "done" or "error"), kept for ttl seconds
+        '''
+        with self._lock:
+            entry = self._entries.get(job_id)
+            if entry is not None and entry["owner"] != owner:
+                # the claim expired and another instance took the job over, its outcome wins
+                return
+            self._entries[job_id] = {
+                "job_id": job_id,
+                "state": state,
+                "owner": owner,
+                "attempts": entry["attempts"] if entry else 1,
+                "result": result,
+                "error": error,
+                "payload": None,
+                "cancelled": entry["cancelled"] if entry else False,
+                "expires_at": time.time() + self.ttl,
+            }
+
+    def get(self, job_id):
+        with self._lock:
+            entry = self._current(job_id, time.time())
+            return dict(entry) if entry is not None else None
+
+    def stats(self):
+        with self._lock:
+            return {"backend": "memory", "entries": len(self._entries), "claims": self.claims, "duplicates": self.duplicates,
+                    "recoveries": self.recoveries}
+
+
+class SQLiteJobLedger:
+    '''
+    Same interface as InMemoryJobLedger, stored in a SQLite file shared by every process that opens it, so a duplicate
+    is recognized by every worker of the instance. Instances only share it on a filesystem whose locks SQLite can rely
+    on (not a GCS bucket mount)
+    '''
+    columns = ("job_id", "state", "owner", "attempts", "result", "error", "payload", "cancelled", "expires_at")
+    json_columns = ("result", "payload")
+
+    def __init__(self, path, lease=120, ttl=24 * 60 * 60, max_attempts=3, purge_interval=300):
+        self.path = str(path)
+        self.lease = lease
+        self.ttl = ttl
+        self.max_attempts = max_attempts
+        self.purge_interval = purge_interval
+        self._local = threading.local()
+        self._last_purge = 0
+        self.claims = 0
+        self.duplicates = 0
+        self.recoveries = 0
+        conn = self._connection()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, state TEXT NOT NULL, owner TEXT, "
+            "attempts INTEGER NOT NULL, result TEXT, error TEXT, payload TEXT, cancelled INTEGER NOT NULL DEFAULT 0, "
+            "expires_at REAL NOT NULL)"
+        )
+        # ledgers created before jobs could be recovered or cancelled
+        for column in ("payload TEXT", "cancelled INTEGER NOT NULL DEFAULT 0"):
+            try:
+                conn.execute(f"ALTER TABLE jobs ADD COLUMN {column}")
+            except sqlite3.OperationalError:
+                pass
+
+    def _connection(self):
+        # sqlite3 connections can't be shared between threads, keep one per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _entry(self, row):
+        entry = dict(zip(self.columns, row))
+        for column in self.json_columns:
+            entry[column] = json.loads(entry[column]) if entry[column] is not None else None
+        entry["cancelled"] = bool(entry["cancelled"])
+        return entry
+
+    def _select(self, conn, job_id, now):
+        row = conn.execute(
+            f"SELECT {', '.join(self.columns)} FROM jobs WHERE job_id = ? AND expires_at > ?", (job_id, now)
+        ).fetchone()
+        return self._entry(row) if row is not None else None
+
+    def _write(self, conn, entry):
+        values = dict(entry)
+        for column in self.json_columns:
+            values[column] = json.dumps(entry[column]) if entry[column] is not None else None
+        conn.execute(
+            f"INSERT OR REPLACE INTO jobs ({', '.join(self.columns)}) VALUES ({', '.join('?' * len(self.columns))})",
+            tuple(values[column] for column in self.columns)
+        )
+
+    def claim(self, job_id, owner, payload=None):
+        now = time.time()
+        conn = self._connection()
+        # BEGIN IMMEDIATE takes the write lock up front, two instances can't both see the job as unclaimed
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            entry = self._select(conn, job_id, now)
+            if entry is not None and entry["state"] != "error":
+                conn.execute("ROLLBACK")
+                self.duplicates += 1
+                return False, entry
+            entry = {
+                "job_id": job_id,
+                "state": "running",
+                "owner": owner,
+                "attempts": (entry["attempts"] if entry else 0) + 1,
+                "result": None,
+                "error": None,
+                "payload": payload,
+                "cancelled": False,
+                "expires_at": now + self.lease,
+            }
+            self._write(conn, entry)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self.claims += 1
+        self._maybe_purge()
+        return True, entry
+
+    def cancel(self, job_id):
+        now = time.time()
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            entry = self._select(conn, job_id, now)
+            if entry is None:
+                entry = {
+                    "job_id": job_id,
+                    "state": "cancelled",
+                    "owner": None,
+                    "attempts": 0,
+                    "result": None,
+                    "error": None,
+                    "payload": None,
+                    "cancelled": True,
+                    "expires_at": now + self.ttl,
+                }
+                self._write(conn, entry)
+            elif entry["state"] == "running":
+                conn.execute("UPDATE jobs SET cancelled = 1 WHERE job_id = ?", (job_id,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return entry["state"]
+
+    def is_cancelled(self, job_id):
+        row = self._connection().execute("SELECT cancelled FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return row is not None and bool(row[0])
+
+    def recover(self, owner):
+        now = time.time()
+        conn = self._connection()
+        recovered = []
+        # in one write transaction, two instances scanning at once never take over the same job
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                f"SELECT {', '.join(self.columns)} FROM jobs "
+                "WHERE state = 'running' AND expires_at <= ? AND payload IS NOT NULL", (now,)
+            ).fetchall()
+            for entry in map(self._entry, rows):
+                if entry["attempts"] >= self.max_attempts:
+                    entry.update(state="error", error=f"Abandoned after {entry['attempts']} attempts", payload=None,
+                                 expires_at=now + self.ttl)
+                else:
+                    entry.update(owner=owner, attempts=entry["attempts"] + 1, expires_at=now + self.lease)
+                    recovered.append(entry)
+                self._write(conn, entry)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self.recoveries += len(recovered)
+        return recovered
+
+    def renew(self, job_ids, owner):
+        self._connection().executemany(
+            "UPDATE jobs SET expires_at = ? WHERE job_id = ? AND state = 'running' AND owner = ?",
+            [(time.time() + self.lease, job_id, owner) for job_id in job_ids]
+        )
+
+    def release(self, job_id, owner):
+        self._connection().execute(
+            "DELETE FROM jobs WHERE job_id = ? AND state = 'running' AND owner = ?", (job_id, owner)
+        )
+
+    def finish(self, job_id, owner, state, result=None, error=None):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # an expired entry still tells who owns the job
+            row = conn.execute("SELECT owner, attempts, cancelled FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            if row is not None and row[0] != owner:
+                conn.execute("ROLLBACK")
+                return
+            self._write(conn, {
+                "job_id": job_id,
+                "state": state,
+                "owner": owner,
+                "attempts": row[1] if row else 1,
+                "result": result,
+                "error": error,
+                "payload": None,
+                "cancelled": bool(row[2]) if row else False,
+                "expires_at": time.time() + self.ttl,
+            })
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def get(self, job_id):
+        return self._select(self._connection(), job_id, time.time())
+
+    def _maybe_purge(self):
+        now = time.time()
+        if now - self._last_purge < self.purge_interval:
+            return
+        self._last_purge = now
+        # running jobs whose claim expired are kept for recover(), for ttl seconds at most
+        self._connection().execute(
+            "DELETE FROM jobs WHERE expires_at <= ? AND (state != 'running' OR expires_at <= ?)", (now, now - self.ttl)
+        )
+
+    def stats(self):
+        entries = self._connection().execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+        return {"backend": "sqlite", "path": self.path, "entries": entries, "claims": self.claims, "duplicates": self.duplicates,
+                "recoveries": self.recoveries}
+
+
+def make_job_ledger():
+    '''
+    SQLiteJobLedger at JOB_LEDGER_PATH if it is set, InMemoryJobLedger otherwise. The deploy config doesn't set it,
+    so deployed instances dedupe only the deliveries they receive themselves.
+    JOB_LEDGER_LEASE is how long a claim survives without being renewed (default 120 seconds),
+    JOB_LEDGER_TTL how long finished jobs are remembered (default 24 hours),
+    JOB_MAX_ATTEMPTS how many times a job whose instance went away is started before it is given up (default 3)
+    '''
+    lease = float(os.environ.get("JOB_LEDGER_LEASE", "120"))
+    ttl = float(os.environ.get("JOB_LEDGER_TTL", str(24 * 60 * 60)))
+    max_attempts = int(os.environ.get("JOB_MAX_ATTEMPTS", "3"))
+    path = os.environ.get("JOB_LEDGER_PATH")
+    if path:
+        logger.info(f"Using SQLite job ledger at {path}")
+        return SQLiteJobLedger(path, lease=lease, ttl=ttl, max_attempts=max_attempts)
+    logger.warning("JOB_LEDGER_PATH isn't set, duplicate deliveries are only recognized within this process")
+    return InMemoryJobLedger(lease=lease, ttl=ttl, max_attempts=max_attempts)
+
+
+# every job_id this process accepted, Cloud Tasks may deliver the same task more than once
+job_ledger = make_job_ledger()
@@ -0,0 +1,253 @@
+import os
+import time
+import queue
+import threading
+import logging
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from .cancellation import JobCancelled
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class JobManager():
+    '''
+    Runs training jobs on a bounded process pool so the event loop of the server is never blocked.
+    Jobs wait in a bounded queue and are handed to the pool by one dispatcher thread per worker,
+    which means a job is "running" exactly when it occupies a worker process.
+    '''
+    def __init__(self, max_workers, max_queued, on_done=None, max_history=1000, initializer=None, initargs=(), on_error=None, on_cancelled=None, on_pool_restart=None, max_crashes=1):
+        '''
+        max_workers: int, number of training processes (the concurrency limit)
+        max_queued: int, jobs allowed to wait for a worker before submissions are rejected
+        on_done: callable(job_id, result), called from a dispatcher thread when a job finishes successfully
+        on_error: callable(job_id, error message), called from a dispatcher thread when a job fails
+        on_cancelled: callable(job_id), called from a dispatcher thread when a cancelled job is dropped or stops
+        max_history: int, number of finished jobs whose status is kept around for GET /jobs/{job_id}
+        initializer: callable(*initargs), run once in every worker process when it starts, e.g. to warm its caches
+        on_pool_restart: callable(), called before the pool is recreated because a worker process died (e.g. killed
+            for running out of memory), the new workers run initializer again
+        max_crashes: int, times a job that was running when its worker died is requeued before it is marked as failed
+        '''
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.on_done = on_done
+        self.on_error = on_error
+        self.on_cancelled = on_cancelled
+        self.max_history = max_history
+        self.initializer = initializer
+        self.initargs = initargs
+        self.on_pool_restart = on_pool_restart
+        self.max_crashes = max_crashes
+        self.pool_restarts = 0
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        # start() runs from the prewarm thread and from submit(), only one of them may create the pool
+        self._start_lock = threading.Lock()
+        self._pool = None
+        self._dispatchers = []
+
+    def start(self):
+        with self._start_lock:
+            if self._pool is not None:
+                return
+            self._pool = self._new_pool()
+            for i in range(self.max_workers):
+                dispatcher = threading.Thread(target=self._dispatch, name=f"job-dispatcher-{i}", daemon=True)
+                dispatcher.start()
+                self._dispatchers.append(dispatcher)
+        logger.info(f"Started job manager with {self.max_workers} workers")
+
+    def _new_pool(self):
+        # spawn instead of fork, forking a process that already runs uvicorn and torch threads is unsafe
+        pool = ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=self.initializer,
+            initargs=self.initargs
+        )
+        if self.initializer is not None:
+            # the executor spawns a worker per submit that finds no idle one, start all of them now so they
+            # initialize before any job arrives
+            for _ in range(self.max_workers):
+                pool.submit(os.getpid)
+        return pool
+
+    def _restart_pool(self, broken):
+        '''
+        Replaces broken, a pool whose worker died. Every job running on it fails with BrokenProcessPool at once,
+        only the first of their dispatchers recreates the pool
+        '''
+        with self._start_lock:
+            if self._pool is not broken:
+                return
+            logger.error("A worker process died, restarting the process pool")
+            broken.shutdown(wait=False, cancel_futures=True)
+            if self.on_pool_restart:
+                self.on_pool_restart()
+            self._pool = self._new_pool()
+            self.pool_restarts += 1
+
+    def shutdown(self):
+        with self._start_lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
+
+    def submit(self, job_id, fn, *args):
+        '''
+        Queues fn(*args) to run in a worker process. Raises JobQueueFull if the queue is at capacity
+        '''
+        self.start()
+        job = {
+            "job_id": job_id,
+            "state": "queued",
+            "submitted_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "error": None,
+            "result": None,
+        }
+        with self._lock:
+            self._jobs[job_id] = job
+            self._trim_history()
+        try:
+            self._queue.put_nowait((job_id, fn, args))
+        except queue.Full:
+            with self._lock:
+                self._jobs.pop(job_id, None)
+            raise JobQueueFull(f"Training queue is full ({self.max_queued} jobs waiting)")
+        return self.get(job_id)
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            status = dict(job)
+        status["queue_depth"] = self.queue_depth()
+        if status["started_at"] is not None:
+            status["queued_seconds"] = status["started_at"] - status["submitted_at"]
+        if status["finished_at"] is not None and status["started_at"] is not None:
+            status["run_seconds"] = status["finished_at"] - status["started_at"]
+        return status
+
+    def cancel(self, job_id):
+        '''
+        Marks a queued job as cancelled, it is dropped instead of run. Running jobs have to stop themselves
+        (see JobCancelled). Returns the job's status, None if the job is unknown
+        '''
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            if job["state"] == "queued":
+                job.update(state="cancelled", finished_at=time.time())
+        return self.get(job_id)
+
+    def active_jobs(self):
+        '''
+        Ids of the queued and running jobs
+        '''
+        with self._lock:
+            return [job_id for job_id, job in self._jobs.items() if job["state"] in ("queued", "running")]
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        with self._lock:
+            states = [job["state"] for job in self._jobs.values()]
+        return {
+            "max_workers": self.max_workers,
+            "max_queued": self.max_queued,
+            "queue_depth": self.queue_depth(),
+            "running": states.count("running"),
+            "done": states.count("done"),
+            "error": states.count("error"),
+            "cancelled": states.count("cancelled"),
+            "pool_restarts": self.pool_restarts,
+        }
+
+    def _update(self, job_id, **fields):
+        with self._lock:
+            if job_id in self._jobs:
+                self._jobs[job_id].update(fields)
+
+    def _trim_history(self):
+        # only forget finished jobs, queued and running ones must stay visible
+        finished = [job_id for job_id, job in self._jobs.items() if job["state"] in ("done", "error", "cancelled")]
+        for job_id in finished[:max(0, len(self._jobs) - self.max_history)]:
+            del self._jobs[job_id]
+
+    def _dispatch(self):
+        while True:
+            job_id, fn, args = self._queue.get()
+            with self._lock:
+                job = self._jobs.get(job_id)
+                cancelled = job is not None and job["state"] == "cancelled"
+                if job is not None and not cancelled:
+                    job.update(state="running", started_at=time.time())
+            if cancelled:
+                logger.info(f"Dropped cancelled job {job_id}")
+                if self.on_cancelled:
+                    self.on_cancelled(job_id)
+                self._queue.task_done()
+                continue
+            pool = self._pool
+            try:
+                result = pool.submit(fn, *args).result()
+                self._update(job_id, state="done", finished_at=time.time(), result=result)
+                if self.on_done:
+                    self.on_done(job_id, result)
+            except JobCancelled:
+                logger.info(f"Job {job_id} was cancelled while running")
+                self._update(job_id, state="cancelled", finished_at=time.time())
+                if self.on_cancelled:
+                    self.on_cancelled(job_id)
+            except BrokenProcessPool as e:
+                self._restart_pool(pool)
+                self._requeue_crashed(job_id, fn, args, e)
+            except Exception as e:
+                logger.error(f"Job {job_id} failed: {e}")
+                self._update(job_id, state="error", finished_at=time.time(), error=str(e))
+                if self.on_error:
+                    self.on_error(job_id, str(e))
+            finally:
+                self._queue.task_done()
+
+    def _requeue_crashed(self, job_id, fn, args, error):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            crashes = job.get("crashes", 0) + 1 if job is not None else 0
+            requeue = job is not None and crashes <= self.max_crashes
+            if requeue:
+                job.update(state="queued", crashes=crashes)
+        if requeue:
+            try:
+                self._queue.put_nowait((job_id, fn, args))
+                logger.info(f"Requeued job {job_id}, its worker process died")
+                return
+            except queue.Full:
+                pass
+        message = f"Worker process died while running the job: {error}"
+        logger.error(f"Job {job_id} failed: {message}")
+        self._update(job_id, state="error", finished_at=time.time(), error=message)
+        if self.on_error:
+            self.on_error(job_id, message)
+
+
+def default_max_workers():
+    return int(os.environ.get("TRAINING_MAX_WORKERS", max(1, (os.cpu_count() or 1) // 2)))
@@ -0,0 +1,106 @@
+import os
+import copy
+import json
+import math
+import time
+import threading
+import logging
+from collections import OrderedDict
+import torch
+import torch.nn as nn
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+
+def architecture_key(blocks, input_shape, output_shape, sparse_input=False):
+    '''
+    Normalized, hashable description of a model: the ordered block ids and params plus the data shapes.
+    blocks must already be sorted and have the final layer's out_features set
+    '''
+    layers = tuple((block.block_id, json.dumps(block.params, sort_keys=True)) for block in blocks)
+    return (layers, input_shape, output_shape, sparse_input)
+
+
+def reset_parameters(model):
+    '''
+    Gives every linear layer of model freshly initialized weights, using the same scheme as nn.Linear.reset_parameters.
+    Linear layers are the only blocks with parameters
+    '''
+    with torch.no_grad():
+        for module in model.modules():
+            weight = getattr(module, "weight", None)
+            if not isinstance(weight, torch.Tensor) or weight.dim() != 2:
+                continue
+            nn.init.kaiming_uniform_(weight, a=math.sqrt(5))
+            bias = getattr(module, "bias", None)
+            if isinstance(bias, torch.Tensor):
+                bound = 1 / math.sqrt(weight.shape[1]) if weight.shape[1] > 0 else 0
+                nn.init.uniform_(bias, -bound, bound)
+
+
+class ModelTemplateCache():
+    '''
+    LRU cache of model templates keyed by architecture_key. A template is built once per architecture,
+    every job gets a deep copy of it with freshly initialized parameters.
+    '''
+    def __init__(self, max_entries=64, mode="eager"):
+        '''
+        mode:
+            "eager" holds plain nn.Sequential templates
+            "compile" wraps every copy with torch.compile. Dynamo keeps the captured graph process-wide, so only the
+            first job of an architecture pays for graph capture, inside its first training step (part of the "train" timing)
+        '''
+        self.max_entries = max_entries
+        self.mode = mode
+        self._templates = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, build_fn):
+        '''
+        Returns (model, timings) where model is a fresh copy of the template for key, building it with build_fn() on a miss
+        '''
+        timings = {}
+        with self._lock:
+            template = self._templates.get(key)
+            if template is not None:
+                self._templates.move_to_end(key)
+                self.hits += 1
+        timings["model_cache"] = "hit" if template is not None else "miss"
+
+        if template is None:
+            start = time.perf_counter()
+            # building must not consume the global RNG, so a seeded job gets the same weights on a hit and a miss
+            with torch.random.fork_rng():
+                template = build_fn()
+            timings["model_build"] = time.perf_counter() - start
+            with self._lock:
+                self.misses += 1
+                self._templates[key] = template
+                while len(self._templates) > self.max_entries:
+                    self._templates.popitem(last=False)
+
+        start = time.perf_counter()
+        model = copy.deepcopy(template)
+        reset_parameters(model)
+        if self.mode == "compile":
+            model = torch.compile(model)
+        timings["model_copy"] = time.perf_counter() - start
+        return model, timings
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._templates), "mode": self.mode}
+
+
+# Shared by every job run in this process
+model_cache = ModelTemplateCache(
+    max_entries=int(os.environ.get("MODEL_TEMPLATE_CACHE_SIZE", "64")),
+    mode=os.environ.get("MODEL_TEMPLATE_MODE", "eager")
+)
@@ -0,0 +1,150 @@
+import os
+import time
+import pickle
+import uuid
+import hashlib
+import logging
+from pathlib import Path
+import torch
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+
+def architecture_hash(key):
+    '''
+    Stable hash of a model_cache.architecture_key, the same in every process
+    '''
+    return hashlib.sha256(repr(key).encode()).hexdigest()[:32]
+
+
+def unwrap(model):
+    '''
+    The module torch.compile wrapped, its state_dict has no "_orig_mod." prefix and loads into eager and compiled copies alike
+    '''
+    return getattr(model, "_orig_mod", model)
+
+
+def fits(model, state_dict):
+    '''
+    Whether state_dict has exactly the keys and shapes of model's. load_state_dict copies the matching tensors before it
+    raises on the others, checking first keeps a mismatch from leaving the model half loaded
+    '''
+    expected = unwrap(model).state_dict()
+    return state_dict.keys() == expected.keys() and all(
+        state_dict[name].shape == tensor.shape for name, tensor in expected.items()
+    )
+
+
+class ModelStore():
+    '''
+    Trained weights of the latest training job per (user, dataset, architecture), so "eval" jobs evaluate the model
+    the user trained instead of a freshly initialized one. One file per entry in path (a state_dict saved with torch.save,
+    written atomically, so every worker process shares the store). Once the files exceed max_bytes the least recently
+    used ones are removed. Counters are per process
+    '''
+    def __init__(self, path, max_bytes=1 << 30):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.saves = 0
+        self.evictions = 0
+
+    def _file(self, user_id, dataset, arch_hash):
+        # hashed, user ids don't end up in file names
+        name = hashlib.sha256(f"{user_id}\0{dataset}\0{arch_hash}".encode()).hexdigest()
+        return self.path / f"{name}.pt"
+
+    def save(self, user_id, dataset, arch_hash, model, job_id=None):
+        self.path.mkdir(parents=True, exist_ok=True)
+        target = self._file(user_id, dataset, arch_hash)
+        tmp_path = target.with_name(f"{target.name}.{uuid.uuid4().hex}.tmp")
+        state_dict = {name: tensor.detach().cpu() for name, tensor in unwrap(model).state_dict().items()}
+        torch.save({"state_dict": state_dict, "job_id": job_id, "saved_at": time.time()}, tmp_path)
+        os.replace(tmp_path, target)
+        self.saves += 1
+        self._evict()
+
+    def load(self, user_id, dataset, arch_hash, model):
+        '''
+        Loads the stored weights into model. Returns False if nothing is stored
+        '''
+        target = self._file(user_id, dataset, arch_hash)
+        try:
+            entry = torch.load(target, map_location="cpu", weights_only=True)
+        except (OSError, EOFError, RuntimeError, pickle.UnpicklingError) as e:
+            if not isinstance(e, FileNotFoundError):
+                logger.error(f"Failed to load stored model {target}: {e}")
+            self.misses += 1
+            return False
+        try:
+            if not fits(model, entry["state_dict"]):
+                raise RuntimeError("state_dict keys or shapes differ")
+            unwrap(model).load_state_dict(entry["state_dict"])
+        except RuntimeError as e:
+            # saved by a model whose modules are named differently, e.g. before modules were named by position
+            logger.error(f"Stored model {target} doesn't fit the model, evaluating fresh weights: {e}")
+            self.misses += 1
+            return False
+        # the modification time orders entries for eviction
+        os.utime(target)
+        self.hits += 1
+        logger.info(f"Loaded weights trained by job {entry['job_id']}")
+        return True
+
+    def copy(self, src_user_id, user_id, dataset, arch_hash):
+        '''
+        Gives user_id the weights stored for src_user_id, e.g. when a job's result came from the result cache and
+        nothing was trained. Returns False if src_user_id has nothing stored
+        '''
+        source = self._file(src_user_id, dataset, arch_hash)
+        target = self._file(user_id, dataset, arch_hash)
+        tmp_path = target.with_name(f"{target.name}.{uuid.uuid4().hex}.tmp")
+        try:
+            # entries are never modified in place, a hard link is as good as a copy
+            os.link(source, tmp_path)
+        except FileNotFoundError:
+            return False
+        os.replace(tmp_path, target)
+        os.utime(target)
+        return True
+
+    def _evict(self):
+        entries = []
+        for file in self.path.glob("*.pt"):
+            try:
+                stat = file.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, file))
+        total = sum(size for _, size, _ in entries)
+        entries.sort()
+        # the newest entry is always kept, even if it alone exceeds max_bytes
+        for _, size, file in entries[:-1]:
+            if total <= self.max_bytes:
+                break
+            file.unlink(missing_ok=True)
+            total -= size
+            self.evictions += 1
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "saves": self.saves, "evictions": self.evictions}
+
+
+def make_model_store():
+    '''
+    ModelStore in MODEL_STORE_DIR (default /tmp/model_store), None if it is set to an empty string.
+    MODEL_STORE_MAX_BYTES bounds the size of the stored weights (default 1 GiB)
+    '''
+    path = os.environ.get("MODEL_STORE_DIR", "/tmp/model_store")
+    if not path:
+        return None
+    return ModelStore(path, max_bytes=int(os.environ.get("MODEL_STORE_MAX_BYTES", str(1 << 30))))
+
+
+model_store = make_model_store()
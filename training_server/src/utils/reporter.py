@@ -0,0 +1,175 @@
+import os
+import json
+import threading
+import logging
+from collections import deque
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session(retries=3):
+    '''
+    Keep-alive session shared by every reporter in this process, so updates reuse pooled connections
+    instead of doing a new TCP/TLS handshake per epoch
+    '''
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(
+                total=retries,
+                backoff_factor=0.2,
+                status_forcelist=[502, 503, 504],
+                allowed_methods=["POST"],
+            )
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+        return _session
+
+
+def stream_url_for(callback_url):
+    '''
+    Websocket url of the client server's update stream, next to its /updates route
+    '''
+    base = callback_url[:-len("/updates")] if callback_url.endswith("/updates") else callback_url.rstrip("/")
+    if base.startswith("https://"):
+        base = "wss://" + base[len("https://"):]
+    elif base.startswith("http://"):
+        base = "ws://" + base[len("http://"):]
+    return base + "/updates-stream"
+
+
+class ProgressReporter():
+    '''
+    Posts training updates to the callback url from a background thread so the training loop never waits on the network.
+    Progress updates that pile up while the client server is slow are coalesced into the most recent one,
+    result and error updates are always delivered in order.
+
+    With transport "stream" the updates of the job go over one websocket to the client server's /updates-stream,
+    which answers every frame with the stop_training flag. If the stream can't be opened or breaks, the reporter
+    falls back to POSTing to the callback url for the rest of the job.
+    '''
+    def __init__(self, callback_url, timeout=5, transport=None):
+        '''
+        transport: "http" or "stream", defaults to the UPDATES_TRANSPORT environment variable (http if unset)
+        '''
+        self.callback_url = callback_url
+        self.timeout = timeout
+        self.transport = transport or os.environ.get("UPDATES_TRANSPORT", "http")
+        self._stream = None
+        # latest stop_training flag returned by the client server, read by the training loop
+        self.stop_training = False
+        self.sent = 0
+        self.coalesced = 0
+        self.failed = 0
+        self._pending = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        # set by the background thread once it has flushed everything and exited
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="progress-reporter", daemon=True)
+        self._thread.start()
+
+    def report(self, data, coalesce=True):
+        '''
+        Queues an update without blocking. coalesce=False keeps every progress update, e.g. when replaying a recorded curve.
+        After close() has stopped the background thread the update is sent right away instead, nothing would send it
+        '''
+        with self._cond:
+            stopped = self._stopped
+            if not stopped:
+                if (coalesce and data.get("update_type") == "progress" and self._pending
+                        and self._pending[-1].get("update_type") == "progress"):
+                    # the client only needs the newest progress, replace the one still waiting to be sent
+                    self._pending[-1] = data
+                    self.coalesced += 1
+                else:
+                    self._pending.append(data)
+                self._cond.notify()
+        if stopped:
+            logger.info(f"Reporter is closed, sending {data.get('update_type')} update directly")
+            self._send(data)
+
+    def close(self, timeout=30):
+        '''
+        Flushes the queued updates and stops the background thread
+        '''
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(timeout)
+
+    def stats(self):
+        return {
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "failed": self.failed,
+            "pending": len(self._pending),
+            "transport": self.transport,
+        }
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    self._stopped = True
+                    break
+                data = self._pending.popleft()
+            if self.transport == "stream" and self._send_stream(data):
+                continue
+            self._send(data)
+        if self._stream is not None:
+            self._stream.close()
+
+    def _open_stream(self):
+        # imported here, the http transport doesn't need the websockets package
+        from websockets.sync.client import connect
+        url = stream_url_for(self.callback_url)
+        self._stream = connect(url, open_timeout=self.timeout, close_timeout=1)
+        logger.info(f"Opened update stream to {url}")
+
+    def _send_stream(self, data):
+        '''
+        Sends one frame and reads the acknowledgement. Returns False (and switches to http) if the stream failed
+        '''
+        try:
+            if self._stream is None:
+                self._open_stream()
+            self._stream.send(json.dumps(data))
+            ack = json.loads(self._stream.recv(timeout=self.timeout))
+            self.sent += 1
+            if ack.get("stop_training", False):
+                self.stop_training = True
+            return True
+        except Exception as e:
+            logger.info(f"Update stream failed, falling back to http: {e}")
+            if self._stream is not None:
+                self._stream.close()
+                self._stream = None
+            self.transport = "http"
+            return False
+
+    def _send(self, data):
+        try:
+            response = get_session().post(self.callback_url, json=data, timeout=self.timeout)
+            self.sent += 1
+            logger.info(f"Published {data.get('update_type')} update, received: {response}")
+            if response.ok and response.json().get("stop_training", False):
+                self.stop_training = True
+        except Exception as e:
+            self.failed += 1
+            logger.info(f"Failed to send update: {e}")
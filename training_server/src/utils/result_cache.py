@@ -0,0 +1,158 @@
+import os
+import json
+import time
+import hashlib
+import logging
+from pathlib import Path
+from .dataset_store import write_json_atomic
+from .reporter import ProgressReporter
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+# bump when a change to training or evaluation makes the recorded results stale
+RESULT_FORMAT = 1
+
+
+def default_seed():
+    '''
+    Seed of jobs that don't set one, from DETERMINISTIC_SEED. None (the default) keeps unseeded jobs random and uncached
+    '''
+    seed = os.environ.get("DETERMINISTIC_SEED")
+    return int(seed) if seed not in (None, "") else None
+
+
+def canonical_diagram(diagram):
+    '''
+    JSON text of a DiagramRequest that is equal for every submission that trains the same way: blocks sorted and
+    renumbered, keys sorted, the seed left out (it's part of the key on its own) and the last linear layer's
+    out_features dropped, since the training server replaces it with the dataset's output shape
+    '''
+    data = diagram.model_dump(mode="json", exclude={"seed"})
+    blocks = sorted(data["blocks"], key=lambda block: block["order"])
+    linear = [i for i, block in enumerate(blocks) if block["block_id"] == "linear_layer"]
+    for i, block in enumerate(blocks):
+        block["order"] = i
+        if linear and i == linear[-1] and "out_features" in block["params"]:
+            block["params"]["out_features"] = None
+    data["blocks"] = blocks
+    return json.dumps(data, sort_keys=True, separators=(",", ":"))
+
+
+def result_key(diagram, dataset, dataset_version, seed):
+    '''
+    Content hash identifying the result of training diagram on a version of dataset with seed
+    '''
+    payload = json.dumps([RESULT_FORMAT, canonical_diagram(diagram), dataset, dataset_version, seed])
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class ResultCache():
+    '''
+    Results of deterministic (seeded) jobs: the progress updates sent while training and the final metrics, stored as
+    one JSON file per result_key in path. Files are written atomically, so every worker process shares the cache.
+    Once there are more than max_entries files the least recently used ones are removed.
+    Hit, miss and compute counters are per process
+    '''
+    def __init__(self, path, max_entries=1000):
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.seconds_saved = 0.0
+
+    def _file(self, key):
+        return self.path / f"{key}.json"
+
+    def get(self, key):
+        '''
+        Returns the recorded result for key, None on a miss. A record that can't be replayed, e.g. written by an older
+        version without all of its fields, counts as a miss
+        '''
+        try:
+            with open(self._file(key)) as f:
+                record = json.load(f)
+            # replay_result reads both
+            if not ("updates" in record and "metrics" in record):
+                raise KeyError("updates or metrics")
+            seconds = float(record.get("seconds", 0))
+            # the modification time orders entries for eviction
+            os.utime(self._file(key))
+        except (OSError, json.JSONDecodeError, KeyError, TypeError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.seconds_saved += seconds
+        return record
+
+    def put(self, key, updates, metrics, seconds, architecture=None):
+        '''
+        updates: the progress and result updates of the job, without job_id and user_id
+        seconds: compute time of the job, counted as saved on every later hit
+        architecture: model_store.architecture_hash of the trained model, to find its weights on a hit
+        '''
+        self.path.mkdir(parents=True, exist_ok=True)
+        write_json_atomic(self._file(key), {
+            "updates": updates,
+            "metrics": metrics,
+            "seconds": seconds,
+            "architecture": architecture,
+            "created_at": time.time()
+        })
+        self.stores += 1
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for file in self.path.glob("*.json"):
+            try:
+                entries.append((file.stat().st_mtime, file))
+            except OSError:
+                continue
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort()
+        for _, file in entries[:len(entries) - self.max_entries]:
+            file.unlink(missing_ok=True)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "stores": self.stores,
+            "hit_rate": self.hits / lookups if lookups else None,
+            "seconds_saved": self.seconds_saved,
+        }
+
+
+def replay_result(record, callback_url, job_id, user_id):
+    '''
+    Sends a recorded job's updates to callback_url as if job_id had just trained, every progress update of the curve
+    included, and returns the recorded metrics
+    '''
+    if callback_url:
+        reporter = ProgressReporter(callback_url)
+        for update in record["updates"]:
+            reporter.report(dict(update, job_id=job_id, user_id=user_id), coalesce=False)
+        reporter.close()
+    return record["metrics"]
+
+
+def make_result_cache():
+    '''
+    ResultCache in RESULT_CACHE_DIR (default /tmp/result_cache, shared by the worker processes of this instance),
+    None if it is set to an empty string. RESULT_CACHE_MAX_ENTRIES bounds the number of results kept (default 1000)
+    '''
+    path = os.environ.get("RESULT_CACHE_DIR", "/tmp/result_cache")
+    if not path:
+        return None
+    return ResultCache(path, max_entries=int(os.environ.get("RESULT_CACHE_MAX_ENTRIES", "1000")))
+
+
+result_cache = make_result_cache()
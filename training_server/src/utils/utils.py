@@ -1,4 +1,3 @@
-import requests
 import torch
 import torch.nn as nn
 import torch.optim as optim
@@ -6,19 +5,29 @@ from torch.utils.data import DataLoader, TensorDataset, sampler
 import torchvision.datasets as dset
 import torchvision.transforms as T
 import numpy as np
+import scipy.sparse
 import pathlib as Path
 import pandas as pd
 from sklearn.feature_extraction.text import CountVectorizer
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import LabelEncoder, StandardScaler, MinMaxScaler, OneHotEncoder
-from sklearn.metrics import f1_score, precision_score, recall_score, accuracy_score, confusion_matrix, precision_recall_fscore_support
 import json
 from typing import Dict
-from google.cloud import storage
-from pydantic import BaseModel, HttpUrl
+from pydantic import BaseModel, HttpUrl, Field
 from typing import List, Dict, Any, Optional
 import logging
 import re
+import math
+import time
+from .dataset_cache import FeaturizedDataset, dataset_cache
+from .reporter import ProgressReporter
+from .model_cache import model_cache, architecture_key
+from .dataset_store import download_dataset, dataset_version
+from .image_store import PackedImages, load_packed_images
+from .result_cache import result_cache, result_key, replay_result, default_seed
+from .model_store import model_store, architecture_hash, unwrap, fits
+from .checkpoint_store import checkpoint_store
+from .cancellation import cancellation_flags, JobCancelled
 
 device = torch.device('cpu')
 if torch.cuda.is_available():
@@ -37,7 +46,7 @@ class Block(BaseModel):
     order: int
     params: Dict[str, Any]
 
-class Diagram(BaseModel):
+class DiagramRequest(BaseModel):
     blocks: List[Block]
     execution: str
     dataset: str
@@ -46,21 +55,77 @@ class Diagram(BaseModel):
     evalFns: List[str]
     lr: float
     epochs: int
+    batch_size: int = Field(default=2, ge=1)
+    # fixes the initial weights and batch order, seeded jobs are deterministic and their results are cached
+    seed: Optional[int] = None
 
 class JobRequest(BaseModel):
     job_id: str
     callback_url: Optional[HttpUrl]  # URL validation, optional if empty
     dataset: str
-    diagram: Diagram
+    diagram: DiagramRequest
     user_id: str
 
 
+def sparse_to_tensor(X):
+    '''
+    Converts a scipy sparse matrix to a torch sparse COO tensor
+    '''
+    coo = X.tocoo()
+    indices = torch.from_numpy(np.vstack([coo.row, coo.col]).astype(np.int64))
+    return torch.sparse_coo_tensor(indices, torch.from_numpy(coo.data), coo.shape, check_invariants=False)
+
+
+class TensorBatchLoader():
+    '''
+    Drop in replacement for DataLoader(TensorDataset(X, y)) over in-memory tensors.
+    Shuffling draws one permutation per epoch and applies it to the whole tensor, so every batch
+    is a contiguous slice rather than a per-sample fetch + collate.
+    X may also be a scipy CSR matrix, in which case every batch is yielded as a sparse COO tensor,
+    or PackedImages, in which case only the batch's images are read from the pack and converted to floats.
+    '''
+    def __init__(self, X, y, batch_size, shuffle=False, generator=None):
+        self.X, self.y = X, y
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.generator = generator
+        self.sparse = scipy.sparse.issparse(X)
+        self.packed = isinstance(X, PackedImages)
+
+    def __len__(self):
+        return math.ceil(len(self.y) / self.batch_size)
+
+    def __iter__(self):
+        X, y = self.X, self.y
+        if self.shuffle:
+            perm = torch.randperm(len(y), generator=self.generator)
+            X, y = X[perm.numpy() if self.sparse or self.packed else perm], y[perm]
+        for start in range(0, len(y), self.batch_size):
+            batch = X[start:start + self.batch_size]
+            if self.sparse:
+                batch = sparse_to_tensor(batch)
+            elif self.packed:
+                batch = batch.to_tensor()
+            yield batch, y[start:start + self.batch_size]
+
+
 class DataLoaderCreator():
-    def __init__(self, dataset, datasets_path, loss_fn, train_split=0.8):
+    # datasets whose labels are re-encoded to -1/1 when trained with hinge loss
+    signed_label_datasets = {"mushrooms"}
+    # datasets with a loader, these are downloaded and featurized when the training server starts
+    registered_datasets = ["emails", "mushrooms", "weather", "shapes"]
+
+    def __init__(self, dataset, datasets_path, loss_fn, train_split=0.8, seed=42, cache=dataset_cache, batch_size=2, fast_loader=True, sparse_features=True, eval_batch_size=1024):
         '''
         datasets: str, the dataset to load
         datasets_path: pathlib.PosixPath, path to dataset folder
         train_split: float, fraction of data to put in train. rest is put in Test
+        seed: int, random state used for the train test split
+        cache: FeaturizedDatasetCache shared across jobs, or None to always featurize
+        batch_size: int, batch size of the train loader
+        eval_batch_size: int, batch size of the test loader, evaluation has no gradients so it can use large batches
+        fast_loader: bool, use TensorBatchLoader instead of torch DataLoader
+        sparse_features: bool, keep bag of words features sparse (CSR) instead of densifying them
 
         This class assumes a predetermined structure to each dataset folder
         '''
@@ -69,6 +134,12 @@ class DataLoaderCreator():
         self.train_split = train_split
         self.test_split = 1 - train_split
         self.loss_fn = loss_fn
+        self.seed = seed
+        self.cache = cache
+        self.batch_size = batch_size
+        self.eval_batch_size = eval_batch_size
+        self.fast_loader = fast_loader
+        self.sparse_features = sparse_features
 
         self.dataset_locations = {
             "emails": self.datasets_path / "emails" / "emails.csv",
@@ -77,6 +148,17 @@ class DataLoaderCreator():
         }
     
     def getLoaders(self):
+        featurized = self.getFeaturized()
+        if featurized is None:
+            return None, None, None, None, None
+
+        train_loader, test_loader = self.returnDataLoaders(featurized.X_train, featurized.y_train, featurized.X_test, featurized.y_test)
+        return train_loader, test_loader, featurized.input_shape, featurized.output_shape, featurized.task_type
+
+    def getFeaturized(self):
+        '''
+        Returns the FeaturizedDataset for this dataset, reusing the process-wide cache when possible
+        '''
         methods = {
             "shapes": self.loadShapesDataset,
             "emails": self.loadEmailsDataset,
@@ -87,8 +169,30 @@ class DataLoaderCreator():
         if self.dataset not in methods:
             logger.info('dataset not available')
             print("Dataset not available")
-            return None, None, None, None
-        return methods[self.dataset]()
+            return None
+
+        if self.cache is None:
+            return methods[self.dataset]()
+        return self.cache.get_or_create(self.cacheKey(), methods[self.dataset])
+
+    def labelEncoding(self):
+        if self.loss_fn == 'hinge_loss' and self.dataset in self.signed_label_datasets:
+            return 'signed'
+        return 'default'
+
+    @classmethod
+    def labelEncodingLossFns(cls, dataset):
+        '''
+        One loss function per label encoding of dataset. Featurizing with each of them creates every cache entry a job can hit
+        '''
+        if dataset in cls.signed_label_datasets:
+            return ['cross_entropy_loss', 'hinge_loss']
+        return ['cross_entropy_loss']
+
+    def cacheKey(self):
+        # the manifest's version makes entries featurized before a sync unreachable in every process, not only the syncing one
+        version = dataset_version(self.datasets_path / self.dataset)
+        return (self.dataset, version, self.labelEncoding(), self.train_split, self.seed, self.sparse_features, str(self.datasets_path))
 
     def readIntoDf(self):
         file_path = self.dataset_locations[self.dataset]
@@ -105,20 +209,51 @@ class DataLoaderCreator():
         return df
     
     def loadShapesDataset(self):
-        pass
+        '''
+        64x64 images of circles, rectangles and triangles, one folder per class. The PNGs are decoded once into a packed
+        uint8 array (see image_store.py) that every job memory-maps. Batches are grayscale images flattened to
+        height * width features in [0, 1]
+        '''
+        images, labels, classes = load_packed_images(self.datasets_path / "shapes", mode="L")
+        train_idx, test_idx = train_test_split(np.arange(len(labels)), test_size=self.test_split, random_state=self.seed)
+        input_shape, output_shape = int(np.prod(images.shape[1:])), len(classes)
+
+        return FeaturizedDataset(
+            PackedImages(images, train_idx),
+            torch.from_numpy(labels[train_idx]),
+            PackedImages(images, test_idx),
+            torch.from_numpy(labels[test_idx]),
+            input_shape,
+            output_shape,
+            'multiclass_classification'
+        )
     
-    def returnDataLoaders(self, X_train, y_train, X_test, y_test, x_dtype=torch.float32, y_dtype=torch.float32):
-        # Convert to PyTorch tensors
-        X_train_tensor = torch.tensor(X_train, dtype=x_dtype)
-        X_test_tensor = torch.tensor(X_test, dtype=x_dtype)
+    def toFeaturized(self, X_train, y_train, X_test, y_test, input_shape, output_shape, task_type, x_dtype=torch.float32, y_dtype=torch.float32):
+        if scipy.sparse.issparse(X_train):
+            # sparse features stay CSR, TensorBatchLoader converts one batch at a time
+            X_train_tensor = X_train.astype(np.float32).tocsr()
+            X_test_tensor = X_test.astype(np.float32).tocsr()
+        else:
+            # Convert to PyTorch tensors
+            X_train_tensor = torch.tensor(X_train, dtype=x_dtype)
+            X_test_tensor = torch.tensor(X_test, dtype=x_dtype)
         y_train_tensor = torch.tensor(y_train, dtype=y_dtype)
         y_test_tensor = torch.tensor(y_test, dtype=y_dtype)
 
+        return FeaturizedDataset(X_train_tensor, y_train_tensor, X_test_tensor, y_test_tensor, input_shape, output_shape, task_type)
+
+    def returnDataLoaders(self, X_train_tensor, y_train_tensor, X_test_tensor, y_test_tensor):
+        # TensorDataset can't index scipy matrices or packed images, those always use the fast loader
+        if self.fast_loader or scipy.sparse.issparse(X_train_tensor) or isinstance(X_train_tensor, PackedImages):
+            train_loader = TensorBatchLoader(X_train_tensor, y_train_tensor, self.batch_size, shuffle=True)
+            test_loader = TensorBatchLoader(X_test_tensor, y_test_tensor, self.eval_batch_size, shuffle=False)
+            return train_loader, test_loader
+
         # Create DataLoader for batching
         train_data = TensorDataset(X_train_tensor, y_train_tensor)
         test_data = TensorDataset(X_test_tensor, y_test_tensor)
-        train_loader = DataLoader(train_data, batch_size=2, shuffle=True)
-        test_loader = DataLoader(test_data, batch_size=2, shuffle=False)
+        train_loader = DataLoader(train_data, batch_size=self.batch_size, shuffle=True)
+        test_loader = DataLoader(test_data, batch_size=self.eval_batch_size, shuffle=False)
 
         return train_loader, test_loader
 
@@ -128,14 +263,14 @@ class DataLoaderCreator():
         x,y = df['text'], (df['label'] == "spam").astype(int).values
         # vectorize each separate value x
         vectorizer = CountVectorizer()
-        X = vectorizer.fit_transform(x).toarray()
+        X = vectorizer.fit_transform(x)
+        if not self.sparse_features:
+            X = X.toarray()
 
-        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=self.test_split, random_state=42)
+        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=self.test_split, random_state=self.seed)
 
-        train_loader, test_loader = self.returnDataLoaders(X_train, y_train, X_test, y_test)
-        
         input_shape, output_shape = X_train.shape[1], 1
-        return train_loader, test_loader, input_shape, output_shape, 'binary_classification'
+        return self.toFeaturized(X_train, y_train, X_test, y_test, input_shape, output_shape, 'binary_classification')
     
     def loadMushroomsDataset(self):
         df = self.readIntoDf()
@@ -169,12 +304,11 @@ class DataLoaderCreator():
         encoded_df['class'] = y_df
 
         # train test split
-        X_train, X_test, y_train, y_test = train_test_split(encoded_df.drop('class', axis=1), encoded_df['class'], test_size=0.2, random_state=42)
+        X_train, X_test, y_train, y_test = train_test_split(encoded_df.drop('class', axis=1), encoded_df['class'], test_size=self.test_split, random_state=self.seed)
         input_shape, output_shape = X_train.shape[1], 1
 
         # Convert the DataFrame to PyTorch tensors
-        train_loader, test_loader = self.returnDataLoaders(X_train.to_numpy(), y_train.to_numpy(), X_test.to_numpy(), y_test.to_numpy())
-        return train_loader, test_loader, input_shape, output_shape, 'binary_classification'
+        return self.toFeaturized(X_train.to_numpy(), y_train.to_numpy(), X_test.to_numpy(), y_test.to_numpy(), input_shape, output_shape, 'binary_classification')
     
     def loadWeatherDataset(self):
         df = self.readIntoDf()
@@ -185,100 +319,139 @@ class DataLoaderCreator():
         X = df.drop(['weather', 'date'], axis=1)
         X,y = scaler.fit_transform(X), df['weather'].astype(int).values
 
-        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42, stratify=y)
+        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=self.test_split, random_state=self.seed, stratify=y)
         input_shape, output_shape = X.shape[1], 5
 
-        train_loader, test_loader = self.returnDataLoaders(X_train, y_train, X_test, y_test, y_dtype=torch.int64)
-        return train_loader, test_loader, input_shape, output_shape, 'multiclass_classification'
+        return self.toFeaturized(X_train, y_train, X_test, y_test, input_shape, output_shape, 'multiclass_classification', y_dtype=torch.int64)
+
+
+class ConfusionMatrix():
+    '''
+    Streaming confusion matrix, rows are labels and columns are predictions.
+    Each batch is folded in with a single bincount, every metric is then derived from the counts.
+    '''
+    def __init__(self, num_classes=2):
+        self.num_classes = num_classes
+        self.counts = torch.zeros(num_classes, num_classes, dtype=torch.int64)
+
+    def update(self, preds, labels):
+        preds = preds.reshape(-1).long().cpu()
+        labels = labels.reshape(-1).long().cpu()
+        n = max(self.num_classes, int(preds.max()) + 1, int(labels.max()) + 1) if len(labels) else self.num_classes
+        if n > self.num_classes:
+            self._grow(n)
+        n = self.num_classes
+        self.counts += torch.bincount(labels * n + preds, minlength=n * n).reshape(n, n)
+
+    def _grow(self, num_classes):
+        counts = torch.zeros(num_classes, num_classes, dtype=torch.int64)
+        counts[:self.num_classes, :self.num_classes] = self.counts
+        self.counts, self.num_classes = counts, num_classes
+
+    def per_class(self):
+        '''
+        Returns precision, recall and f1 for every class, 0 where the denominator is 0 (sklearn zero_division=0.0)
+        '''
+        counts = self.counts.double()
+        true_positive = counts.diagonal()
+        predicted = counts.sum(dim=0)
+        actual = counts.sum(dim=1)
+        precision = torch.where(predicted > 0, true_positive / predicted.clamp(min=1), torch.zeros_like(true_positive))
+        recall = torch.where(actual > 0, true_positive / actual.clamp(min=1), torch.zeros_like(true_positive))
+        denominator = precision + recall
+        f1 = torch.where(denominator > 0, 2 * precision * recall / denominator.clamp(min=1e-12), torch.zeros_like(true_positive))
+        return precision, recall, f1
+
+    def accuracy(self):
+        total = int(self.counts.sum())
+        return float(self.counts.diagonal().sum()) / total if total else 0.0
+
+    def binary_metrics(self):
+        precision, recall, f1 = self.per_class()
+        true_negative, false_positive = int(self.counts[0, 0]), int(self.counts[0, 1])
+        # False Positive Rate (FPR) = FP / (FP + TN)
+        false_positive_rate = false_positive / (false_positive + true_negative) if (false_positive + true_negative) > 0 else 0
+        return {
+            'f1_score_metric': float('%.3f' % f1[1]),
+            'precision_metric': float('%.3f' % precision[1]),
+            'recall_metric': float('%.3f' % recall[1]), # True positive rate
+            'accuracy_metric': float('%.3f' % self.accuracy()),
+            'false_positive_metric': false_positive_rate,
+        }
+
+    def multiclass_metrics(self):
+        precision, recall, f1 = self.per_class()
+        # we average the standard metrics over all classes that appear in the labels or predictions (sklearn macro average)
+        present = (self.counts.sum(dim=0) + self.counts.sum(dim=1)) > 0
+        if not present.any():
+            present = torch.ones_like(present)
+        return {
+            'accuracy_metric': float('%.3f' % (self.accuracy() * 100)),
+            'f1_score_metric': float('%.3f' % f1[present].mean()),
+            'precision_metric': float('%.3f' % precision[present].mean()),
+            'recall_metric': float('%.3f' % recall[present].mean()),
+        }
 
 
 class EvalFns():
     @staticmethod
-    def get_all_metrics(model, test_loader, lossFn, task='binary_classification'):
+    def get_all_metrics(model, test_loader, lossFn, task='binary_classification', check_cancelled=None):
         # choose get all multiclass or binary metrics function
         if task == 'binary_classification':
-            return EvalFns.get_all_binary_metrics(model, test_loader, lossFn)
+            return EvalFns.get_all_binary_metrics(model, test_loader, lossFn, check_cancelled)
         else:
-            return EvalFns.get_all_multiclass_metrics(model, test_loader, lossFn)
+            return EvalFns.get_all_multiclass_metrics(model, test_loader, lossFn, check_cancelled)
 
     @staticmethod
-    def get_all_multiclass_metrics(model, test_loader, lossFn):
-        model.eval()
-        all_preds = []
-        all_labels = []
-        
-        with torch.no_grad():
-            for inputs, labels in test_loader:
-                inputs = inputs.to(device)
-                labels = labels.to(device)
-                
-                outputs = model(inputs)
-                preds = torch.argmax(outputs, dim=1)
-                
-                all_preds.extend(preds.cpu().numpy())
-                all_labels.extend(labels.cpu().numpy())
-        output_metrics = {}
-
-        # we average the standard metrics over all classes
-        accuracy = accuracy_score(all_labels, all_preds)
-        output_metrics['accuracy_metric'] = float('%.3f' % (accuracy * 100))
-        precision, recall, f1, _ = precision_recall_fscore_support(
-            all_labels, all_preds, average='macro', zero_division=0.0
-        )
-        output_metrics['f1_score_metric'] = float('%.3f' % f1)
-        output_metrics['precision_metric'] = float('%.3f' % precision)
-        output_metrics['recall_metric'] = float('%.3f' % recall)
-        # output_metrics['confusion_matrix'] = confusion_matrix(all_labels, all_preds).tolist()
-        return output_metrics
+    def get_predictions(outputs, labels, lossFn, task='binary_classification'):
+        '''
+        Turns model outputs into class predictions, and labels into 0..n-1 class indices
+        '''
+        if task != 'binary_classification':
+            return torch.argmax(outputs, dim=1), labels
+
+        if (lossFn == 'bce'):
+            preds = (outputs > 0.5).long()  # For binary classification, use a 0.5 threshold
+        elif (lossFn == 'hinge_loss'):
+            # models trained on hinge loss outputs between -1 and 1, however metrics for binary classification require 0 and 1
+            preds = (outputs > 0).long()  # For hinge loss, use 0 threshold
+            # models using hinge loss have labels -1 or 1
+            labels = ((labels+1)//2).long()  # Convert labels to 0 and 1
+        else:
+            preds = (outputs > 0).long()  # For binary classification, use a 0.5 threshold
+        return preds, labels
 
     @staticmethod
-    def get_all_binary_metrics(model, test_loader, lossFn):
-
+    def get_confusion_matrix(model, test_loader, lossFn, task='binary_classification', check_cancelled=None):
+        '''
+        Single pass over the test loader in inference mode, accumulating a ConfusionMatrix batch by batch.
+        check_cancelled is called before every batch, it raises JobCancelled to abandon the pass
+        '''
         model.eval()
-        all_preds = []
-        all_labels = []
-        
-        with torch.no_grad():
+        confusion = ConfusionMatrix()
+
+        with torch.inference_mode():
             for inputs, labels in test_loader:
+                if check_cancelled:
+                    check_cancelled()
                 inputs = inputs.to(device)
                 labels = labels.to(device)
-                
-                outputs = model(inputs)
-                preds = None
-
-                if (lossFn == 'bce'):
-                    preds = (outputs > 0.5).long()  # For binary classification, use a 0.5 threshold
-                elif (lossFn == 'hinge_loss'):
-                    # models trained on hinge loss outputs between -1 and 1, however metrics for binary classification require 0 and 1
-                    preds = (outputs > 0).long()  # For hinge loss, use 0 threshold
-                    # models using hinge loss have labels -1 or 1
-                    labels = ((labels+1)//2).long()  # Convert labels to 0 and 1
-                else:
-                    preds = (outputs > 0).long()  # For binary classification, use a 0.5 threshold
-                
 
-                all_preds.extend(preds.cpu().numpy())
-                all_labels.extend(labels.cpu().numpy())
-        
-        # calculate accuraacy manually
-        accuracy = sum([1 for i in range(len(all_preds)) if all_preds[i] == all_labels[i]]) / len(all_preds)
-        logging.info(f"Accuracy: {accuracy}")
-
-        output_metrics = {}
-        output_metrics['f1_score_metric'] = float('%.3f'%(f1_score(all_labels, all_preds, zero_division=0.0)))
-        output_metrics['precision_metric'] = float('%.3f'%(precision_score(all_labels, all_preds, zero_division=0.0)))
-        output_metrics['recall_metric'] = float('%.3f'%(recall_score(all_labels, all_preds, zero_division=0.0))) # True positive rate
-        output_metrics['accuracy_metric'] = float('%.3f'%(accuracy_score(all_labels, all_preds)))
-        # output_metrics['confusion_matrix_metric'] = confusion_matrix(all_labels, all_preds)
-        
-        # get false positive
-        false_positive = np.sum((all_labels == 1) & (all_preds == 0))
-        true_negative = np.sum((all_labels == 0) & (all_preds == 0))
+                outputs = model(inputs)
+                preds, labels = EvalFns.get_predictions(outputs, labels, lossFn, task)
+                confusion.update(preds, labels)
+        return confusion
 
-        # Compute False Positive Rate (FPR)
-        false_positive_rate = false_positive / (false_positive + true_negative) if (false_positive + true_negative) > 0 else 0
-        output_metrics['false_positive_metric'] = false_positive_rate
+    @staticmethod
+    def get_all_multiclass_metrics(model, test_loader, lossFn, check_cancelled=None):
+        confusion = EvalFns.get_confusion_matrix(model, test_loader, lossFn, 'multiclass_classification', check_cancelled)
+        return confusion.multiclass_metrics()
 
+    @staticmethod
+    def get_all_binary_metrics(model, test_loader, lossFn, check_cancelled=None):
+        confusion = EvalFns.get_confusion_matrix(model, test_loader, lossFn, 'binary_classification', check_cancelled)
+        output_metrics = confusion.binary_metrics()
+        logging.info(f"Accuracy: {output_metrics['accuracy_metric']}")
         return output_metrics
 
 class BinaryHingeLoss(nn.Module):
@@ -288,10 +461,29 @@ class BinaryHingeLoss(nn.Module):
   def forward(self, inputs, targets):
     return torch.mean(torch.clamp(1 - inputs * targets, min=0))
 
+class SparseLinear(nn.Linear):
+    '''
+    nn.Linear that also accepts sparse COO input, using a sparse x dense matmul instead of densifying the batch
+    '''
+    def forward(self, input):
+        if input.is_sparse:
+            output = torch.sparse.mm(input, self.weight.t())
+            if self.bias is not None:
+                output = output + self.bias
+            return output
+        return nn.functional.linear(input, self.weight, self.bias)
+
+class Densify(nn.Module):
+    '''
+    Converts sparse input to dense, used when the first layer of a model can't consume sparse tensors
+    '''
+    def forward(self, input):
+        return input.to_dense() if input.is_sparse else input
+
 class Diagram():
     moduleDict = {
         'flatten_layer': nn.Flatten,
-        'linear_layer': nn.Linear,
+        'linear_layer': SparseLinear,
         'relu_activation': nn.ReLU,
         'sigmoid_activation': nn.Sigmoid,
         'dropout_layer': nn.Dropout,
@@ -339,6 +531,18 @@ class Diagram():
         self.callback_url = callback_url
         self.user_id = user_id
         self.task = task
+        # updates are sent from a background thread, see ProgressReporter
+        self.reporter = ProgressReporter(callback_url) if callback_url else None
+        # model construction, train and evaluation timings, reported with the job
+        self.timings = {}
+        self.seed = None
+        self.architecture = None
+        # every update sent, replayed by the result cache for identical seeded jobs
+        self.history = []
+        # set when the user stopped training early, the result is incomplete
+        self.stopped = False
+        # raises JobCancelled once POST /jobs/{job_id}/cancel was called, checked before every batch
+        self.check_cancelled = cancellation_flags.checker(job_id)
 
     def digest_diagram_object(self, req):
         '''
@@ -378,6 +582,7 @@ class Diagram():
         self.loss_fn = self.lossFnDict[req.loss_fn]()
         self.evalfns = req.evalFns
         self.epochs = req.epochs
+        self.seed = req.seed
 
     def create_model_from_inputs(self):
         '''
@@ -387,45 +592,75 @@ class Diagram():
         if not self.model_updated:
             return
 
+        if self.seed is not None:
+            # the initial weights and then the batch order are drawn from the global RNG
+            torch.manual_seed(self.seed)
+
         last_linear_layer_order = max([block.order for block in self.blocks if block.block_id == 'linear_layer'])
+        for block in self.blocks:
+            # make last layer match the desired output size, which is based on the dataset
+            if "out_features" in block.params and block.order == last_linear_layer_order:
+                block.params['out_features'] = self.output_shape
+
+        # sparse batches can only be fed straight into a linear layer
+        densify = getattr(self.train_loader, 'sparse', False) and self.blocks[0].block_id != 'linear_layer'
+
+        # architectures repeat a lot between jobs, copy a cached template instead of building it again
+        key = architecture_key(self.blocks, self.input_shape, self.output_shape, densify)
+        self.architecture = key
+        model, timings = model_cache.get(key, lambda: self.build_model(densify))
+        self.timings.update(timings)
+        self.model = model
+        self.model = self.model.to(device)
+        self.model_updated = False
+
+    def build_model(self, densify=False):
+        '''
+        Builds the nn.Sequential described by self.blocks
+        '''
         model = nn.Sequential()
+        if densify:
+            model.add_module('densify', Densify())
         # do we want output shape to be enforced
         in_size = self.input_shape
-        for block in self.blocks:
+        # modules are named by position, not by block.order: architecture_key leaves the order out, so names (and the
+        # state_dict keys of stored weights and checkpoints) must only depend on what the key describes
+        for position, block in enumerate(self.blocks, start=1):
+            name = block.block_id + str(position)
             # if there are out_features, there must also be in_features to specify. Otherwise, we probably don't need either (i.e. in case of activation fcn)
             if "out_features" in block.params:
-                # make last layer match the desired output size, which is based on the dataset
-                if block.order == last_linear_layer_order:
-                    block.params['out_features'] = self.output_shape
-                model.add_module(block.block_id + str(block.order), self.moduleDict[block.block_id](in_features=in_size, **block.params))
+                model.add_module(name, self.moduleDict[block.block_id](in_features=in_size, **block.params))
                 in_size = block.params.get("out_features", in_size)
             else:
-                model.add_module(block.block_id + str(block.order), self.moduleDict[block.block_id](**block.params))
-        self.model = model
-        self.model = self.model.to(device)
-        self.model_updated = False
+                model.add_module(name, self.moduleDict[block.block_id](**block.params))
+        return model
 
     def execute(self, return_metrics=False):
         '''
         Train or evaluate model based on execution
         '''
         logger.info(f"Executing model with execution type: {self.execution}")
-        if self.execution == "train":
-            self.train()
-            return self.evaluate()
-        elif self.execution == "eval":
-            return self.evaluate()
-        else:
-            raise Exception("Invalid execution type")
+        try:
+            if self.execution == "train":
+                start = time.perf_counter()
+                self.train()
+                self.timings["train"] = time.perf_counter() - start
+            elif self.execution != "eval":
+                raise Exception("Invalid execution type")
+            start = time.perf_counter()
+            metrics = self.evaluate()
+            self.timings["evaluate"] = time.perf_counter() - start
+            return metrics
+        finally:
+            # make sure the result/error updates are delivered before the job ends
+            if self.reporter:
+                self.reporter.close()
 
     def post_update(self, data: Dict):
-        '''Function to send updates'''
-        try:
-            response = requests.post(self.callback_url, json=data)
-            logging.info(f"Published training update, received: {response}")
-            return response
-        except Exception as e:
-            logging.info(f"Failed to send update: {e}")
+        '''Function to send updates. Queues the update on the background reporter and returns immediately'''
+        self.history.append({key: value for key, value in data.items() if key not in ("job_id", "user_id")})
+        if self.reporter:
+            self.reporter.report(data)
 
     def train(self):
         '''
@@ -433,11 +668,15 @@ class Diagram():
         '''
         self.model.train()
         optimizer = self.optimizerDict[self.optimizer_name](self.model.parameters(), lr=self.lr)
+        # a job run again after its instance went away (recovered from the job ledger) continues from its last checkpoint
+        start_epoch = self.resume(optimizer)
+        last_checkpoint = time.monotonic()
         
         try:
-            for epoch in range(self.epochs):
+            for epoch in range(start_epoch, self.epochs):
                 running_loss = 0.0
                 for data, labels in self.train_loader:
+                    self.check_cancelled()
                     optimizer.zero_grad()
 
                     outputs = self.model(data)
@@ -468,15 +707,74 @@ class Diagram():
                         "job_id": self.job_id,
                         "user_id": self.user_id
                     }
-                    response = self.post_update(update_data)
-                    if response.json().get("stop_training", False):
+                    self.post_update(update_data)
+                    # flag set by the reporter from the latest response, checking it never blocks the loop
+                    if self.reporter.stop_training:
                         logging.info("Training stopped by user") # should we raise an interrupt exception here?
+                        self.stopped = True
                         break
-                    logging.info(f"Published training update, received: {response}")
+
+                if (checkpoint_store and epoch + 1 < self.epochs
+                        and time.monotonic() - last_checkpoint >= checkpoint_store.interval):
+                    self.save_checkpoint(optimizer, epoch + 1)
+                    last_checkpoint = time.monotonic()
         
+        except JobCancelled:
+            # the user moved on, nobody is waiting for an error message
+            raise
         except Exception as e:
             self.errorHandler(e)
             raise e
+
+    def save_checkpoint(self, optimizer, epochs_done):
+        '''
+        Everything train() needs to continue after epochs_done epochs as if it never stopped: weights, optimizer state,
+        the RNG states that drive dropout and the batch order, and the updates sent so far
+        '''
+        generator = getattr(self.train_loader, "generator", None)
+        checkpoint_store.save(self.job_id, {
+            "architecture": architecture_hash(self.architecture),
+            "epoch": epochs_done,
+            "model": unwrap(self.model).state_dict(),
+            "optimizer": optimizer.state_dict(),
+            "rng": torch.get_rng_state(),
+            "cuda_rng": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+            "generator": generator.get_state() if generator is not None else None,
+            "history": self.history,
+        })
+
+    def resume(self, optimizer):
+        '''
+        Restores the job's checkpoint if it has one for this model. Returns the epoch to start from
+        '''
+        checkpoint = checkpoint_store.load(self.job_id) if checkpoint_store else None
+        if checkpoint is None:
+            return 0
+        if checkpoint["architecture"] != architecture_hash(self.architecture) or checkpoint["epoch"] >= self.epochs:
+            logger.info(f"Ignoring checkpoint of job {self.job_id}, it doesn't match the diagram")
+            return 0
+        try:
+            # checked before loading, load_state_dict copies the matching tensors before it raises on the others
+            if not fits(self.model, checkpoint["model"]):
+                raise RuntimeError("state_dict keys or shapes differ")
+            # the optimizer first, it validates its param groups before changing anything
+            optimizer.load_state_dict(checkpoint["optimizer"])
+            unwrap(self.model).load_state_dict(checkpoint["model"])
+        except (RuntimeError, ValueError) as e:
+            # written by a model whose modules were named differently, e.g. before they were named by position
+            logger.error(f"Discarding checkpoint of job {self.job_id}, it doesn't fit the model: {e}")
+            checkpoint_store.delete(self.job_id)
+            return 0
+        torch.set_rng_state(checkpoint["rng"])
+        if checkpoint["cuda_rng"] is not None and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(checkpoint["cuda_rng"])
+        generator = getattr(self.train_loader, "generator", None)
+        if generator is not None and checkpoint["generator"] is not None:
+            generator.set_state(checkpoint["generator"])
+        self.history = list(checkpoint["history"])
+        self.timings["resumed_from_epoch"] = checkpoint["epoch"]
+        logger.info(f"Resuming job {self.job_id} from epoch {checkpoint['epoch']}")
+        return checkpoint["epoch"]
     
     
     def evaluate(self):
@@ -484,7 +782,9 @@ class Diagram():
         
         logger.info('Evaluating model')
         try:
-            return_metrics = EvalFns.get_all_metrics(self.model, self.test_loader, self.loss_fn_string, self.task)
+            return_metrics = EvalFns.get_all_metrics(self.model, self.test_loader, self.loss_fn_string, self.task, self.check_cancelled)
+        except JobCancelled:
+            raise
         except Exception as e:
             logger.info('Error evaluating model')
             self.errorHandler(e)
@@ -496,14 +796,13 @@ class Diagram():
         
         if self.callback_url:
             logging.info(f"Sending evaluation update: {return_metrics}")
-            response = requests.post(self.callback_url, json={
+            self.post_update({
                 "message": "Evaluation complete",
                 "update_type": "result",
                 "metrics": return_metrics,
                 "job_id": self.job_id,
                 "user_id": self.user_id
             })
-            logging.info(f"Published evaluation update, received: {response}")
         
         return return_metrics
     
@@ -541,67 +840,3 @@ class Diagram():
             logging.info(f"Unknown error caught!: {errMessage}")
 
         self.post_update(update_data)
-
-def download_dataset(datasets_path, dataset_name):
-    '''
-    This function looks at datasets_path / dataset_name and sees if the folder already exists (it has been downloaded)
-    If not, it will retrieve and download all the items in the folder /dataset_name/ in the gcs bucket to local
-    '''
-    logging.info(f"Starting download for dataset: {dataset_name}")
-    
-    BUCKET_NAME = "myai-datasets-bucket"
-    dataset_folder = datasets_path / dataset_name
-
-    # Check if entire dataset folder already exists
-    if dataset_folder.exists():
-        logging.info(f"Dataset {dataset_name} already exists at {dataset_folder}. Skipping download.")
-        return
-    
-    try:
-        # Initialize GCS client
-        client = storage.Client()
-        bucket = client.bucket(BUCKET_NAME)
-        
-        # List only blobs in the specified dataset folder
-        blobs = bucket.list_blobs(prefix=f"{dataset_name}/")
-        
-        # Track if we found any files
-        files_found = False
-        
-        # Download each file in the dataset folder
-        for blob in blobs:
-            # Skip if the blob is a directory marker
-            if blob.name.endswith('/'):
-                continue
-                
-            files_found = True
-            
-            # Create the full local path maintaining the bucket structure
-            local_file_path = datasets_path / blob.name
-            
-            # Ensure parent directory exists
-            local_file_path.parent.mkdir(parents=True, exist_ok=True)
-            
-            logging.info(f"Downloading {blob.name} to {str(local_file_path)}")
-            
-            try:
-                blob.download_to_filename(str(local_file_path))
-                logging.info(f"Successfully downloaded {blob.name}")
-            except Exception as e:
-                logging.error(f"Error downloading {blob.name}: {str(e)}")
-                # If any file fails to download, cleanup the partial dataset
-                if dataset_folder.exists():
-                    import shutil
-                    shutil.rmtree(dataset_folder)
-                raise  # Re-raise the exception to indicate failure
-        
-        if not files_found:
-            logging.warning(f"No files found in dataset folder: {dataset_name}")
-            raise ValueError(f"Dataset {dataset_name} not found in bucket")
-            
-        logging.info(f"Download complete for dataset: {dataset_name}")
-    
-    except Exception as e:
-        logging.error(f"Error during dataset download: {str(e)}")
-        raise
-
@@ -0,0 +1,72 @@
+import sys
+import pytest
+import torch
+from torch import nn
+from types import SimpleNamespace
+from src.utils.utils import EvalFns
+from src.utils.job_ledger import SQLiteJobLedger
+from src.utils.cancellation import JobCancelled, CancellationFlags, FileCancellationFlags, LedgerCancellationFlags
+
+
+@pytest.fixture(params=["file", "ledger"])
+def make_flags(request, tmp_path):
+    def make(interval=0):
+        if request.param == "file":
+            return FileCancellationFlags(tmp_path / "flags", interval=interval)
+        ledger = SQLiteJobLedger(tmp_path / "ledger.db")
+        ledger.claim("job", "owner")
+        return LedgerCancellationFlags(ledger, interval=interval)
+    return make
+
+
+class CancellingLoader:
+    '''
+    Batches of a binary task, the job is cancelled once cancel_after of them were handed out. Counts how many were
+    '''
+    def __init__(self, flags, cancel_after, batches=5):
+        self.flags = flags
+        self.cancel_after = cancel_after
+        self.batches = batches
+        self.consumed = 0
+
+    def __iter__(self):
+        for _ in range(self.batches):
+            if self.consumed == self.cancel_after:
+                self.flags.cancel("job")
+            self.consumed += 1
+            yield torch.randn(4, 3), torch.randint(0, 2, (4, 1))
+
+
+def test_checker_raises_once_the_job_is_cancelled(make_flags):
+    flags = make_flags()
+    check = flags.checker("job")
+    check()
+    flags.cancel("job")
+    assert flags.is_cancelled("job")
+    with pytest.raises(JobCancelled):
+        check()
+
+
+def test_checker_reads_the_flag_at_most_every_interval(make_flags, monkeypatch):
+    clock = SimpleNamespace(now=100.0)
+    monkeypatch.setattr(sys.modules[CancellationFlags.__module__], "time", SimpleNamespace(monotonic=lambda: clock.now, time=lambda: clock.now))
+    flags = make_flags(interval=1)
+    check = flags.checker("job")
+    flags.cancel("job")
+    # within the interval of the checker's creation, the flag isn't read
+    clock.now += 0.5
+    check()
+    clock.now += 0.6
+    with pytest.raises(JobCancelled):
+        check()
+
+
+def test_evaluation_stops_at_the_batch_after_the_cancel(make_flags):
+    flags = make_flags()
+    loader = CancellingLoader(flags, cancel_after=2)
+    model = nn.Sequential(nn.Linear(3, 1), nn.Sigmoid())
+
+    with pytest.raises(JobCancelled):
+        EvalFns.get_confusion_matrix(model, loader, "bce", check_cancelled=flags.checker("job"))
+    # the third batch is the first one checked after the cancel, the rest of the pass is skipped
+    assert loader.consumed == 3
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+import torch
+from sklearn.metrics import accuracy_score, confusion_matrix, precision_recall_fscore_support
+from src.utils.utils import ConfusionMatrix
+
+
+def random_labels(num_classes, size, seed):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, num_classes, size), rng.integers(0, num_classes, size)
+
+
+@pytest.mark.parametrize("num_classes", [2, 3, 7])
+@pytest.mark.parametrize("seed", range(5))
+def test_counts_and_per_class_metrics_match_sklearn(num_classes, seed):
+    labels, preds = random_labels(num_classes, 500, seed)
+    matrix = ConfusionMatrix(num_classes)
+    # folded in over uneven batches, like the evaluation loop does
+    for start in range(0, len(labels), 64):
+        matrix.update(torch.from_numpy(preds[start:start + 64]), torch.from_numpy(labels[start:start + 64]))
+
+    expected = confusion_matrix(labels, preds, labels=list(range(num_classes)))
+    np.testing.assert_array_equal(matrix.counts.numpy(), expected)
+
+    precision, recall, f1 = matrix.per_class()
+    sk_precision, sk_recall, sk_f1, _ = precision_recall_fscore_support(
+        labels, preds, labels=list(range(num_classes)), zero_division=0.0
+    )
+    np.testing.assert_allclose(precision.numpy(), sk_precision)
+    np.testing.assert_allclose(recall.numpy(), sk_recall)
+    np.testing.assert_allclose(f1.numpy(), sk_f1)
+    assert matrix.accuracy() == pytest.approx(accuracy_score(labels, preds))
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_binary_metrics_match_sklearn(seed):
+    labels, preds = random_labels(2, 300, seed)
+    matrix = ConfusionMatrix(2)
+    matrix.update(torch.from_numpy(preds), torch.from_numpy(labels))
+
+    metrics = matrix.binary_metrics()
+    precision, recall, f1, _ = precision_recall_fscore_support(labels, preds, average="binary", zero_division=0.0)
+    assert metrics["precision_metric"] == pytest.approx(precision, abs=5e-4)
+    assert metrics["recall_metric"] == pytest.approx(recall, abs=5e-4)
+    assert metrics["f1_score_metric"] == pytest.approx(f1, abs=5e-4)
+    assert metrics["accuracy_metric"] == pytest.approx(accuracy_score(labels, preds), abs=5e-4)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_multiclass_metrics_match_sklearn_macro_average(seed):
+    # class 4 never occurs, sklearn's macro average only covers the classes present in labels or predictions
+    labels, preds = random_labels(4, 300, seed)
+    matrix = ConfusionMatrix(5)
+    matrix.update(torch.from_numpy(preds), torch.from_numpy(labels))
+
+    metrics = matrix.multiclass_metrics()
+    precision, recall, f1, _ = precision_recall_fscore_support(labels, preds, average="macro", zero_division=0.0)
+    assert metrics["precision_metric"] == pytest.approx(precision, abs=5e-4)
+    assert metrics["recall_metric"] == pytest.approx(recall, abs=5e-4)
+    assert metrics["f1_score_metric"] == pytest.approx(f1, abs=5e-4)
+    # reported as a percentage
+    assert metrics["accuracy_metric"] == pytest.approx(accuracy_score(labels, preds) * 100, abs=5e-4)
+
+
+def test_grows_when_a_batch_has_more_classes():
+    labels, preds = random_labels(6, 200, 0)
+    matrix = ConfusionMatrix(2)
+    matrix.update(torch.from_numpy(preds), torch.from_numpy(labels))
+    assert matrix.num_classes == 6
+    np.testing.assert_array_equal(matrix.counts.numpy(), confusion_matrix(labels, preds, labels=list(range(6))))
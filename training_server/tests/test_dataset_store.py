@@ -0,0 +1,80 @@
+import os
+import pytest
+from src.utils.dataset_store import LocalBucket, dataset_version, download_dataset, read_manifest, verify_dataset
+
+
+class CorruptingBucket(LocalBucket):
+    '''
+    Serves the listing of the real files, but downloads of corrupt_name get the same number of bytes of other content
+    '''
+    def __init__(self, root, corrupt_name):
+        super().__init__(root)
+        self.corrupt_name = corrupt_name
+
+    def download(self, name, local_path):
+        super().download(name, local_path)
+        if name == self.corrupt_name:
+            size = os.path.getsize(local_path)
+            with open(local_path, "wb") as f:
+                f.write(b"x" * size)
+
+
+@pytest.fixture
+def bucket_root(tmp_path):
+    root = tmp_path / "bucket"
+    (root / "toy").mkdir(parents=True)
+    (root / "toy" / "toy.csv").write_text("a,b\n1,2\n")
+    (root / "toy" / "labels.txt").write_text("yes\nno\n")
+    return root
+
+
+def test_sync_verifies_checksums(tmp_path, bucket_root):
+    datasets = tmp_path / "datasets"
+    with pytest.raises(IOError, match="Checksum mismatch for toy/toy.csv"):
+        download_dataset(datasets, "toy", bucket=CorruptingBucket(bucket_root, "toy/toy.csv"), max_age=0)
+    # nothing half downloaded is left behind or visible
+    assert not (datasets / "toy").exists()
+    assert list((datasets / ".versions" / "toy").iterdir()) == []
+
+    assert download_dataset(datasets, "toy", bucket=LocalBucket(bucket_root), max_age=0)
+    assert (datasets / "toy").is_symlink()
+    assert verify_dataset(datasets, "toy") == []
+    assert sorted(read_manifest(datasets / "toy")["files"]) == ["labels.txt", "toy.csv"]
+
+
+def test_failed_sync_keeps_the_current_version(tmp_path, bucket_root):
+    datasets = tmp_path / "datasets"
+    download_dataset(datasets, "toy", bucket=LocalBucket(bucket_root), max_age=0)
+    version = dataset_version(datasets / "toy")
+    target = os.readlink(datasets / "toy")
+
+    (bucket_root / "toy" / "toy.csv").write_text("a,b\n3,4\n")
+    with pytest.raises(IOError, match="Checksum mismatch"):
+        download_dataset(datasets, "toy", bucket=CorruptingBucket(bucket_root, "toy/toy.csv"), max_age=0)
+    assert os.readlink(datasets / "toy") == target
+    assert dataset_version(datasets / "toy") == version
+    assert (datasets / "toy" / "toy.csv").read_text() == "a,b\n1,2\n"
+
+
+def test_changed_files_swap_in_a_new_version(tmp_path, bucket_root):
+    datasets = tmp_path / "datasets"
+    download_dataset(datasets, "toy", bucket=LocalBucket(bucket_root), max_age=0)
+    version = dataset_version(datasets / "toy")
+    assert not download_dataset(datasets, "toy", bucket=LocalBucket(bucket_root), max_age=0)
+
+    (bucket_root / "toy" / "toy.csv").write_text("a,b\n3,4\n")
+    assert download_dataset(datasets, "toy", bucket=LocalBucket(bucket_root), max_age=0)
+    assert dataset_version(datasets / "toy") != version
+    assert (datasets / "toy" / "toy.csv").read_text() == "a,b\n3,4\n"
+    # the unchanged file is carried over as a hard link, the previous version is kept for readers still using it
+    assert (datasets / "toy" / "labels.txt").stat().st_nlink == 2
+    assert len(list((datasets / ".versions" / "toy").iterdir())) == 2
+
+
+def test_plain_folder_is_moved_into_the_versions(tmp_path, bucket_root):
+    datasets = tmp_path / "datasets"
+    (datasets / "toy").mkdir(parents=True)
+    (datasets / "toy" / "toy.csv").write_text("old\n")
+    assert download_dataset(datasets, "toy", bucket=LocalBucket(bucket_root), max_age=0)
+    assert (datasets / "toy").is_symlink()
+    assert verify_dataset(datasets, "toy") == []
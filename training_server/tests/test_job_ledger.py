@@ -0,0 +1,111 @@
+import sys
+import time
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from src.utils.job_ledger import InMemoryJobLedger, SQLiteJobLedger
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def make_ledger(request, tmp_path):
+    def make(**kwargs):
+        if request.param == "memory":
+            return InMemoryJobLedger(**kwargs)
+        # a new instance per call, like separate processes sharing the file
+        return SQLiteJobLedger(tmp_path / "ledger.db", **kwargs)
+    return make
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # leases expire on this clock instead of after real sleeps
+    clock = SimpleNamespace(now=time.time())
+    # the package exports the job_ledger instance under the module's name
+    monkeypatch.setattr(sys.modules[InMemoryJobLedger.__module__], "time", SimpleNamespace(time=lambda: clock.now))
+    return clock
+
+
+def run_concurrently(fn, count):
+    with ThreadPoolExecutor(max_workers=count) as pool:
+        return list(pool.map(fn, range(count)))
+
+
+def test_concurrent_claims_have_one_winner(make_ledger):
+    ledger = make_ledger()
+    results = run_concurrently(lambda i: ledger.claim("job", f"owner-{i}", payload={"i": i}), 16)
+
+    winners = [entry for claimed, entry in results if claimed]
+    assert len(winners) == 1
+    owner = winners[0]["owner"]
+    # every loser is answered with the winner's entry
+    assert all(entry["owner"] == owner and entry["state"] == "running" for claimed, entry in results if not claimed)
+    assert ledger.get("job")["attempts"] == 1
+
+
+def test_finish_only_by_owner(make_ledger):
+    ledger = make_ledger()
+    ledger.claim("job", "a")
+    ledger.finish("job", "b", "done", result={"accuracy": 0.5})
+    assert ledger.get("job")["state"] == "running"
+
+    ledger.finish("job", "a", "done", result={"accuracy": 0.9})
+    entry = ledger.get("job")
+    assert (entry["state"], entry["result"], entry["payload"]) == ("done", {"accuracy": 0.9}, None)
+    assert ledger.claim("job", "b") == (False, entry)
+
+
+def test_failed_jobs_can_be_claimed_again(make_ledger):
+    ledger = make_ledger()
+    ledger.claim("job", "a")
+    ledger.finish("job", "a", "error", error="boom")
+    claimed, entry = ledger.claim("job", "b")
+    assert claimed and entry["attempts"] == 2 and entry["error"] is None
+
+
+def test_expired_claims_are_recovered_once(make_ledger, clock):
+    ledger = make_ledger(lease=60, max_attempts=2)
+    ledger.claim("job", "a", payload={"job_id": "job"})
+    ledger.claim("renewed", "a", payload={"job_id": "renewed"})
+    clock.now += 90
+    ledger.renew(["renewed"], "a")
+
+    recovered = run_concurrently(lambda i: ledger.recover(f"owner-{i}"), 8)
+    entries = [entry for entries in recovered for entry in entries]
+    assert [(entry["job_id"], entry["attempts"], entry["payload"]) for entry in entries] == [("job", 2, {"job_id": "job"})]
+    # the old owner's late result loses against the new owner
+    ledger.finish("job", "a", "done")
+    assert ledger.get("job")["owner"] == entries[0]["owner"]
+
+    clock.now += 90
+    ledger.renew(["renewed"], "a")
+    assert ledger.recover("c") == []
+    entry = ledger.get("job")
+    assert entry["state"] == "error" and entry["error"] == "Abandoned after 2 attempts"
+
+
+def test_cancel_flags(make_ledger):
+    ledger = make_ledger()
+    ledger.claim("running", "a")
+    assert ledger.cancel("running") == "running"
+    assert ledger.is_cancelled("running")
+    ledger.finish("running", "a", "cancelled")
+    assert ledger.get("running")["cancelled"]
+
+    # cancelled before its delivery, the delivery is a duplicate
+    assert ledger.cancel("later") == "cancelled"
+    claimed, entry = ledger.claim("later", "a")
+    assert not claimed and entry["state"] == "cancelled"
+
+    ledger.claim("done", "a")
+    ledger.finish("done", "a", "done")
+    assert ledger.cancel("done") == "done"
+    assert not ledger.is_cancelled("done")
+
+
+def test_sqlite_instances_share_the_file(tmp_path):
+    first = SQLiteJobLedger(tmp_path / "ledger.db")
+    second = SQLiteJobLedger(tmp_path / "ledger.db")
+    assert first.claim("job", "a")[0]
+    assert not second.claim("job", "b")[0]
+    second.cancel("job")
+    assert first.is_cancelled("job")
@@ -0,0 +1,74 @@
+import threading
+from src.utils.reporter import ProgressReporter
+
+
+class RecordingReporter(ProgressReporter):
+    '''
+    Records the updates instead of posting them. The first send blocks until release() so updates pile up behind it
+    '''
+    def __init__(self):
+        self.sent_updates = []
+        self.sending = threading.Event()
+        self.released = threading.Event()
+        super().__init__("http://client/updates", transport="http")
+
+    def release(self):
+        self.released.set()
+
+    def _send(self, data):
+        self.sending.set()
+        self.released.wait(10)
+        self.sent_updates.append(data)
+
+
+def progress(epoch):
+    return {"update_type": "progress", "epoch": epoch}
+
+
+def test_progress_is_coalesced_and_results_keep_their_order():
+    reporter = RecordingReporter()
+    reporter.report(progress(1))
+    # the background thread is sending epoch 1, everything below waits behind it
+    assert reporter.sending.wait(10)
+    reporter.report(progress(2))
+    reporter.report(progress(3))
+    reporter.report({"update_type": "result", "accuracy": 0.5})
+    reporter.report(progress(4))
+    reporter.report({"update_type": "error", "message": "boom"})
+    reporter.release()
+    reporter.close()
+
+    assert reporter.sent_updates == [
+        progress(1),
+        progress(3),
+        {"update_type": "result", "accuracy": 0.5},
+        progress(4),
+        {"update_type": "error", "message": "boom"},
+    ]
+    assert reporter.coalesced == 1
+    assert reporter.stats()["pending"] == 0
+
+
+def test_coalesce_false_keeps_every_progress_update():
+    reporter = RecordingReporter()
+    reporter.report(progress(1))
+    assert reporter.sending.wait(10)
+    for epoch in range(2, 5):
+        reporter.report(progress(epoch), coalesce=False)
+    reporter.release()
+    reporter.close()
+
+    assert reporter.sent_updates == [progress(epoch) for epoch in range(1, 5)]
+    assert reporter.coalesced == 0
+
+
+def test_report_after_close_is_sent_right_away():
+    reporter = RecordingReporter()
+    reporter.release()
+    reporter.report(progress(1))
+    reporter.close()
+    assert not reporter._thread.is_alive()
+
+    reporter.report({"update_type": "error", "message": "late"})
+    assert reporter.sent_updates == [progress(1), {"update_type": "error", "message": "late"}]
+    assert reporter.stats()["pending"] == 0
@@ -0,0 +1,75 @@
+import os
+import json
+from src.utils.utils import DiagramRequest
+from src.utils.result_cache import ResultCache, canonical_diagram, result_key
+
+
+def make_diagram(blocks, **fields):
+    return DiagramRequest(**{
+        "blocks": [{"block_id": block_id, "order": order, "params": params} for block_id, order, params in blocks],
+        "execution": "train",
+        "dataset": "mushrooms",
+        "optimizer": "adam_algorithm",
+        "loss_fn": "bce",
+        "evalFns": ["accuracy"],
+        "lr": 0.01,
+        "epochs": 2,
+        **fields,
+    })
+
+
+BLOCKS = [
+    ("linear_layer", 1, {"out_features": 16}),
+    ("relu_activation", 2, {}),
+    ("linear_layer", 3, {"out_features": 1}),
+    ("sigmoid_activation", 4, {}),
+]
+
+
+def test_renumbered_blocks_have_the_same_key():
+    renumbered = [(block_id, order * 10 + 5, params) for block_id, order, params in reversed(BLOCKS)]
+    assert canonical_diagram(make_diagram(renumbered)) == canonical_diagram(make_diagram(BLOCKS))
+
+
+def test_last_linear_out_features_and_seed_are_ignored():
+    resized = [(block_id, order, {"out_features": 7} if order == 3 else params) for block_id, order, params in BLOCKS]
+    assert canonical_diagram(make_diagram(resized, seed=3)) == canonical_diagram(make_diagram(BLOCKS))
+    # the seed is part of the key on its own
+    assert result_key(make_diagram(BLOCKS), "mushrooms", "v1", 3) != result_key(make_diagram(BLOCKS), "mushrooms", "v1", 4)
+
+
+def test_hidden_out_features_change_the_key():
+    wider = [(block_id, order, {"out_features": 32} if order == 1 else params) for block_id, order, params in BLOCKS]
+    assert canonical_diagram(make_diagram(wider)) != canonical_diagram(make_diagram(BLOCKS))
+
+
+def test_round_trip_and_least_recently_used_eviction(tmp_path):
+    cache = ResultCache(tmp_path, max_entries=2)
+    for i, key in enumerate(["a", "b"]):
+        cache.put(key, [{"update_type": "progress", "epoch": 1}], {"accuracy": i}, seconds=2.0)
+        # distinct modification times, oldest first
+        os.utime(tmp_path / f"{key}.json", (1000 + i, 1000 + i))
+
+    record = cache.get("a")
+    assert record["metrics"] == {"accuracy": 0}
+    assert record["updates"] == [{"update_type": "progress", "epoch": 1}]
+    # "a" was just read, "b" is the least recently used one
+    cache.put("c", [], {"accuracy": 2}, seconds=1.0)
+
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+    assert cache.stats()["hits"] == 3 and cache.stats()["misses"] == 1
+    assert cache.stats()["seconds_saved"] == 5.0
+
+
+def test_incomplete_records(tmp_path):
+    cache = ResultCache(tmp_path)
+    (tmp_path / "old.json").write_text(json.dumps({"updates": [], "metrics": {"accuracy": 1}}))
+    (tmp_path / "broken.json").write_text(json.dumps({"metrics": {"accuracy": 1}}))
+    (tmp_path / "list.json").write_text(json.dumps([1, 2]))
+
+    # a record without seconds is still replayable
+    assert cache.get("old")["metrics"] == {"accuracy": 1}
+    assert cache.get("broken") is None
+    assert cache.get("list") is None
+    assert cache.stats()["seconds_saved"] == 0